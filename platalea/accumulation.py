@@ -0,0 +1,79 @@
+import torch
+
+import platalea.hardware
+
+
+def micro_batches(loader, accumulation_steps=1):
+    """Groups the batches of `loader` into lists of `accumulation_steps`
+    micro-batches, each list making up one optimization step. The last list
+    of an epoch can be shorter."""
+    items = []
+    for item in loader:
+        items.append(item)
+        if len(items) == accumulation_steps:
+            yield items
+            items = []
+    if items:
+        yield items
+
+
+def accumulate_gradients(net, items, scaler, amp=None, gradient_cache=False):
+    """Accumulates the gradients of the cost of `net` over the micro-batches
+    in `items` and returns the value of the cost averaged over them.
+
+    With `gradient_cache`, and if `net` is a contrastive model exposing
+    `encode` and `embedding_cost`, the embeddings of all micro-batches are
+    first computed without keeping the graph, the cost is computed over
+    the similarity matrix of the full batch, and its gradient with respect
+    to the embeddings is then backpropagated through each micro-batch in
+    turn (Gao et al., 2021 [https://arxiv.org/abs/2101.06983]). This gives
+    the negatives of the full batch with the memory of a micro-batch.
+    """
+    if gradient_cache and hasattr(net, 'encode'):
+        return _gradient_cache(net, items, scaler, amp)
+    cost = 0
+    for item in items:
+        with platalea.hardware.autocast(amp):
+            loss = net.cost(item)
+        scaler.scale(loss / len(items)).backward()
+        cost += loss.item()
+    return cost / len(items)
+
+
+def _get_rng_state():
+    if torch.cuda.is_available():
+        return torch.get_rng_state(), torch.cuda.get_rng_state_all()
+    return torch.get_rng_state(), None
+
+
+def _set_rng_state(state):
+    cpu_state, cuda_state = state
+    torch.set_rng_state(cpu_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state_all(cuda_state)
+
+
+def _gradient_cache(net, items, scaler, amp):
+    # Computing the embeddings of all micro-batches, keeping the random
+    # state to replay dropout identically in the second pass
+    rng_states = []
+    cache = []
+    with torch.no_grad():
+        for item in items:
+            rng_states.append(_get_rng_state())
+            with platalea.hardware.autocast(amp):
+                enc = net.encode(item)
+            cache.append([e.detach().float().requires_grad_() for e in enc])
+    # Computing the cost over the full batch and its gradient with respect to
+    # the embeddings
+    full = [torch.cat(e) for e in zip(*cache)]
+    with platalea.hardware.autocast(amp):
+        loss = net.embedding_cost(*full)
+    scaler.scale(loss).backward()
+    # Backpropagating the cached gradients through each micro-batch
+    for item, state, enc_cache in zip(items, rng_states, cache):
+        _set_rng_state(state)
+        with platalea.hardware.autocast(amp):
+            enc = net.encode(item)
+        torch.autograd.backward(enc, [e.grad.to(o.dtype) for o, e in zip(enc, enc_cache)])
+    return loss.item()
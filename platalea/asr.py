@@ -8,6 +8,11 @@ import torch.nn.functional as F
 
 import platalea.schedulers
 import platalea.dataset as D
+import platalea.distributed
+from platalea.accumulation import accumulate_gradients, micro_batches
+from platalea.checkpoint import CheckpointWriter, TrainingState
+from platalea.controller import EpsilonDecay, TrainingController
+from platalea.utils.files import model_fname
 from platalea.decoders import TextDecoder
 from platalea.encoders import SpeechEncoder
 import platalea.loss
@@ -89,29 +94,80 @@ def experiment(net, data, config, slt=False):
             result = []
             for item in data['val']:
                 item = {key: value.to(_device) for key, value in item.items()}
-                result.append(net.cost(item).item())
+                with platalea.hardware.autocast(config.get('amp')):
+                    result.append(net.cost(item).item())
             net.train()
         return torch.tensor(result).mean()
 
     net.to(_device)
+    platalea.distributed.broadcast_parameters(net)
     net.train()
     net_parameters = net.parameters()
     optimizer = create_optimizer(config, net_parameters)
     scheduler = create_scheduler(config, optimizer, data)
-
-    results = []
-    with open("result.json", "w") as out:
-        best_score = -np.inf
-        for epoch in range(1, config['epochs']+1):
-            cost = Counter()
-            for j, item in enumerate(data['train'], start=1):
-                item = {key: value.to(_device) for key, value in item.items()}
-                loss = net.cost(item)
-                optimizer.zero_grad()
-                loss.backward()
+    scaler = platalea.hardware.grad_scaler(config.get('amp'))
+    writer = CheckpointWriter(keep_last=config.get('keep_checkpoints'),
+                              best_path='net.best.pt')
+    policies = []
+    if 'epsilon_decay' in config.keys():
+        policies.append(EpsilonDecay(net, optimizer, writer, config['epsilon_decay']))
+    controller = TrainingController.from_config(
+        config, 'slt' if slt else 'asr', plateau_policies=policies)
+    state = TrainingState(config.get('checkpoint'), writer, net=net,
+                          optimizer=optimizer, scheduler=scheduler, scaler=scaler,
+                          controller=controller)
+    if config.get('resume'):
+        state.load()
+
+    def evaluate(out, epoch, step=None):
+        with torch.no_grad():
+            net.eval()
+            workers = config.get('score_workers', 1)
+            val = controller.validation(data['val'].dataset)
+            if slt:
+                result = platalea.score.score_slt(net, val, workers=workers)
+            else:
+                result = platalea.score.score_asr(net, val, workers=workers)
+            net.train()
+        cost = state.costs['train']
+        result['average_loss'] = cost['cost'] / cost['N']
+        result['epoch'] = epoch
+        if step is not None:
+            result['step'] = step
+        json.dump(result, out)
+        print('', file=out, flush=True)
+        state.add_result(result, out)
+        if platalea.distributed.is_main_process():
+            logging.info("Saving model in {}".format(model_fname(epoch, step)))
+            writer.save(net, model_fname(epoch, step), score=controller.score(result))
+        controller.evaluated(result)
+
+    results = state.results
+    with writer, state.open_results("result.json") as out:
+        for epoch in range(state.epoch, config['epochs']+1):
+            reason = controller.stop_reason()
+            if reason is not None:
+                logging.info("Stopping training: {}".format(reason))
+                break
+            platalea.distributed.set_epoch(data['train'], epoch)
+            train_steps = micro_batches(data['train'],
+                                        config.get('accumulation_steps', 1))
+            train_steps = state.epoch_steps(epoch, train_steps)
+            cost = state.costs['train']
+            for j, items in enumerate(train_steps, start=state.step + 1):
+                items = [{key: value.to(_device) for key, value in item.items()}
+                         for item in items]
+                loss_value = accumulate_gradients(net, items, scaler,
+                                                  amp=config.get('amp'))
+                platalea.distributed.average_gradients(net)
+                # Gradients have to be unscaled for clipping to see their
+                # actual norm
+                scaler.unscale_(optimizer)
                 nn.utils.clip_grad_norm_(net.parameters(), config['max_norm'])
-                optimizer.step()
-                cost += Counter({'cost': loss.item(), 'N': 1})
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+                cost += Counter({'cost': loss_value, 'N': 1})
                 average_loss = cost['cost'] / cost['N']
                 if 'opt' not in config.keys() or config['opt'] == 'adam':
                     scheduler.step()
@@ -120,39 +176,17 @@ def experiment(net, data, config, slt=False):
                         epoch, j, average_loss))
                 if j % config['validation_interval'] == 0:
                     logging.info("valid {} {} {}".format(epoch, j, val_loss()))
-            with torch.no_grad():
-                net.eval()
-                if slt:
-                    result = platalea.score.score_slt(net, data['val'].dataset)
-                else:
-                    result = platalea.score.score_asr(net, data['val'].dataset)
-                net.train()
-            result['average_loss'] = average_loss
-            result['epoch'] = epoch
-            results.append(result)
-            json.dump(result, out)
-            print('', file=out, flush=True)
-            if 'epsilon_decay' in config.keys():
-                if slt:
-                    score = result['bleu']
-                else:
-                    score = -result['wer']['WER']
-                if score > best_score:
-                    best_score = score
-                else:
-                    net.load_state_dict(torch.load('net.{}.pt'.format(epoch - 1)))
-                    for p in optimizer.param_groups:
-                        p["eps"] *= config['epsilon_decay']
-                        print('Epsilon decay - new value: ', p["eps"])
-                logging.info("Saving model in net.{}.pt".format(epoch))
-                # Saving weights only
-                torch.save(net.state_dict(), "net.{}.pt".format(epoch))
-            else:
-                logging.info("Saving model in net.{}.pt".format(epoch))
-                torch.save(net, "net.{}.pt".format(epoch))
-    if 'epsilon_decay' in config.keys():
-        # Save full model for inference
-        torch.save(net, 'net.best.pt')
+                controller.step()
+                state.end_step(j, config.get('checkpoint_interval'))
+                if controller.evaluation_due():
+                    evaluate(out, epoch, j)
+                    state.save()
+                if controller.stop_reason() is not None:
+                    break
+            if controller.evaluation_due(end_of_epoch=True,
+                                         end_of_training=epoch == config['epochs']):
+                evaluate(out, epoch)
+            state.end_epoch()
     return results
 
 
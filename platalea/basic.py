@@ -4,11 +4,16 @@ import json
 import numpy as np
 import torch
 import torch.nn as nn
-import wandb  # cloud logging
 
+from platalea.accumulation import accumulate_gradients, micro_batches
+from platalea.checkpoint import CheckpointWriter, TrainingState
+from platalea.controller import TrainingController
+from platalea.utils.files import model_fname
 from platalea.encoders import SpeechEncoder, ImageEncoder
+from platalea.metrics import create_logger
 import platalea.loss
 import platalea.dataset as D
+import platalea.distributed
 import platalea.score
 import platalea.hardware
 import platalea.schedulers
@@ -29,12 +34,32 @@ class SpeechImage(nn.Module):
             self.ImageEncoder = config['ImageEncoder']
         else:
             self.ImageEncoder = ImageEncoder(config['ImageEncoder'])
+        # Recent embeddings used as additional negatives in training
+        self.memory_bank = None
+        if config.get('memory_bank'):
+            self.memory_bank = platalea.loss.MemoryBank(**config['memory_bank'])
 
     def cost(self, item):
+        return self.embedding_cost(*self.encode(item))
+
+    def encode(self, item):
         speech_enc = self.SpeechEncoder(item['audio'], item['audio_len'])
         image_enc = self.ImageEncoder(item['image'])
-        scores = platalea.loss.cosine_matrix(speech_enc, image_enc)
-        loss = platalea.loss.contrastive(scores, margin=self.config['margin_size'])
+        return speech_enc, image_enc
+
+    def embedding_cost(self, speech_enc, image_enc):
+        if self.training and self.config.get('gather_negatives', False):
+            # Contrasting with the batches of all processes
+            speech_enc = platalea.distributed.all_gather_with_grad(speech_enc)
+            image_enc = platalea.distributed.all_gather_with_grad(image_enc)
+        if self.training and self.memory_bank is not None:
+            return platalea.loss.contrastive_with_memory(
+                speech_enc, image_enc, self.memory_bank,
+                margin=self.config['margin_size'],
+                hard_negatives=self.config.get('hard_negatives'))
+        loss = platalea.loss.cosine_contrastive(
+            speech_enc, image_enc, margin=self.config['margin_size'],
+            hard_negatives=self.config.get('hard_negatives'))
         return loss
 
     def embed_image(self, images):
@@ -78,79 +103,99 @@ def experiment(net, data, config,
         result = []
         for item in data['val']:
             item = dict_values_to_device(item, _device)
-            result.append(net.cost(item).item())
+            with platalea.hardware.autocast(config.get('amp')):
+                result.append(net.cost(item).item())
         net.train()  # back to train mode
         return torch.tensor(result).mean()
 
-    if not wandb_log:
-        wandb_log = config
-
-    logging.getLogger().info(
-        "Run 'wandb disabled' if you don't want to use wandb cloud logging.")
-    wandb.init(project=wandb_project, entity=wandb_entity, config=wandb_log)
-    wandb.watch(net)
-
     _device = platalea.hardware.device()
     net.to(_device)
+    platalea.distributed.broadcast_parameters(net)
     net.train()
     net_parameters = net.parameters()
     optimizer = create_optimizer(config, net_parameters)
     scheduler = create_scheduler(config, optimizer, data)
+    scaler = platalea.hardware.grad_scaler(config.get('amp'))
+    writer = CheckpointWriter(keep_last=config.get('keep_checkpoints'),
+                              best_path='net.best.pt')
+    controller = TrainingController.from_config(config)
+    state = TrainingState(config.get('checkpoint'), writer, net=net,
+                          optimizer=optimizer, scheduler=scheduler, scaler=scaler,
+                          controller=controller)
+    if config.get('resume'):
+        state.load()
+    metrics = create_logger(config, net, wandb_log, wandb_project, wandb_entity)
+
+    def evaluate(out, epoch, step=None):
+        logging.info("Calculating and saving epoch score results")
+        net.eval()
+        result = platalea.score.score(net, controller.validation(data['val'].dataset))
+        net.train()
+        result['epoch'] = epoch
+        if step is not None:
+            result['step'] = step
+        cost = state.costs['train']
+        result['average_loss'] = cost['cost'] / cost['N']
+        json.dump(result, out)
+        print('', file=out, flush=True)
+        state.add_result(result, out)
+        if platalea.distributed.is_main_process():
+            logging.info("Saving model in {}".format(model_fname(epoch, step)))
+            writer.save(net, model_fname(epoch, step), score=controller.score(result))
+        controller.evaluated(result)
+        metrics.log(result, step=controller.steps)
+        metrics.flush()
 
     debug_logging_active = logging.getLogger().isEnabledFor(logging.DEBUG)
 
     loss_value = None
-    results = []
-    with open("result.json", "w") as out:
-        for epoch in range(1, config['epochs']+1):
-            cost = Counter()
-            for j, item in enumerate(data['train'], start=1):  # check reshuffling
-                wandb_step_output = {
-                    "epoch": epoch,
-                }
-
-                item = dict_values_to_device(item, _device)
-                loss = net.cost(item)
+    results = state.results
+    with writer, metrics, state.open_results("result.json") as out:
+        for epoch in range(state.epoch, config['epochs']+1):
+            reason = controller.stop_reason()
+            if reason is not None:
+                logging.info("Stopping training: {}".format(reason))
+                break
+            platalea.distributed.set_epoch(data['train'], epoch)
+            train_steps = micro_batches(data['train'], config.get('accumulation_steps', 1))
+            train_steps = state.epoch_steps(epoch, train_steps)
+            cost = state.costs['train']
+            for j, items in enumerate(train_steps, start=state.step + 1):  # check reshuffling
+                items = [dict_values_to_device(item, _device) for item in items]
+                loss_value = accumulate_gradients(net, items, scaler, amp=config.get('amp'),
+                                                  gradient_cache=config.get('gradient_cache', False))
+                platalea.distributed.average_gradients(net)
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
                 scheduler.step()
-                loss_value = loss.item()
                 cost += Counter({'cost': loss_value, 'N': 1})
                 average_loss = cost['cost'] / cost['N']
 
                 # logging
-                wandb_step_output["step loss"] = loss_value
-                wandb_step_output["last_lr"] = scheduler.get_last_lr()[0]
+                step_metrics = {"epoch": epoch, "step loss": loss_value,
+                                "last_lr": scheduler.get_last_lr()[0]}
                 if j % config['loss_logging_interval'] == 0:
                     logging.info("train %d %d %f", epoch, j, average_loss)
-                else:
-                    if debug_logging_active:
-                        logging.debug("train %d %d %f %f", epoch, j, average_loss, loss_value)
+                elif debug_logging_active:
+                    logging.debug("train %d %d %f %f", epoch, j, average_loss, loss_value)
                 if j % config['validation_interval'] == 0:
-                    validation_loss = val_loss(net)
+                    validation_loss = val_loss(net).item()
                     logging.info("valid %d %d %f", epoch, j, validation_loss)
-                    wandb_step_output["validation loss"] = validation_loss
-                else:
-                    if debug_logging_active:
-                        validation_loss = val_loss(net)
-                        logging.debug("valid %d %d %f", epoch, j, validation_loss)
-                        wandb_step_output["validation loss"] = validation_loss
-                wandb.log(wandb_step_output)
-
-            logging.info("Saving model in net.{}.pt".format(epoch))
-            torch.save(net, "net.{}.pt".format(epoch))
-
-            logging.info("Calculating and saving epoch score results")
-            net.eval()
-            result = platalea.score.score(net, data['val'].dataset)
-            net.train()
-            result['epoch'] = epoch
-            result['average_loss'] = average_loss
-            results.append(result)
-            json.dump(result, out)
-            print('', file=out, flush=True)
-            wandb.log(result)
+                    step_metrics["validation loss"] = validation_loss
+                controller.step()
+                metrics.log(step_metrics, step=controller.steps)
+                state.end_step(j, config.get('checkpoint_interval'))
+                if controller.evaluation_due():
+                    evaluate(out, epoch, j)
+                    state.save()
+                if controller.stop_reason() is not None:
+                    break
+
+            if controller.evaluation_due(end_of_epoch=True,
+                                         end_of_training=epoch == config['epochs']):
+                evaluate(out, epoch)
+            state.end_epoch()
 
     return results
 
@@ -161,4 +206,5 @@ DEFAULT_CONFIG = dict(SpeechEncoder=dict(conv=dict(in_channels=39, out_channels=
                                                   bidirectional=True, dropout=0),
                                          att=dict(in_size=2048, hidden_size=128)),
                       ImageEncoder=dict(linear=dict(in_size=2048, out_size=2*1024), norm=True),
-                      margin_size=0.2)
+                      margin_size=0.2,
+                      hard_negatives=None)
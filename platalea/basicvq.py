@@ -1,11 +1,17 @@
 import numpy as np
 import torch
 import torch.nn as nn
-from platalea.encoders import SpeechEncoderVQ, SpeechEncoderVQ2, ImageEncoder, inout
+from platalea.encoders import SpeechEncoderVQ, SpeechEncoderVQ2, ImageEncoder
 import platalea.loss
+from platalea.accumulation import accumulate_gradients, micro_batches
+from platalea.checkpoint import CheckpointWriter, TrainingState
+from platalea.controller import TrainingController
+from platalea.utils.files import model_fname
 from collections import Counter
 import logging
 import platalea.dataset as D
+import platalea.distributed
+import platalea.hardware
 import platalea.score
 import json
 
@@ -23,12 +29,26 @@ class SpeechImage(nn.Module):
         else:
             self.SpeechEncoder = SpeechEncoderVQ(config['SpeechEncoder'])
         self.ImageEncoder = ImageEncoder(config['ImageEncoder'])
+        # Recent embeddings used as additional negatives in training
+        self.memory_bank = None
+        if config.get('memory_bank'):
+            self.memory_bank = platalea.loss.MemoryBank(**config['memory_bank'])
 
     def cost(self, item):
         speech_enc = self.SpeechEncoder(item['audio'], item['audio_len'])
         image_enc = self.ImageEncoder(item['image'])
-        scores = platalea.loss.cosine_matrix(speech_enc, image_enc)
-        loss = platalea.loss.contrastive(scores, margin=self.config['margin_size'])
+        if self.training and self.config.get('gather_negatives', False):
+            # Contrasting with the batches of all processes
+            speech_enc = platalea.distributed.all_gather_with_grad(speech_enc)
+            image_enc = platalea.distributed.all_gather_with_grad(image_enc)
+        if self.training and self.memory_bank is not None:
+            return platalea.loss.contrastive_with_memory(
+                speech_enc, image_enc, self.memory_bank,
+                margin=self.config['margin_size'],
+                hard_negatives=self.config.get('hard_negatives'))
+        loss = platalea.loss.cosine_contrastive(
+            speech_enc, image_enc, margin=self.config['margin_size'],
+            hard_negatives=self.config.get('hard_negatives'))
         return loss
 
     def embed_image(self, images):
@@ -36,8 +56,9 @@ class SpeechImage(nn.Module):
                                             shuffle=False,
                                             collate_fn=D.batch_image)
         image_e = []
+        _device = platalea.hardware.device()
         for i in image:
-            image_e.append(self.ImageEncoder(i.cuda()).detach().cpu().numpy())
+            image_e.append(self.ImageEncoder(i.to(_device)).detach().cpu().numpy())
         image_e = np.concatenate(image_e)
         return image_e
 
@@ -46,68 +67,130 @@ class SpeechImage(nn.Module):
                                             shuffle=False,
                                             collate_fn=D.batch_audio)
         audio_e = []
+        _device = platalea.hardware.device()
         for a, l in audio:
-            audio_e.append(self.SpeechEncoder(a.cuda(), l.cuda()).detach().cpu().numpy())
+            audio_e.append(self.SpeechEncoder(a.to(_device), l.to(_device)).detach().cpu().numpy())
         audio_e = np.concatenate(audio_e)
         return audio_e
 
-    def code_audio(self, audios, one_hot=False):  # FIXME messed up sized ETC
-        audio = torch.utils.data.DataLoader(dataset=audios, batch_size=32,
+    def codes(self, audios, one_hot=False, batch_size=32):
+        """Returns the codes of `audios` for each codebook of the speech
+        encoder, all computed in a single pass: for each codebook, a list of
+        arrays with the code indices of each utterance, or their one-hot
+        encodings (as uint8) with `one_hot`. Padding is removed on the device,
+        and the codes of all utterances are copied at once."""
+        audio = torch.utils.data.DataLoader(dataset=audios, batch_size=batch_size,
                                             shuffle=False,
                                             collate_fn=D.batch_audio)
-        audio_e = []
-        for a, l in audio:
+        codebooks = self.SpeechEncoder.codebooks()
+        levels = [[] for _ in codebooks]
+        lengths = []
+        _device = platalea.hardware.device()
+        with torch.no_grad():
+            for a, l in audio:
+                codes, length = self.SpeechEncoder.codes(a.to(_device), l.to(_device))
+                mask = torch.arange(codes[0].size(1), device=length.device) < length.unsqueeze(1)
+                for level, code in zip(levels, codes):
+                    level.append(code[mask])
+                lengths.append(length)
+        if not lengths:
+            return [[] for _ in codebooks]
+        splits = torch.cat(lengths).cumsum(0)[:-1].cpu().numpy()
+        result = []
+        for level, codebook in zip(levels, codebooks):
+            code = torch.cat(level)
             if one_hot:
-                codes = self.SpeechEncoder.Codebook(self.SpeechEncoder.Bottom(a.cuda(), l.cuda()))['one_hot']
-            else:
-                codes = self.SpeechEncoder.Codebook(self.SpeechEncoder.Bottom(a.cuda(), l.cuda()))['codes']
-            codes = codes.detach().cpu().numpy()
-            for code, L in zip(list(codes), list(l)):
-                code = code[:inout(self.SpeechEncoder.Bottom.Conv, L).item()]
-                audio_e.append(code)
-        return audio_e
+                code = nn.functional.one_hot(code, codebook.embedding.size(0)).to(torch.uint8)
+            result.append(np.split(code.cpu().numpy(), splits))
+        return result
+
+    def code_audio(self, audios, one_hot=False, level=0):
+        """Returns the codes of `audios` for the codebook `level` (see
+        `codes`)."""
+        return self.codes(audios, one_hot=one_hot)[level]
 
 
 def experiment(net, data, config):
     def val_loss():
+        _device = platalea.hardware.device()
         net.eval()
         result = []
         for item in data['val']:
-            item = {key: value.cuda() for key, value in item.items()}
-            result.append(net.cost(item).item())
+            item = {key: value.to(_device) for key, value in item.items()}
+            with platalea.hardware.autocast(config.get('amp')):
+                result.append(net.cost(item).item())
         net.train()
         return torch.tensor(result).mean()
 
-    net.cuda()
+    _device = platalea.hardware.device()
+    net.to(_device)
+    platalea.distributed.broadcast_parameters(net)
     net.train()
     optimizer = create_optimizer(config, net.parameters())
     config['min_lr'] = 1e-6
     scheduler = create_scheduler(config, optimizer, data)
+    scaler = platalea.hardware.grad_scaler(config.get('amp'))
+    writer = CheckpointWriter(keep_last=config.get('keep_checkpoints'),
+                              best_path='net.best.pt')
+    controller = TrainingController.from_config(config)
+    state = TrainingState(config.get('checkpoint'), writer, net=net,
+                          optimizer=optimizer, scheduler=scheduler, scaler=scaler,
+                          controller=controller)
+    if config.get('resume'):
+        state.load()
+
+    def evaluate(out, epoch, step=None):
+        result = platalea.score.score(net, controller.validation(data['val'].dataset))
+        cost = state.costs['train']
+        result['average_loss'] = cost['cost'] / cost['N']
+        result['epoch'] = epoch
+        if step is not None:
+            result['step'] = step
+        print(json.dumps(result), file=out, flush=True)
+        state.add_result(result, out)
+        if platalea.distributed.is_main_process():
+            logging.info("Saving model in {}".format(model_fname(epoch, step)))
+            writer.save(net, model_fname(epoch, step), score=controller.score(result))
+        controller.evaluated(result)
 
-    results = []
-    with open("result.json", "w") as out:
-        for epoch in range(1, config['epochs']+1):
-            cost = Counter()
-            for j, item in enumerate(data['train'], start=1):  # check reshuffling
-                item = {key: value.cuda() for key, value in item.items()}
-                loss = net.cost(item)
+    results = state.results
+    with writer, state.open_results("result.json") as out:
+        for epoch in range(state.epoch, config['epochs']+1):
+            reason = controller.stop_reason()
+            if reason is not None:
+                logging.info("Stopping training: {}".format(reason))
+                break
+            platalea.distributed.set_epoch(data['train'], epoch)
+            train_steps = micro_batches(data['train'], config.get('accumulation_steps', 1))
+            train_steps = state.epoch_steps(epoch, train_steps)
+            cost = state.costs['train']
+            for j, items in enumerate(train_steps, start=state.step + 1):  # check reshuffling
+                items = [{key: value.to(_device) for key, value in item.items()} for item in items]
+                loss_value = accumulate_gradients(net, items, scaler, amp=config.get('amp'))
+                platalea.distributed.average_gradients(net)
+                scaler.step(optimizer)
+                scaler.update()
+                # The codebooks are updated by EMA in each process
+                platalea.distributed.average_buffers(net)
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
                 scheduler.step()
-                cost += Counter({'cost': loss.item(), 'N': 1})
+                cost += Counter({'cost': loss_value, 'N': 1})
                 average_loss = cost['cost'] / cost['N']
                 if j % config['loss_logging_interval'] == 0:
                     logging.info("train {} {} {}".format(epoch, j, average_loss))
                 if j % config['validation_interval'] == 0:
                     logging.info("valid {} {} {}".format(epoch, j, val_loss()))
-            result = platalea.score.score(net, data['val'].dataset)
-            result['average_loss'] = average_loss
-            result['epoch'] = epoch
-            results.append(result)
-            print(json.dumps(result), file=out, flush=True)
-            logging.info("Saving model in net.{}.pt".format(epoch))
-            torch.save(net, "net.{}.pt".format(epoch))
+                controller.step()
+                state.end_step(j, config.get('checkpoint_interval'))
+                if controller.evaluation_due():
+                    evaluate(out, epoch, j)
+                    state.save()
+                if controller.stop_reason() is not None:
+                    break
+            if controller.evaluation_due(end_of_epoch=True,
+                                         end_of_training=epoch == config['epochs']):
+                evaluate(out, epoch)
+            state.end_epoch()
     return results
 
 
@@ -120,4 +203,5 @@ DEFAULT_CONFIG = dict(SpeechEncoder=dict(SpeechEncoderBottom=dict(conv=dict(in_c
                                                                         bidirectional=True, dropout=0),
                                                                att=dict(in_size=2048, hidden_size=128))),
                       ImageEncoder=dict(linear=dict(in_size=2048, out_size=2*1024), norm=True),
-                      margin_size=0.2)
+                      margin_size=0.2,
+                      hard_negatives=None)
@@ -0,0 +1,293 @@
+from collections import Counter, defaultdict
+import copy
+import logging
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+import platalea.distributed
+import platalea.hardware
+from platalea.utils.files import link_file
+
+
+CHECKPOINT = 'checkpoint.pt'
+
+
+def get_rng_state():
+    state = dict(python=random.getstate(), numpy=np.random.get_state(),
+                 torch=torch.get_rng_state())
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_model(path):
+    """Loads a model saved whole in `path` on the current device."""
+    return torch.load(path, map_location=platalea.hardware.device(),
+                      weights_only=False)
+
+
+def load_weights(net, path):
+    """Loads the weights saved in `path` into `net`, whether the whole model or
+    only its state_dict was saved."""
+    saved = load_model(path)
+    if isinstance(saved, torch.nn.Module):
+        saved = saved.state_dict()
+    net.load_state_dict(saved)
+
+
+def _write(obj, path):
+    """Saves `obj` in `path` through a temporary file, so that `path` never
+    holds a partially written checkpoint."""
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _tensors(obj):
+    if isinstance(obj, torch.Tensor):
+        yield obj
+    elif isinstance(obj, torch.nn.Module):
+        yield from obj.parameters()
+        yield from obj.buffers()
+        # Tensors kept as attributes, e.g. attention weights
+        for module in obj.modules():
+            yield from (v for v in vars(module).values() if isinstance(v, torch.Tensor))
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            yield from _tensors(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            yield from _tensors(v)
+
+
+def snapshot(obj):
+    """Returns a deep copy of `obj`, e.g. a model or a state_dict, with its
+    tensors copied to CPU memory."""
+    memo = {}
+    for t in _tensors(obj):
+        cpu = t.detach().to('cpu', copy=True)
+        if isinstance(t, torch.nn.Parameter):
+            cpu = torch.nn.Parameter(cpu, requires_grad=t.requires_grad)
+        memo[id(t)] = cpu
+    return copy.deepcopy(obj, memo)
+
+
+class CheckpointWriter():
+    """Saves checkpoints from a background thread.
+
+    What is saved is first copied to CPU memory, and training goes on while it
+    is written. At most `max_pending` checkpoints wait to be written, saving
+    another one blocks until there is room for it.
+
+    Checkpoints saved with a score, e.g. the model of each epoch, are rotated:
+    when `keep_last` is set, only the `keep_last` most recent ones are kept on
+    disk, as well as the one with the highest score. If `best_path` is set, it
+    is linked to the checkpoint with the highest score as soon as it is
+    written.
+    """
+    def __init__(self, keep_last=None, max_pending=1, best_path=None):
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1')
+        self.keep_last = keep_last
+        self.best_path = best_path
+        self.queue = queue.Queue(max_pending)
+        self.thread = None
+        self.error = None
+        # Rotated checkpoints, as (path, score), from the oldest
+        self.saved = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def state_dict(self):
+        return dict(saved=list(self.saved))
+
+    def load_state_dict(self, state):
+        self.saved = list(state['saved'])
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                obj, path, stale, best = task
+                if self.error is None:
+                    _write(obj, path)
+                    if best:
+                        link_file(path, self.best_path)
+                    for p in stale:
+                        if os.path.exists(p):
+                            os.remove(p)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def _rotate(self, path, score):
+        """Records a new rotated checkpoint. Returns the paths of those which
+        are not kept anymore, and whether the new one is the best."""
+        self.saved = [(p, s) for p, s in self.saved if p != path]
+        self.saved.append((path, score))
+        best = max(self.saved, key=lambda x: x[1])
+        if self.keep_last is None:
+            return [], best[0] == path
+        stale = [x for x in self.saved[:-self.keep_last] if x is not best]
+        self.saved = [x for x in self.saved if x not in stale]
+        return [p for p, _ in stale], best[0] == path
+
+    def save(self, obj, path, score=None):
+        """Saves `obj` in `path` in the background. Checkpoints with a
+        `score` are rotated."""
+        self._check()
+        stale, best = [], False
+        if score is not None:
+            stale, best = self._rotate(path, score)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((snapshot(obj), path, stale, best and self.best_path))
+
+    def wait(self):
+        """Waits until all checkpoints are written."""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._check()
+
+
+class TrainingState():
+    """Bookkeeping of a training run, which can be saved to a checkpoint and
+    restored to resume the run, including in the middle of an epoch.
+
+    The checkpoint is saved in `path`, by default checkpoint.pt, through
+    `writer` if given, a CheckpointWriter whose rotation state is saved too.
+    The keyword arguments are the objects whose state_dict is saved, e.g. the
+    model, optimizer, scheduler and gradient scaler. The checkpoint also holds
+    the current epoch and number of optimizer steps done in it, the random
+    generator states, the costs accumulated over the epoch, the results so far
+    and the size of the results file they were written to.
+    """
+    def __init__(self, path=None, writer=None, **stateful):
+        self.path = path or CHECKPOINT
+        self.writer = writer
+        self.stateful = dict(stateful)
+        if writer is not None:
+            self.stateful['writer'] = writer
+        self.epoch = 1
+        self.step = 0
+        self.costs = defaultdict(Counter)
+        self.results = []
+        self.result_offset = 0
+        # Random state at the start of the epoch, determining the order of
+        # the training data
+        self.epoch_rng_state = None
+
+    def state_dict(self):
+        return dict(
+            stateful={k: v.state_dict() for k, v in self.stateful.items()},
+            epoch=self.epoch, step=self.step, costs=dict(self.costs),
+            results=self.results, result_offset=self.result_offset,
+            epoch_rng_state=self.epoch_rng_state,
+            rng_state=get_rng_state())
+
+    def load_state_dict(self, state):
+        for k, v in self.stateful.items():
+            v.load_state_dict(state['stateful'][k])
+        self.epoch = state['epoch']
+        self.step = state['step']
+        self.costs = defaultdict(Counter, state['costs'])
+        self.results = state['results']
+        self.result_offset = state['result_offset']
+        self.epoch_rng_state = state['epoch_rng_state']
+        set_rng_state(state['rng_state'])
+
+    def save(self):
+        """Saves the checkpoint on the main process, replacing the previous one
+        only once it is completely written."""
+        if not platalea.distributed.is_main_process():
+            return
+        if self.writer is None:
+            _write(self.state_dict(), self.path)
+        else:
+            self.writer.save(self.state_dict(), self.path)
+
+    def load(self):
+        """Restores the saved checkpoint, if any. Returns whether it existed."""
+        path = self.path
+        if not os.path.exists(path):
+            logging.info("No checkpoint in {}, starting from scratch".format(path))
+            return False
+        self.load_state_dict(torch.load(path, map_location='cpu', weights_only=False))
+        logging.info("Resuming from {} at epoch {}, step {}".format(
+            path, self.epoch, self.step))
+        return True
+
+    def open_results(self, path='result.json'):
+        """Opens the results file for writing, dropping the results written
+        after the checkpoint when resuming."""
+        out = platalea.distributed.main_process_open(path, 'a')
+        if platalea.distributed.is_main_process():
+            out.truncate(self.result_offset)
+        return out
+
+    def epoch_steps(self, epoch, steps):
+        """Wraps the training steps of `epoch`. When resuming in the middle of
+        it, the data are drawn in the same order as before and the steps
+        already done are skipped."""
+        if epoch != self.epoch or self.epoch_rng_state is None:
+            self.epoch = epoch
+            self.step = 0
+            self.costs = defaultdict(Counter)
+            self.epoch_rng_state = get_rng_state()
+            return steps
+        rng_state = get_rng_state()
+        set_rng_state(self.epoch_rng_state)
+        steps = iter(steps)
+        for _ in range(self.step):
+            next(steps)
+        set_rng_state(rng_state)
+        return steps
+
+    def end_step(self, step, checkpoint_interval=None):
+        """Records that `step` optimizer steps of the epoch are done, saving a
+        checkpoint every `checkpoint_interval` steps."""
+        self.step = step
+        if checkpoint_interval and step % checkpoint_interval == 0:
+            self.save()
+
+    def add_result(self, result, out):
+        """Records a result written to `out`."""
+        self.results.append(result)
+        self.result_offset = out.tell()
+
+    def end_epoch(self):
+        """Saves a checkpoint to resume from the next epoch."""
+        self.epoch += 1
+        self.step = 0
+        self.epoch_rng_state = None
+        self.save()
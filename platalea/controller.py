@@ -0,0 +1,137 @@
+import logging
+import time
+
+import platalea.dataset as D
+import platalea.distributed
+from platalea.checkpoint import load_weights
+from platalea.utils.get_best_score import get_score
+
+
+class EpsilonDecay():
+    """Policy going back to the best model and decaying the epsilon of the
+    optimizer by `factor` when an evaluation shows no improvement."""
+    def __init__(self, net, optimizer, writer, factor):
+        self.net = net
+        self.optimizer = optimizer
+        self.writer = writer
+        self.factor = factor
+
+    def __call__(self):
+        # The best model has to be written before it is reloaded
+        self.writer.wait()
+        platalea.distributed.barrier()
+        load_weights(self.net, self.writer.best_path)
+        for p in self.optimizer.param_groups:
+            p["eps"] *= self.factor
+            logging.info("Epsilon decay - new value: {}".format(p["eps"]))
+
+
+class TrainingController():
+    """Decides when models are evaluated during training and when training
+    stops.
+
+    By default, models are evaluated at the end of each epoch. With
+    `eval_interval`, they are evaluated every `eval_interval` steps instead,
+    and with `eval_subset` on the first `eval_subset` validation examples
+    only.
+
+    Training stops after `patience` evaluations without improvement of the
+    score of `experiment_type` (see get_best_score), after `max_steps`
+    optimizer steps, or after `max_time` seconds of training, the model being
+    evaluated one last time, as it is at the end of the last epoch. On each
+    evaluation without improvement, the `plateau_policies` are called, e.g.
+    EpsilonDecay.
+    """
+    def __init__(self, experiment_type='retrieval', patience=None, max_steps=None,
+                 max_time=None, eval_interval=None, eval_subset=None,
+                 plateau_policies=()):
+        self.experiment_type = experiment_type
+        self.patience = patience
+        self.max_steps = max_steps
+        self.max_time = max_time
+        self.eval_interval = eval_interval
+        self.eval_subset = eval_subset
+        self.plateau_policies = list(plateau_policies)
+        self.steps = 0
+        self.elapsed = 0
+        self.start_time = time.monotonic()
+        self.best_score = None
+        self.evaluations_since_best = 0
+        self.last_evaluation = None
+
+    @classmethod
+    def from_config(cls, config, experiment_type='retrieval', plateau_policies=()):
+        max_hours = config.get('max_hours')
+        return cls(experiment_type, patience=config.get('patience'),
+                   max_steps=config.get('max_steps'),
+                   max_time=max_hours * 3600 if max_hours else None,
+                   eval_interval=config.get('eval_interval'),
+                   eval_subset=config.get('eval_subset'),
+                   plateau_policies=plateau_policies)
+
+    def state_dict(self):
+        return dict(steps=self.steps, elapsed=self.elapsed_time(),
+                    best_score=self.best_score,
+                    evaluations_since_best=self.evaluations_since_best,
+                    last_evaluation=self.last_evaluation)
+
+    def load_state_dict(self, state):
+        self.steps = state['steps']
+        self.elapsed = state['elapsed']
+        self.start_time = time.monotonic()
+        self.best_score = state['best_score']
+        self.evaluations_since_best = state['evaluations_since_best']
+        self.last_evaluation = state['last_evaluation']
+
+    def elapsed_time(self):
+        return self.elapsed + time.monotonic() - self.start_time
+
+    def score(self, result):
+        return get_score(result, self.experiment_type)
+
+    def step(self):
+        """Records an optimizer step."""
+        self.steps += 1
+
+    def validation(self, dataset):
+        """Returns the validation data to evaluate models on."""
+        if self.eval_subset:
+            return D.EvaluationSubset(dataset, self.eval_subset)
+        return dataset
+
+    def evaluation_due(self, end_of_epoch=False, end_of_training=False):
+        """Returns whether the model should be evaluated now, after a step or
+        at the end of an epoch. The final model is always evaluated."""
+        if self.last_evaluation == self.steps:
+            return False
+        if end_of_training or self.stop_reason() is not None:
+            return True
+        if self.eval_interval:
+            return self.steps % self.eval_interval == 0
+        return end_of_epoch
+
+    def evaluated(self, result):
+        """Records the result of an evaluation. Returns whether it is the best
+        so far."""
+        self.last_evaluation = self.steps
+        score = self.score(result)
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+            self.evaluations_since_best = 0
+            return True
+        self.evaluations_since_best += 1
+        for policy in self.plateau_policies:
+            policy()
+        return False
+
+    def stop_reason(self):
+        """Returns why training should stop, or None if it should go on."""
+        if self.patience is not None and self.evaluations_since_best >= self.patience:
+            return 'no improvement in {} evaluations'.format(self.patience)
+        if self.max_steps is not None and self.steps >= self.max_steps:
+            return 'step budget of {} reached'.format(self.max_steps)
+        # Processes have to agree on stopping, so the main one decides
+        if self.max_time is not None and \
+                platalea.distributed.broadcast(self.elapsed_time() >= self.max_time):
+            return 'time budget of {:.0f}s reached'.format(self.max_time)
+        return None
@@ -3,10 +3,11 @@ import numpy as np
 import pathlib
 import pickle
 import random
-from sklearn.preprocessing import LabelEncoder
 import torch
 import torch.utils.data
 
+import platalea.distributed
+
 
 class TranscribedDataset():
     le = None
@@ -17,6 +18,7 @@ class TranscribedDataset():
 
     @classmethod
     def init_vocabulary(cls, transcriptions):
+        from sklearn.preprocessing import LabelEncoder
         cls.le = LabelEncoder()
         tokens = [cls.sos, cls.eos, cls.unk, cls.pad] + \
                  [c for t in transcriptions for c in t]
@@ -129,15 +131,16 @@ class Flickr8KData(torch.utils.data.Dataset, TranscribedDataset):
                     label_encoder=self.get_label_encoder(),
                     language=self.language)
 
-    def evaluation(self):
+    def evaluation(self, limit=None):
         """Returns image features, audio features, caption features, and a
-        boolean array specifying whether a caption goes with an image."""
+        boolean array specifying whether a caption goes with an image.
+        Optionally, only the first `limit` captions are used."""
         audio = []
         text = []
         image = []
         matches = []
         image2idx = {}
-        for sd in self.split_data:
+        for sd in self.split_data[:limit]:
             # Add image
             if sd[0] in image2idx:
                 image_idx = image2idx[sd[0]]
@@ -208,17 +211,34 @@ class LibriSpeechData(torch.utils.data.Dataset, TranscribedDataset):
         return dict(feature_fname=self.feature_fname,
                     label_encoder=self.get_label_encoder())
 
-    def evaluation(self):
-        """Returns audio features with corresponding caption"""
+    def evaluation(self, limit=None):
+        """Returns audio features with corresponding caption. Optionally,
+        only the first `limit` examples are used."""
         audio = []
         text = []
-        for ex in self.metadata:
+        for ex in self.metadata[:limit]:
             text.append(ex['trn'])
             a = torch.from_numpy(self.audio[ex['audio_start']:ex['audio_end']])
             audio.append(a)
         return dict(audio=audio, text=text)
 
 
+class EvaluationSubset():
+    """Dataset whose evaluation data are limited to its first `size`
+    examples, e.g. to score models faster during training."""
+    def __init__(self, dataset, size):
+        self.dataset = dataset
+        self.size = size
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def evaluation(self):
+        return self.dataset.evaluation(limit=self.size)
+
+
 def batch_audio(audios, max_frames=2048):
     """Merge audio captions. Truncate to max_frames. Pad with 0s."""
     mfcc_lengths = [len(cap[:max_frames, :]) for cap in audios]
@@ -270,15 +290,20 @@ def flickr8k_loader(root, meta_fname, language, feature_fname,
                     split='train', batch_size=32, shuffle=False,
                     max_frames=2048,
                     downsampling_factor=None):
+    dataset = Flickr8KData(root=root,
+                           feature_fname=feature_fname,
+                           meta_fname=meta_fname,
+                           split=split,
+                           language=language,
+                           downsampling_factor=downsampling_factor)
+    # When training distributed, each process gets its own part of the
+    # training data
+    sampler = platalea.distributed.sampler(dataset, shuffle) if split == 'train' else None
     return torch.utils.data.DataLoader(
-        dataset=Flickr8KData(root=root,
-                             feature_fname=feature_fname,
-                             meta_fname=meta_fname,
-                             split=split,
-                             language=language,
-                             downsampling_factor=downsampling_factor),
+        dataset=dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         num_workers=0,
         collate_fn=lambda x: collate_fn(x, max_frames=max_frames))
 
@@ -287,13 +312,16 @@ def librispeech_loader(root, meta_fname, feature_fname,
                        split='train', batch_size=32, shuffle=False,
                        max_frames=2048,
                        downsampling_factor=None):
+    dataset = LibriSpeechData(root=root,
+                              feature_fname=feature_fname,
+                              meta_fname=meta_fname,
+                              split=split,
+                              downsampling_factor=downsampling_factor)
+    sampler = platalea.distributed.sampler(dataset, shuffle) if split == 'train' else None
     return torch.utils.data.DataLoader(
-        dataset=LibriSpeechData(root=root,
-                                feature_fname=feature_fname,
-                                meta_fname=meta_fname,
-                                split=split,
-                                downsampling_factor=downsampling_factor),
+        dataset=dataset,
         batch_size=batch_size,
-        shuffle=shuffle,
+        shuffle=shuffle and sampler is None,
+        sampler=sampler,
         num_workers=0,
         collate_fn=lambda x: collate_fn_speech(x, max_frames=max_frames))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+Launches an experiment in several data-parallel processes
+
+Runs `python -m <module> [args]` in the given number of processes on the local
+machine, setting the environment variables read by
+platalea.distributed.init_process_group (the same ones as torchrun).
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import torch
+import torch.distributed as dist
+import torch.utils.data
+
+import platalea.hardware
+
+
+def init_process_group():
+    """Initialize the default process group from the environment variables
+    RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT, as set by the launcher in
+    this module or by torchrun. Does nothing for a single process.
+
+    Processes communicate through nccl when training on GPU, and through gloo
+    on CPU.
+    """
+    if is_initialized() or int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return
+    _device = platalea.hardware.device()
+    if _device.type == 'cuda':
+        torch.cuda.set_device(_device)
+        dist.init_process_group('nccl')
+    else:
+        dist.init_process_group('gloo')
+
+
+def is_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_initialized() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_initialized():
+        dist.barrier()
+
+
+def main_process_open(path, mode='w'):
+    """Open `path` on the main process and the null device on the others, so
+    that results are written only once."""
+    return open(path if is_main_process() else os.devnull, mode)
+
+
+def sampler(dataset, shuffle=False):
+    """Return a sampler giving each process its own part of `dataset`, or None
+    if not running distributed."""
+    if not is_initialized():
+        return None
+    return torch.utils.data.distributed.DistributedSampler(dataset, shuffle=shuffle)
+
+
+def set_epoch(loader, epoch):
+    """Reshuffle the part of the data each process gets at every epoch."""
+    if isinstance(loader.sampler, torch.utils.data.distributed.DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+def broadcast(obj):
+    """Return the object passed by the main process."""
+    if not is_initialized():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, 0)
+    return objects[0]
+
+
+def broadcast_parameters(net):
+    """Copy the parameters and buffers of the main process to the others."""
+    if not is_initialized():
+        return
+    for t in list(net.parameters()) + list(net.buffers()):
+        dist.broadcast(t.data, 0)
+
+
+def average_gradients(net):
+    """Average the gradients of `net` over all processes, communicating them in
+    a single flat buffer."""
+    if not is_initialized():
+        return
+    grads = [p.grad for p in net.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat)
+    flat /= get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset + g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def average_buffers(net):
+    """Average the floating point buffers of `net` over all processes, e.g. to
+    keep the VQ codebooks updated by each process in sync."""
+    if not is_initialized():
+        return
+    for b in net.buffers():
+        if b.is_floating_point():
+            dist.all_reduce(b.data)
+            b.data /= get_world_size()
+
+
+def shard(items):
+    """Return the contiguous part of `items` processed by this process."""
+    rank, world_size = get_rank(), get_world_size()
+    return items[len(items) * rank // world_size:len(items) * (rank + 1) // world_size]
+
+
+def all_gather(obj):
+    """Return the list of the objects passed by each process, in rank order."""
+    if not is_initialized():
+        return [obj]
+    result = [None] * get_world_size()
+    dist.all_gather_object(result, obj)
+    return result
+
+
+class _AllGather(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x):
+        # Batches can differ in size between processes, so they are padded to
+        # the largest one
+        size = torch.tensor([x.shape[0]], device=x.device)
+        sizes = [torch.zeros_like(size) for _ in range(get_world_size())]
+        dist.all_gather(sizes, size)
+        ctx.sizes = [int(n) for n in sizes]
+        padded = x.new_zeros((max(ctx.sizes),) + x.shape[1:])
+        padded[:x.shape[0]] = x
+        parts = [torch.empty_like(padded) for _ in ctx.sizes]
+        dist.all_gather(parts, padded)
+        return torch.cat([p[:n] for p, n in zip(parts, ctx.sizes)])
+
+    @staticmethod
+    def backward(ctx, grad):
+        # Every process computes the loss over the gathered batch, so the
+        # gradient of the local rows is summed over processes
+        grad = grad.contiguous().clone()
+        dist.all_reduce(grad)
+        start = sum(ctx.sizes[:get_rank()])
+        return grad[start:start + ctx.sizes[get_rank()]]
+
+
+def all_gather_with_grad(x):
+    """Concatenate the batches `x` of all processes in rank order, letting the
+    gradient flow back to the rows of the local batch. The result is the same
+    in all processes, e.g. to compute a loss over the global batch."""
+    if not is_initialized():
+        return x
+    return _AllGather.apply(x)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def launch(module, args=(), nproc=2):
+    """Run `python -m module args` in `nproc` processes and return the highest
+    exit code. If one process fails, the others are terminated."""
+    port = _free_port()
+    processes = []
+    for rank in range(nproc):
+        env = dict(os.environ, RANK=str(rank), LOCAL_RANK=str(rank),
+                   WORLD_SIZE=str(nproc), MASTER_ADDR='127.0.0.1',
+                   MASTER_PORT=str(port))
+        processes.append(subprocess.Popen([sys.executable, '-m', module] + list(args), env=env))
+    while any(p.poll() is None for p in processes):
+        if any(p.poll() for p in processes):
+            for p in processes:
+                if p.poll() is None:
+                    p.terminate()
+        time.sleep(0.5)
+    return max(p.returncode for p in processes)
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    parser = argparse.ArgumentParser(description=doc[0], epilog=doc[1])
+    parser.add_argument(
+        '--nproc', help='Number of processes (default=2).', type=int,
+        default=2)
+    parser.add_argument(
+        'module', help='Experiment module, e.g. platalea.experiments.flickr8k.basic')
+    parser.add_argument(
+        'args', help='Arguments passed on to the experiment.',
+        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    sys.exit(launch(args.module, args.args, args.nproc))
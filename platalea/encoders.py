@@ -393,6 +393,11 @@ class SpeechEncoderBottom(nn.Module):
             x, _ = self.RNN(x)
         return x
 
+    def output_length(self, length):
+        """Returns the lengths of the output sequences given those of the
+        inputs."""
+        return inout(self.Conv, length).clamp(min=1)
+
     def introspect(self, input, length):
         if self.RNN is not None and not hasattr(self, 'IntrospectRNN'):
             logging.info("Creating IntrospectRNN wrapper")
@@ -532,6 +537,15 @@ class SpeechEncoderVQ(nn.Module):
     def forward(self, input, length):
         return self.Top(self.Codebook(self.Bottom(input, length))['quantized'])
 
+    def codebooks(self):
+        return [self.Codebook]
+
+    def codes(self, input, length):
+        """Returns the padded code indices of the inputs for each codebook,
+        and the number of codes of each input."""
+        codes = self.Codebook(self.Bottom(input, length))['codes']
+        return [codes], self.Bottom.output_length(length)
+
     def introspect(self, input, length):
 
         x = self.Bottom(input, length)
@@ -559,6 +573,17 @@ class SpeechEncoderVQ2(nn.Module):
     def forward(self, input, length):
         return self.Top(self.Codebook2(self.Middle(self.Codebook1(self.Bottom(input, length))['quantized']))['quantized'])
 
+    def codebooks(self):
+        return [self.Codebook1, self.Codebook2]
+
+    def codes(self, input, length):
+        """Returns the padded code indices of the inputs for each codebook,
+        and the number of codes of each input."""
+        x = self.Codebook1(self.Bottom(input, length))
+        codes1 = x['codes']
+        codes2 = self.Codebook2(self.Middle(x['quantized']))['codes']
+        return [codes1, codes2], self.Bottom.output_length(length)
+
     def introspect(self, input, length):
 
         x = self.Bottom(input, length)
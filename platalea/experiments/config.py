@@ -98,6 +98,41 @@ def get_argument_parser():
         '--device', type=str, default=None, env_var="PLATALEA_DEVICE",
         help="Device to train on. Can be passed on to platalea.hardware.device \
         in experiments.")
+    args.add_argument(
+        '--amp', default=None, choices=['fp16', 'bf16'],
+        help='Train with automatic mixed precision in the given floating point \
+        format. fp16 uses gradient scaling and is meant for GPUs, bf16 also \
+        works on recent CPUs. By default, training runs in fp32.')
+    args.add_argument(
+        '--accumulation_steps', type=int, default=1,
+        help='Number of batches over which gradients are accumulated before \
+        each optimizer step. The effective batch size is the batch size \
+        times this number.')
+    args.add_argument(
+        '--gradient_cache', action='store_true',
+        help='With gradient accumulation, compute contrastive losses over the \
+        similarity matrix of all accumulated batches instead of each batch \
+        separately, caching embeddings to keep the memory of one batch.')
+    args.add_argument(
+        '--hard_negatives', type=int, default=None,
+        help='Compute contrastive losses over the given number of hardest \
+        negatives of each example only, 1 giving the max violation loss. By \
+        default, all negatives are used.')
+    args.add_argument(
+        '--gather_negatives', action='store_true',
+        help='When training distributed, compute contrastive losses over the \
+        batches of all processes instead of each local batch, giving more \
+        negative examples.')
+    args.add_argument(
+        '--memory_bank_size', type=int, default=0,
+        help='Number of recent speech and image embeddings kept in a memory \
+        bank and used as additional negatives in the speech-image \
+        contrastive loss. By default, no memory bank is used.')
+    args.add_argument(
+        '--memory_bank_max_age', type=int, default=None,
+        help='Number of batches after which embeddings in the memory bank are \
+        too stale to be used as negatives. By default, embeddings are used \
+        until they are replaced.')
     args.add_argument(
         '--hidden_size_factor', type=int, default=1024,
         help='The experiment models by default have a factor 1024 in their \
@@ -112,6 +147,54 @@ def get_argument_parser():
     args.add_argument(
         '--validation_interval', type=int, default=400,
         help='Step interval at which a validation step is run and logged on the info level.')
+    args.add_argument(
+        '--score_workers', type=int, default=1,
+        help='Number of processes used to compute the error rates (CER/WER) \
+        when scoring ASR/SLT models.')
+    args.add_argument(
+        '--resume', action='store_true',
+        help='Resume training from the checkpoint.pt file in the run \
+        directory, if any, including in the middle of an epoch.')
+    args.add_argument(
+        '--checkpoint_interval', type=int, default=None,
+        help='Step interval at which checkpoint.pt is saved to resume \
+        training from. By default, it is only saved at the end of each \
+        epoch.')
+    args.add_argument(
+        '--keep_checkpoints', type=int, default=None,
+        help='Number of most recent epoch models (net.<epoch>.pt) kept on \
+        disk, the best one being kept too. By default, all are kept.')
+    args.add_argument(
+        '--patience', type=int, default=None,
+        help='Stop training after this number of evaluations without \
+        improvement of the validation score. By default, training runs for \
+        all epochs.')
+    args.add_argument(
+        '--max_steps', type=int, default=None,
+        help='Stop training after this number of optimizer steps, evaluating \
+        the model one last time.')
+    args.add_argument(
+        '--max_hours', type=float, default=None,
+        help='Stop training after this number of hours, evaluating the model \
+        one last time.')
+    args.add_argument(
+        '--eval_interval', type=int, default=None,
+        help='Step interval at which the model is evaluated and saved \
+        (net.<epoch>.<step>.pt). By default, it is evaluated at the end of \
+        each epoch.')
+    args.add_argument(
+        '--eval_subset', type=int, default=None,
+        help='Number of validation examples the model is evaluated on. By \
+        default, the whole validation set is used.')
+    args.add_argument(
+        '--metrics', nargs='*', default=['jsonl', 'wandb'],
+        choices=['jsonl', 'csv', 'wandb'],
+        help='Where training metrics are logged: metrics.jsonl, metrics.csv \
+        and/or wandb, if installed.')
+    args.add_argument(
+        '--wandb_watch', default=None, choices=['gradients', 'parameters', 'all'],
+        help='Log histograms of the gradients and/or parameters to wandb. \
+        Off by default as it runs hooks at each step.')
 
     # Flickr8k specific parameters
     args.add_argument(
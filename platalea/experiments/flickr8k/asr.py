@@ -4,6 +4,7 @@ import torch
 
 import platalea.asr as M
 import platalea.dataset as D
+import platalea.distributed
 from platalea.experiments.config import get_argument_parser
 
 
@@ -15,6 +16,7 @@ args.parse()
 # Setting general configuration
 torch.manual_seed(args.seed)
 random.seed(args.seed)
+platalea.distributed.init_process_group()
 
 # Logging the arguments
 logging.info('Arguments: {}'.format(args))
@@ -39,7 +41,18 @@ run_config = dict(max_norm=2.0, max_lr=args.cyclic_lr_max, min_lr=args.cyclic_lr
                   l2_regularization=args.l2_regularization,
                   loss_logging_interval=args.loss_logging_interval,
                   validation_interval=args.validation_interval,
-                  opt=args.optimizer
+                  opt=args.optimizer,
+                  amp=args.amp,
+                  accumulation_steps=args.accumulation_steps,
+                  score_workers=args.score_workers,
+                  resume=args.resume,
+                  checkpoint_interval=args.checkpoint_interval,
+                  keep_checkpoints=args.keep_checkpoints,
+                  patience=args.patience,
+                  max_steps=args.max_steps,
+                  max_hours=args.max_hours,
+                  eval_interval=args.eval_interval,
+                  eval_subset=args.eval_subset
                   )
 
 logging.info('Training')
@@ -1,9 +1,11 @@
+from functools import partial
 import logging
 import random
 import torch
 import torch.nn as nn
 
 import platalea.dataset as D
+import platalea.distributed
 import platalea.mtl as M
 from platalea.score import score, score_asr, score_slt
 from platalea.experiments.config import get_argument_parser
@@ -17,6 +19,7 @@ args.parse()
 # Setting general configuration
 torch.manual_seed(args.seed)
 random.seed(args.seed)
+platalea.distributed.init_process_group()
 
 # Logging the arguments
 logging.info('Arguments: {}'.format(args))
@@ -74,6 +77,11 @@ config = dict(
         pad_id=fd.get_token_id(fd.pad)),
     inverse_transform_fn=fd.get_label_encoder().inverse_transform,
     margin_size=0.2,
+    hard_negatives=args.hard_negatives,
+    gather_negatives=args.gather_negatives,
+    memory_bank=(dict(size=args.memory_bank_size,
+                      max_age=args.memory_bank_max_age)
+                 if args.memory_bank_size else None),
     lmbd=0.5)
 
 logging.info('Building model')
@@ -82,13 +90,24 @@ run_config = dict(max_norm=2.0, max_lr=args.cyclic_lr_max, min_lr=args.cyclic_lr
                   l2_regularization=args.l2_regularization,
                   loss_logging_interval=args.loss_logging_interval,
                   validation_interval=args.validation_interval,
-                  opt=args.optimizer
+                  opt=args.optimizer,
+                  amp=args.amp,
+                  accumulation_steps=args.accumulation_steps,
+                  gradient_cache=args.gradient_cache,
+                  resume=args.resume,
+                  checkpoint_interval=args.checkpoint_interval,
+                  keep_checkpoints=args.keep_checkpoints,
+                  patience=args.patience,
+                  max_steps=args.max_steps,
+                  max_hours=args.max_hours,
+                  eval_interval=args.eval_interval,
+                  eval_subset=args.eval_subset
                   )
 
 if data['train'].dataset.is_slt():
-    scorer = score_slt
+    scorer = partial(score_slt, workers=args.score_workers)
 else:
-    scorer = score_asr
+    scorer = partial(score_asr, workers=args.score_workers)
 tasks = [dict(name='SI', net=net.SpeechImage, data=data, eval=score),
          dict(name='ASR', net=net.SpeechTranscriber, data=data, eval=scorer)]
 
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 
 import platalea.dataset as D
+import platalea.distributed
 import platalea.mtl as M
 from platalea.score import score, score_speech_text
 from platalea.experiments.config import get_argument_parser
@@ -17,6 +18,7 @@ args.parse()
 # Setting general configuration
 torch.manual_seed(args.seed)
 random.seed(args.seed)
+platalea.distributed.init_process_group()
 
 # Logging the arguments
 logging.info('Arguments: {}'.format(args))
@@ -61,6 +63,11 @@ config = dict(
                  bidirectional=True, dropout=0),
         att=dict(in_size=hidden_size * 2, hidden_size=128)),
     margin_size=0.2,
+    hard_negatives=args.hard_negatives,
+    gather_negatives=args.gather_negatives,
+    memory_bank=(dict(size=args.memory_bank_size,
+                      max_age=args.memory_bank_max_age)
+                 if args.memory_bank_size else None),
     lmbd=0.5)
 
 logging.info('Building model')
@@ -69,7 +76,18 @@ run_config = dict(max_norm=2.0, max_lr=args.cyclic_lr_max, min_lr=args.cyclic_lr
                   l2_regularization=args.l2_regularization,
                   loss_logging_interval=args.loss_logging_interval,
                   validation_interval=args.validation_interval,
-                  opt=args.optimizer
+                  opt=args.optimizer,
+                  amp=args.amp,
+                  accumulation_steps=args.accumulation_steps,
+                  gradient_cache=args.gradient_cache,
+                  resume=args.resume,
+                  checkpoint_interval=args.checkpoint_interval,
+                  keep_checkpoints=args.keep_checkpoints,
+                  patience=args.patience,
+                  max_steps=args.max_steps,
+                  max_hours=args.max_hours,
+                  eval_interval=args.eval_interval,
+                  eval_subset=args.eval_subset
                   )
 
 tasks = [
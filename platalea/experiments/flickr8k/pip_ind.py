@@ -7,10 +7,12 @@ from shutil import copyfile
 import torch
 
 import platalea.asr as M1
+from platalea.checkpoint import load_model
 import platalea.dataset as D
+import platalea.distributed
 import platalea.rank_eval as E
 import platalea.text_image as M2
-from platalea.utils.copy_best import copy_best
+from platalea.utils.files import link_file
 from platalea.utils.extract_transcriptions import extract_trn
 from platalea.experiments.config import get_argument_parser
 
@@ -32,6 +34,7 @@ args.parse()
 # Setting general configuration
 torch.manual_seed(args.seed)
 random.seed(args.seed)
+platalea.distributed.init_process_group()
 
 # Logging the arguments
 logging.info('Arguments: {}'.format(args))
@@ -51,7 +54,10 @@ data = dict(
         shuffle=False))
 
 if args.asr_model_dir:
-    net = torch.load(os.path.join(args.asr_model_dir, 'net.best.pt'))
+    net = load_model(os.path.join(args.asr_model_dir, 'net.best.pt'))
+elif args.resume and os.path.exists('asr.best.pt'):
+    # The ASR/SLT model was trained before the run was interrupted
+    net = load_model('asr.best.pt')
 else:
     logging.info('Building ASR/SLT model')
     config = M1.get_default_config(hidden_size_factor=args.hidden_size_factor)
@@ -60,25 +66,39 @@ else:
                       l2_regularization=args.l2_regularization,
                       loss_logging_interval=args.loss_logging_interval,
                       validation_interval=args.validation_interval,
-                      opt=args.optimizer
+                      opt=args.optimizer,
+                      amp=args.amp,
+                      accumulation_steps=args.accumulation_steps,
+                      score_workers=args.score_workers,
+                      resume=args.resume,
+                      checkpoint='checkpoint_asr.pt',
+                      checkpoint_interval=args.checkpoint_interval,
+                      keep_checkpoints=args.keep_checkpoints,
+                      patience=args.patience,
+                      max_steps=args.max_steps,
+                      max_hours=args.max_hours,
+                      eval_interval=args.eval_interval,
+                      eval_subset=args.eval_subset
                       )
     logging.info('Training ASR/SLT')
-    if data['train'].dataset.is_slt():
-        M1.experiment(net, data, run_config, slt=True)
+    slt = data['train'].dataset.is_slt()
+    M1.experiment(net, data, run_config, slt=slt)
+    if platalea.distributed.is_main_process():
         copyfile('result.json', 'result_asr.json')
-        copy_best('.', 'result_asr.json', 'asr.best.pt', experiment_type='slt')
-    else:
-        M1.experiment(net, data, run_config)
-        copyfile('result.json', 'result_asr.json')
-        copy_best('.', 'result_asr.json', 'asr.best.pt', experiment_type='asr')
-    net = torch.load('asr.best.pt')
+        # The models of the text-image stage replace those of this one
+        link_file('net.best.pt', 'asr.best.pt', symlink=False)
+    # The other processes load the model selected by the main one
+    platalea.distributed.barrier()
+    net = load_model('asr.best.pt')
 
 logging.info('Extracting ASR/SLT transcriptions')
 hyp_asr, _ = extract_trn(net, data['val'].dataset, use_beam_decoding=True)
 
 if args.text_image_model_dir:
-    net = torch.load(os.path.join(args.text_image_model_dir,
+    net = load_model(os.path.join(args.text_image_model_dir,
                                   'net.best.pt'))
+elif args.resume and os.path.exists('ti.best.pt'):
+    net = load_model('ti.best.pt')
 else:
     logging.info('Building model text-image')
     net = M2.TextImage(M2.get_default_config(hidden_size_factor=args.hidden_size_factor))
@@ -86,13 +106,26 @@ else:
                       l2_regularization=args.l2_regularization,
                       loss_logging_interval=args.loss_logging_interval,
                       validation_interval=args.validation_interval,
-                      opt=args.optimizer
+                      opt=args.optimizer,
+                      amp=args.amp,
+                      accumulation_steps=args.accumulation_steps,
+                      gradient_cache=args.gradient_cache,
+                      resume=args.resume,
+                      checkpoint_interval=args.checkpoint_interval,
+                      keep_checkpoints=args.keep_checkpoints,
+                      patience=args.patience,
+                      max_steps=args.max_steps,
+                      max_hours=args.max_hours,
+                      eval_interval=args.eval_interval,
+                      eval_subset=args.eval_subset
                       )
     logging.info('Training text-image')
     M2.experiment(net, data, run_config)
-    copyfile('result.json', 'result_text_image.json')
-    copy_best('.', 'result_text_image.json', 'ti.best.pt')
-    net = torch.load('ti.best.pt')
+    if platalea.distributed.is_main_process():
+        copyfile('result.json', 'result_text_image.json')
+        link_file('net.best.pt', 'ti.best.pt')
+    platalea.distributed.barrier()
+    net = load_model('ti.best.pt')
 
 logging.info('Evaluating text-image with ASR/SLT\'s output')
 data = data['val'].dataset.evaluation()
@@ -104,4 +137,5 @@ res_out = dict(medr=np.median(result['ranks']),
                recall={1: np.mean(result['recall'][1]),
                        5: np.mean(result['recall'][5]),
                        10: np.mean(result['recall'][10])})
-json.dump(res_out, open('result.json', 'w'))
+if platalea.distributed.is_main_process():
+    json.dump(res_out, open('result.json', 'w'))
@@ -4,6 +4,7 @@ import torch
 
 import platalea.text_image as M
 import platalea.dataset as D
+import platalea.distributed
 from platalea.experiments.config import get_argument_parser
 
 
@@ -15,6 +16,7 @@ args.parse()
 # Setting general configuration
 torch.manual_seed(args.seed)
 random.seed(args.seed)
+platalea.distributed.init_process_group()
 
 
 batch_size = 32
@@ -31,12 +33,26 @@ data = dict(
                           split='val', batch_size=batch_size, shuffle=False))
 
 logging.info('Building model')
-net = M.TextImage(M.get_default_config())
+config = M.get_default_config()
+config['hard_negatives'] = args.hard_negatives
+config['gather_negatives'] = args.gather_negatives
+net = M.TextImage(config)
 run_config = dict(max_lr=args.cyclic_lr_max, min_lr=args.cyclic_lr_min, epochs=args.epochs,
                   l2_regularization=args.l2_regularization,
                   loss_logging_interval=args.loss_logging_interval,
                   validation_interval=args.validation_interval,
-                  opt=args.optimizer
+                  opt=args.optimizer,
+                  amp=args.amp,
+                  accumulation_steps=args.accumulation_steps,
+                  gradient_cache=args.gradient_cache,
+                  resume=args.resume,
+                  checkpoint_interval=args.checkpoint_interval,
+                  keep_checkpoints=args.keep_checkpoints,
+                  patience=args.patience,
+                  max_steps=args.max_steps,
+                  max_hours=args.max_hours,
+                  eval_interval=args.eval_interval,
+                  eval_subset=args.eval_subset
                   )
 
 logging.info('Training')
@@ -5,6 +5,7 @@ import torch
 import platalea.basic as M
 import platalea.encoders
 import platalea.dataset as D
+import platalea.distributed
 import platalea.hardware
 from platalea.experiments.config import get_argument_parser
 
@@ -43,6 +44,7 @@ args.parse()
 torch.manual_seed(args.seed)
 random.seed(args.seed)
 platalea.hardware.set_device(args.device)
+platalea.distributed.init_process_group()
 
 # Logging the arguments
 logging.info('Arguments: {}'.format(args))
@@ -82,7 +84,12 @@ image_encoder_out_size = args.trafo_d_model
 
 config = dict(SpeechEncoder=speech_encoder,
               ImageEncoder=dict(linear=dict(in_size=2048, out_size=image_encoder_out_size), norm=True),
-              margin_size=0.2)
+              margin_size=0.2,
+              hard_negatives=args.hard_negatives,
+              gather_negatives=args.gather_negatives,
+              memory_bank=(dict(size=args.memory_bank_size,
+                                max_age=args.memory_bank_max_age)
+                           if args.memory_bank_size else None))
 
 logging.info('Building model')
 net = M.SpeechImage(config)
@@ -92,7 +99,20 @@ run_config = dict(max_lr=args.cyclic_lr_max, min_lr=args.cyclic_lr_min, epochs=a
                   l2_regularization=args.l2_regularization,
                   loss_logging_interval=args.loss_logging_interval,
                   validation_interval=args.validation_interval,
-                  opt=args.optimizer
+                  opt=args.optimizer,
+                  amp=args.amp,
+                  accumulation_steps=args.accumulation_steps,
+                  gradient_cache=args.gradient_cache,
+                  resume=args.resume,
+                  checkpoint_interval=args.checkpoint_interval,
+                  keep_checkpoints=args.keep_checkpoints,
+                  patience=args.patience,
+                  max_steps=args.max_steps,
+                  max_hours=args.max_hours,
+                  eval_interval=args.eval_interval,
+                  eval_subset=args.eval_subset,
+                  metrics=args.metrics,
+                  wandb_watch=args.wandb_watch
                   )
 
 logged_config = dict(run_config=run_config, encoder_config=config, speech_config=speech_config)
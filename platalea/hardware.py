@@ -1,3 +1,5 @@
+import contextlib
+import os
 from typing import Optional
 import torch
 
@@ -20,13 +22,47 @@ def device(ordinal: Optional[int] = None):
     It is also possible to use set_device to set a custom device string. If set,
     i.e. if not None (the default value), this value is used.
 
+    When running distributed, each process defaults to the GPU given by the
+    LOCAL_RANK environment variable set by the launcher.
+
     This function can only be used by models that run on a single device.
     """
     global _device
     if _device is not None:
         return torch.device(_device)
 
+    if ordinal is None and 'LOCAL_RANK' in os.environ:
+        ordinal = int(os.environ['LOCAL_RANK'])
     ordinal_str = ''
     if ordinal is not None:
         ordinal_str = f':{ordinal}'
     return torch.device("cuda" + ordinal_str if torch.cuda.is_available() else "cpu")
+
+
+_precision_dtypes = {'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(precision: Optional[str] = None):
+    """Return an autocast context manager for the given precision.
+
+    `precision` can be 'fp16' or 'bf16' to run the enclosed forward pass in
+    mixed precision on the current device, or None for plain fp32, in which
+    case the context is a no-op.
+    """
+    if precision is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device().type,
+                          dtype=_precision_dtypes[precision])
+
+
+def grad_scaler(precision: Optional[str] = None):
+    """Return a gradient scaler for the given precision.
+
+    Loss scaling is only needed for fp16 on GPU, bf16 having the same range as
+    fp32. In all other cases the returned scaler is disabled, and its scale,
+    unscale_, step and update methods fall back to plain backward and
+    optimizer steps.
+    """
+    _device = device()
+    enabled = precision == 'fp16' and _device.type == 'cuda'
+    return torch.amp.GradScaler(_device.type, enabled=enabled)
@@ -0,0 +1,222 @@
+"""
+Nearest neighbour indices of embeddings
+
+Indices of the image embeddings of a retrieval model, searched with the
+embeddings of spoken (or written) captions. Embeddings are normalized, so
+neighbours are ranked by cosine similarity, as in rank_eval.ranking.
+
+- FlatIndex searches exhaustively, giving the exact ranking.
+- IVFIndex (inverted file) partitions the embeddings with spherical k-means
+  and only searches the `nprobe` partitions whose centroids are the closest
+  to each query (or more, if they hold less than k embeddings). It is
+  implemented with NumPy.
+- FaissIndex is the IVF-flat index of faiss, if it is installed.
+
+Indices are saved to and loaded from a single file, and can hold an array of
+identifiers (e.g. image file names) returned instead of positions.
+"""
+
+
+import numpy as np
+
+
+def _normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _top_k(scores, k):
+    """Returns the positions of the `k` highest scores of each row, in
+    decreasing order of score."""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1)
+
+
+class Index():
+    """Base class of the indices. `search` returns the similarities and the
+    identifiers of the `k` nearest neighbours of each query, in batches of
+    `batch_size` queries."""
+    kind = None
+
+    def __init__(self):
+        self.vectors = None
+        self.ids = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    def build(self, vectors, ids=None):
+        self.vectors = _normalize(vectors)
+        self.ids = None if ids is None else np.asarray(ids)
+        return self
+
+    def _search(self, queries, k):
+        raise NotImplementedError
+
+    def search(self, queries, k=10, batch_size=1024):
+        queries = _normalize(queries)
+        scores, positions = [], []
+        for start in range(0, len(queries), batch_size):
+            s, p = self._search(queries[start:start + batch_size], k)
+            scores.append(s)
+            positions.append(p)
+        scores = np.concatenate(scores)
+        positions = np.concatenate(positions)
+        if self.ids is None:
+            return scores, positions
+        return scores, self.ids[positions]
+
+    def _arrays(self):
+        return dict(vectors=self.vectors)
+
+    def save(self, path):
+        arrays = self._arrays()
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        with open(path, 'wb') as f:
+            np.savez(f, kind=self.kind, **arrays)
+
+    def _load(self, arrays):
+        self.vectors = arrays['vectors']
+
+
+class FlatIndex(Index):
+    """Exact search."""
+    kind = 'flat'
+
+    def _search(self, queries, k):
+        scores = queries @ self.vectors.T
+        positions = _top_k(scores, k)
+        return np.take_along_axis(scores, positions, axis=1), positions
+
+
+def kmeans(x, clusters, iterations=20, seed=123):
+    """Spherical k-means: returns `clusters` normalized centroids of the
+    normalized vectors `x`, and the cluster of each vector."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = (x @ centroids.T).argmax(axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        counts = np.bincount(assignment, minlength=clusters)
+        # Empty clusters are moved to random vectors
+        empty = counts == 0
+        sums[empty] = x[rng.choice(len(x), empty.sum())]
+        centroids = _normalize(sums)
+    return centroids, (x @ centroids.T).argmax(axis=1)
+
+
+class IVFIndex(Index):
+    """Inverted file index: vectors are stored by partition, and queries are
+    compared with the vectors of the `nprobe` partitions whose centroids are
+    the most similar to them. By default, there are 4 sqrt(n) partitions for
+    n vectors."""
+    kind = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, iterations=20, seed=123):
+        super(IVFIndex, self).__init__()
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.positions = None
+        self.offsets = None
+
+    def build(self, vectors, ids=None):
+        super(IVFIndex, self).build(vectors, ids)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(self.vectors))))
+        nlist = min(nlist, len(self.vectors))
+        self.centroids, assignment = kmeans(self.vectors, nlist, self.iterations, self.seed)
+        # Vectors sorted by partition, partition i spanning
+        # offsets[i]:offsets[i+1]
+        self.positions = np.argsort(assignment, kind='stable')
+        self.vectors = self.vectors[self.positions]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))])
+        return self
+
+    def _search(self, queries, k):
+        k = min(k, len(self.vectors))
+        sizes = np.diff(self.offsets)
+        ranked = np.argsort(-(queries @ self.centroids.T), axis=1, kind='stable')
+        scores = np.empty((len(queries), k), dtype=np.float32)
+        positions = np.empty((len(queries), k), dtype=np.int64)
+        for i, (query, lists) in enumerate(zip(queries, ranked)):
+            # More partitions are probed if needed to find k neighbours
+            nprobe = max(self.nprobe, np.searchsorted(np.cumsum(sizes[lists]), k) + 1)
+            candidates = np.concatenate([np.arange(self.offsets[j], self.offsets[j + 1])
+                                         for j in lists[:nprobe]])
+            s = self.vectors[candidates] @ query
+            top = _top_k(s[None], k)[0]
+            scores[i] = s[top]
+            positions[i] = self.positions[candidates[top]]
+        return scores, positions
+
+    def _arrays(self):
+        return dict(vectors=self.vectors, centroids=self.centroids,
+                    positions=self.positions, offsets=self.offsets,
+                    nprobe=self.nprobe)
+
+    def _load(self, arrays):
+        self.vectors = arrays['vectors']
+        self.centroids = arrays['centroids']
+        self.positions = arrays['positions']
+        self.offsets = arrays['offsets']
+        self.nprobe = int(arrays['nprobe'])
+        self.nlist = len(self.centroids)
+
+
+class FaissIndex(Index):
+    """IVF-flat index of faiss, on inner products of normalized vectors."""
+    kind = 'faiss'
+
+    def __init__(self, nlist=None, nprobe=8):
+        super(FaissIndex, self).__init__()
+        import faiss
+        self.faiss = faiss
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index = None
+
+    def build(self, vectors, ids=None):
+        super(FaissIndex, self).build(vectors, ids)
+        nlist = self.nlist or max(1, int(4 * np.sqrt(len(self.vectors))))
+        nlist = min(nlist, len(self.vectors))
+        quantizer = self.faiss.IndexFlatIP(self.vectors.shape[1])
+        self.index = self.faiss.IndexIVFFlat(quantizer, self.vectors.shape[1], nlist,
+                                             self.faiss.METRIC_INNER_PRODUCT)
+        self.index.train(self.vectors)
+        self.index.add(self.vectors)
+        return self
+
+    def _search(self, queries, k):
+        self.index.nprobe = self.nprobe
+        k = min(k, self.index.ntotal)
+        return self.index.search(np.ascontiguousarray(queries), k)
+
+    def _arrays(self):
+        return dict(vectors=self.vectors, nprobe=self.nprobe,
+                    index=self.faiss.serialize_index(self.index))
+
+    def _load(self, arrays):
+        self.vectors = arrays['vectors']
+        self.nprobe = int(arrays['nprobe'])
+        self.index = self.faiss.deserialize_index(arrays['index'])
+
+
+INDICES = dict(flat=FlatIndex, ivf=IVFIndex, faiss=FaissIndex)
+
+
+def create_index(kind='ivf', **kwargs):
+    return INDICES[kind](**kwargs)
+
+
+def load_index(path):
+    with np.load(path) as arrays:
+        index = INDICES[str(arrays['kind'])]()
+        index._load(arrays)
+        index.ids = arrays['ids'] if 'ids' in arrays else None
+    return index
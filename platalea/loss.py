@@ -1,14 +1,63 @@
 import torch
 
 
-def contrastive(M, margin=0.2):
-    "Returns contrastive margin loss over similarity matrix M."
+def contrastive(M, margin=0.2, negatives_r=None, negatives_c=None,
+                hard_negatives=None):
+    """Returns contrastive margin loss over similarity matrix M.
+
+    Optionally, `negatives_r` holds the similarities of the rows of M with
+    additional negative columns, and `negatives_c` those of additional
+    negative rows with the columns of M, e.g. from a MemoryBank.
+
+    By default, the loss sums the margin violations of all negatives. With
+    `hard_negatives` set to k, it averages those of the k hardest negatives
+    of each row and each column only, k=1 giving the max violation loss of
+    VSE++ (Faghri et al., 2018 [https://arxiv.org/abs/1707.05612]).
+    """
+    if hard_negatives:
+        D = torch.diag(M).view(-1, 1)
+        if negatives_c is not None:
+            negatives_c = negatives_c.t()
+        loss = 0
+        for S, N in ((M, negatives_r), (M.t(), negatives_c)):
+            hardest = _hardest_negatives(S, hard_negatives, N)
+            C = torch.clamp(margin + hardest - D, min=0)
+            loss = loss + C.sum() / torch.isfinite(hardest).sum().clamp(min=1)
+        return loss
     E = - M
     D = torch.diag(E)
     C_c = torch.clamp(margin - E + D, min=0)
     C_r = torch.clamp(margin - E + D.view(-1, 1), min=0)
-    C = C_c + C_r
-    return (C.sum() - torch.diag(C).sum())/C.size(0)**2
+    if negatives_r is None and negatives_c is None:
+        C = C_c + C_r
+        return (C.sum() - torch.diag(C).sum())/C.size(0)**2
+    B = M.size(0)
+    if negatives_r is None:
+        negatives_r = M.new_zeros(B, 0)
+    if negatives_c is None:
+        negatives_c = M.new_zeros(0, B)
+    C_r = C_r.sum() - torch.diag(C_r).sum() + \
+        torch.clamp(margin + negatives_r + D.view(-1, 1), min=0).sum()
+    C_c = C_c.sum() - torch.diag(C_c).sum() + \
+        torch.clamp(margin + negatives_c + D, min=0).sum()
+    return C_r / (B * (B + negatives_r.size(1))) + \
+        C_c / (B * (B + negatives_c.size(0)))
+
+
+def _hardest_negatives(M, k, negatives=None):
+    """Returns the k highest similarities of each row of M with its negatives,
+    i.e. the entries of the row outside of the diagonal and the corresponding
+    row of `negatives`, padded with -inf if there are less than k."""
+    B = M.size(0)
+    # Only k + 1 entries per row are selected, the positive pair on the
+    # diagonal being dropped if it is among them
+    values, index = M.topk(min(k + 1, B), dim=1)
+    negative = index != torch.arange(B, device=M.device).view(-1, 1)
+    values = values.masked_fill(~negative | (negative.cumsum(1) > k), float('-inf'))
+    if negatives is not None and negatives.size(1) > 0:
+        values = torch.cat([values, negatives.topk(min(k, negatives.size(1)), dim=1)[0]], dim=1)
+        values = values.topk(min(k, values.size(1)), dim=1)[0]
+    return values
 
 
 def cosine_matrix(U, V):
@@ -16,3 +65,141 @@ def cosine_matrix(U, V):
     U_norm = U / U.norm(2, dim=1, keepdim=True)
     V_norm = V / V.norm(2, dim=1, keepdim=True)
     return torch.matmul(U_norm, V_norm.t())
+
+
+class _CosineContrastive(torch.autograd.Function):
+    """Contrastive margin loss over the cosine similarities of U and V.
+
+    No normalized copies of U and V are made, the norms being applied to the
+    similarity matrix instead, and the loss and its gradient with respect to
+    the similarities are computed in two BxB buffers.
+    """
+    @staticmethod
+    def forward(ctx, U, V, margin):
+        dtype = U.dtype
+        with torch.autocast(device_type=U.device.type, enabled=False):
+            # Half precision inputs from autocast are computed in fp32
+            U = U.to(torch.promote_types(dtype, torch.float32))
+            V = V.to(U.dtype)
+            U_norm = U.norm(2, dim=1, keepdim=True)
+            V_norm = V.norm(2, dim=1, keepdim=True)
+            M = torch.matmul(U, V.t()).div_(U_norm).div_(V_norm.t())
+            B = M.size(0)
+            D = torch.diag(M)
+            # Violations with the rows as queries, then the columns, reusing
+            # their buffers for the indicators of positive violations
+            C_r = M.sub(D.view(-1, 1)).add_(margin).clamp_(min=0).fill_diagonal_(0)
+            C_c = M.sub_(D).add_(margin).clamp_(min=0).fill_diagonal_(0)
+            loss = (C_r.sum() + C_c.sum()) / B**2
+            C_r.gt_(0)
+            C_c.gt_(0)
+            violations = C_r.sum(1) + C_c.sum(0)
+            # Gradient of the loss with respect to the similarities
+            G = C_r.add_(C_c)
+            G.diagonal().copy_(-violations)
+            G /= B**2
+        ctx.save_for_backward(U, V, U_norm, V_norm, G)
+        ctx.dtype = dtype
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad):
+        U, V, U_norm, V_norm, G = ctx.saved_tensors
+        G = G * grad.to(G.dtype)
+        grad_U = _normalized_grad(torch.matmul(G.div(V_norm.t()), V), U, U_norm)
+        grad_V = _normalized_grad(torch.matmul(G.div_(U_norm).t(), U), V, V_norm)
+        return grad_U.to(ctx.dtype), grad_V.to(ctx.dtype), None
+
+
+def _normalized_grad(grad, X, X_norm):
+    """Backpropagates `grad` with respect to X / X_norm to X, in place."""
+    dot = torch.matmul(grad.unsqueeze(1), X.unsqueeze(2)).view(-1, 1)
+    return grad.addcmul_(X, dot / X_norm**2, value=-1).div_(X_norm)
+
+
+def cosine_contrastive(U, V, margin=0.2, hard_negatives=None):
+    """Returns the contrastive margin loss over the cosine similarities
+    between the rows of U and V, i.e.
+    `contrastive(cosine_matrix(U, V), margin, hard_negatives=hard_negatives)`.
+
+    The default loss over all negatives is computed by a fused
+    implementation, saving most of the intermediate BxB matrices.
+    """
+    if hard_negatives:
+        return contrastive(cosine_matrix(U, V), margin=margin,
+                           hard_negatives=hard_negatives)
+    return _CosineContrastive.apply(U, V, margin)
+
+
+def contrastive_with_memory(U, V, memory_bank, margin=0.2, hard_negatives=None):
+    """Returns the contrastive margin loss between the rows of U and V, using
+    the embeddings stored in `memory_bank` as additional negatives, and then
+    adds U and V to the memory bank."""
+    scores = cosine_matrix(U, V)
+    memory = memory_bank.get()
+    if memory is None:
+        loss = contrastive(scores, margin=margin, hard_negatives=hard_negatives)
+    else:
+        U_memory, V_memory = memory
+        loss = contrastive(scores, margin=margin,
+                           negatives_r=cosine_matrix(U, V_memory),
+                           negatives_c=cosine_matrix(U_memory, V),
+                           hard_negatives=hard_negatives)
+    memory_bank.push(U, V)
+    return loss
+
+
+class MemoryBank():
+    """FIFO queue of the embeddings of the last `size` training examples, used
+    as additional negatives in contrastive losses.
+
+    Several aligned embeddings (e.g. speech and image) are stored per example.
+    The stored embeddings are detached, so they were computed by past versions
+    of the model. Those pushed more than `max_age` batches ago are not returned
+    anymore.
+
+    The queue is emptied when the model holding it is saved.
+    """
+    def __init__(self, size, max_age=None):
+        self.size = size
+        self.max_age = max_age
+        self._reset()
+
+    def _reset(self):
+        self.queues = None
+        self.steps = None
+        self.position = 0
+        self.step = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(queues=None, steps=None, position=0, step=0)
+        return state
+
+    def push(self, *embeddings):
+        """Adds a batch of embeddings, replacing the oldest ones."""
+        embeddings = [e.detach().float()[-self.size:] for e in embeddings]
+        if self.queues is None:
+            self.queues = [e.new_zeros(self.size, e.size(1)) for e in embeddings]
+            self.steps = torch.full((self.size,), -1, dtype=torch.long,
+                                    device=embeddings[0].device)
+        n = embeddings[0].size(0)
+        index = (self.position + torch.arange(n, device=self.steps.device)) % self.size
+        for queue, e in zip(self.queues, embeddings):
+            queue[index] = e
+        self.steps[index] = self.step
+        self.position = (self.position + n) % self.size
+        self.step += 1
+
+    def get(self):
+        """Returns the stored embeddings which are recent enough, or None if
+        there are none."""
+        if self.queues is None:
+            return None
+        valid = self.steps >= 0
+        if self.max_age is not None:
+            valid &= self.step - self.steps <= self.max_age
+        index = valid.nonzero().view(-1)
+        if index.numel() == 0:
+            return None
+        return [queue[index] for queue in self.queues]
@@ -0,0 +1,190 @@
+import csv
+import importlib.util
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import platalea.distributed
+
+
+def _flatten(metrics, prefix=''):
+    for k, v in metrics.items():
+        if isinstance(v, dict):
+            yield from _flatten(v, '{}{}/'.format(prefix, k))
+        else:
+            yield '{}{}'.format(prefix, k), v
+
+
+class MetricsSink():
+    """Destination of the metrics logged during training. Sinks receive
+    batches of records, as (step, metrics) pairs, from the background thread
+    of a MetricsLogger."""
+    def write(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JSONLSink(MetricsSink):
+    """Appends each record to a file as a line of JSON."""
+    def __init__(self, path='metrics.jsonl'):
+        self.path = path
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for step, metrics in records:
+                if step is not None:
+                    # The step of the logger replaces any step of the record
+                    metrics = {**metrics, 'step': step}
+                print(json.dumps(metrics, default=float), file=f)
+
+
+class CSVSink(MetricsSink):
+    """Appends each metric to a CSV file as a (step, name, value) row, nested
+    metrics being named after their path, e.g. recall/10."""
+    def __init__(self, path='metrics.csv'):
+        self.path = path
+
+    def write(self, records):
+        new = not os.path.exists(self.path)
+        with open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(['step', 'name', 'value'])
+            for step, metrics in records:
+                for name, value in _flatten(metrics):
+                    writer.writerow([step, name, float(value)])
+
+
+class WandbSink(MetricsSink):
+    """Logs to Weights and Biases, which is only imported when this sink is
+    used. With `watch` ('gradients', 'parameters' or 'all'), histograms of the
+    gradients and/or parameters of `net` are logged every `watch_freq` steps,
+    at the cost of hooks run at each step."""
+    def __init__(self, config=None, project='platalea', entity='spokenlanguage',
+                 net=None, watch=None, watch_freq=1000):
+        import wandb
+        self.wandb = wandb
+        logging.info("Run 'wandb disabled' if you don't want to use wandb cloud logging.")
+        wandb.init(project=project, entity=entity, config=config)
+        if watch is not None:
+            wandb.watch(net, log=watch, log_freq=watch_freq)
+
+    def write(self, records):
+        for step, metrics in records:
+            self.wandb.log(metrics, step=step)
+
+    def close(self):
+        self.wandb.finish()
+
+
+class MetricsLogger():
+    """Logs metrics to sinks from a background thread.
+
+    Logged metrics are buffered, and passed on to the sinks every
+    `buffer_size` records or when flushed, so logging them only costs
+    appending them to a list. The time spent in `log` is recorded in
+    `overhead`.
+    """
+    def __init__(self, sinks=(), buffer_size=100):
+        self.sinks = list(sinks)
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+        self.calls = 0
+        self.overhead = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        while True:
+            records = self.queue.get()
+            try:
+                if records is None:
+                    return
+                if self.error is None:
+                    for sink in self.sinks:
+                        sink.write(records)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Logging metrics failed') from error
+
+    def log(self, metrics, step=None):
+        """Logs a dictionary of metrics, possibly nested, at a given step."""
+        if not self.sinks:
+            return
+        start = time.perf_counter()
+        self.buffer.append((step, dict(metrics)))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        self.calls += 1
+        self.overhead += time.perf_counter() - start
+
+    def flush(self):
+        """Passes the buffered metrics on to the sinks in the background."""
+        self._check()
+        if not self.buffer:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put(self.buffer)
+        self.buffer = []
+
+    def wait(self):
+        """Waits until all flushed metrics are written."""
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.flush()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        for sink in self.sinks:
+            sink.close()
+        if self.calls:
+            logging.info("Metrics logging took {:.1f}us per step".format(
+                self.overhead / self.calls * 1e6))
+        self._check()
+
+
+def create_logger(config, net=None, wandb_config=None, wandb_project='platalea',
+                  wandb_entity='spokenlanguage'):
+    """Creates a MetricsLogger with the sinks listed in config['metrics']
+    ('jsonl', 'csv' and/or 'wandb'). Only the main process logs metrics."""
+    if not platalea.distributed.is_main_process():
+        return MetricsLogger()
+    sinks = []
+    for name in config.get('metrics', ['jsonl']):
+        if name == 'jsonl':
+            sinks.append(JSONLSink())
+        elif name == 'csv':
+            sinks.append(CSVSink())
+        elif name == 'wandb':
+            if importlib.util.find_spec('wandb') is None:
+                logging.warning('wandb is not installed, metrics are not logged to it')
+                continue
+            sinks.append(WandbSink(wandb_config or config, wandb_project,
+                                   wandb_entity, net, config.get('wandb_watch'),
+                                   config.get('loss_logging_interval', 1000)))
+        else:
+            raise ValueError('Unknown metrics sink: {}'.format(name))
+    return MetricsLogger(sinks)
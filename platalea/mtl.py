@@ -5,10 +5,15 @@ import torch
 import torch.nn as nn
 
 import platalea.schedulers
+from platalea.accumulation import accumulate_gradients
+from platalea.checkpoint import CheckpointWriter, TrainingState
+from platalea.controller import TrainingController
+from platalea.utils.files import model_fname
 from platalea.encoders import SpeechEncoderBottom, SpeechEncoderSplit
 from platalea.basic import SpeechImage
 from platalea.speech_text import SpeechText
 from platalea.asr import SpeechTranscriber
+import platalea.distributed
 import platalea.loss
 import platalea.score
 import platalea.hardware
@@ -30,7 +35,10 @@ class MTLNetASR(nn.Module):
         self.SpeechImage = SpeechImage(dict(
             SpeechEncoder=SpeechEncoderSplitSI,
             ImageEncoder=config['ImageEncoder'],
-            margin_size=config['margin_size']))
+            margin_size=config['margin_size'],
+            hard_negatives=config.get('hard_negatives'),
+            gather_negatives=config.get('gather_negatives', False),
+            memory_bank=config.get('memory_bank')))
         self.SpeechTranscriber = SpeechTranscriber(dict(
             SpeechEncoder=SpeechEncoderSplitASR,
             TextDecoder=config['TextDecoder'],
@@ -58,11 +66,16 @@ class MTLNetSpeechText(nn.Module):
         self.SpeechImage = SpeechImage(dict(
             SpeechEncoder=SpeechEncoderSplitSI,
             ImageEncoder=config['ImageEncoder'],
-            margin_size=config['margin_size']))
+            margin_size=config['margin_size'],
+            hard_negatives=config.get('hard_negatives'),
+            gather_negatives=config.get('gather_negatives', False),
+            memory_bank=config.get('memory_bank')))
         self.SpeechText = SpeechText(dict(
             SpeechEncoder=SpeechEncoderSplitST,
             TextEncoder=config['TextEncoder'],
-            margin_size=config['margin_size']))
+            margin_size=config['margin_size'],
+            hard_negatives=config.get('hard_negatives'),
+            gather_negatives=config.get('gather_negatives', False)))
         self.lmbd = config.get('lmbd', 0.5)
 
     def cost(self, item):
@@ -73,29 +86,40 @@ class MTLNetSpeechText(nn.Module):
                       'speech-image': loss_si.item()}
 
 
-def val_loss(net, data):
+def val_loss(net, data, amp=None):
     _device = platalea.hardware.device()
     with torch.no_grad():
         net.eval()
         result = []
         for item in data['val']:
             item = {key: value.to(_device) for key, value in item.items()}
-            result.append(net.cost(item).item())
+            with platalea.hardware.autocast(amp):
+                result.append(net.cost(item).item())
         net.train()
     return torch.tensor(result).mean()
 
 
-def task_iterator(tasks):
+def task_iterator(tasks, accumulation_steps=1):
     # returns a list of batches for each task to train this step
     # allows to train a task only every n step
+    # with gradient accumulation, the batches of accumulation_steps
+    # consecutive steps are grouped and trained as micro-batches of one step
     iterators = [t['data']['train'].__iter__() for t in tasks]
     step = 1
-    try:
-        while True:
-            yield [(t, next(it)) for t, it in zip(tasks, iterators) if 'step' not in t or step % t['step'] == 0]
-            step += 1
-    except StopIteration:
-        return
+    while True:
+        batches = [[] for t in tasks]
+        try:
+            for _ in range(accumulation_steps):
+                step_batches = [(i, next(it)) for i, (t, it) in enumerate(zip(tasks, iterators))
+                                if 'step' not in t or step % t['step'] == 0]
+                for i, item in step_batches:
+                    batches[i].append(item)
+                step += 1
+        except StopIteration:
+            if any(batches):
+                yield [(t, b) for t, b in zip(tasks, batches) if b]
+            return
+        yield [(t, b) for t, b in zip(tasks, batches) if b]
 
 
 def experiment(net, tasks, config):
@@ -106,23 +130,75 @@ def experiment(net, tasks, config):
         t['net'].train()
         t['optimizer'] = create_optimizer(config, t['net'].parameters())
         t['scheduler'] = create_scheduler(config, t['optimizer'], t['data'])
+        t['scaler'] = platalea.hardware.grad_scaler(config.get('amp'))
+    platalea.distributed.broadcast_parameters(net)
+    stateful = dict(net=net)
+    for t in tasks:
+        for k in ['optimizer', 'scheduler', 'scaler']:
+            stateful['{}_{}'.format(k, t['name'])] = t[k]
+    writer = CheckpointWriter(keep_last=config.get('keep_checkpoints'),
+                              best_path='net.best.pt')
+    controller = TrainingController.from_config(config, 'mtl')
+    state = TrainingState(config.get('checkpoint'), writer, controller=controller,
+                          **stateful)
+    if config.get('resume'):
+        state.load()
 
-    results = []
-    with open("result.json", "w") as out:
-        for epoch in range(1, config['epochs']+1):
+    def evaluate(out, epoch, step=None):
+        result = {}
+        with torch.no_grad():
+            net.eval()
             for t in tasks:
-                t['cost'] = Counter()
-            for j, items in enumerate(task_iterator(tasks), start=1):
-                for t, item in items:
-                    item = {k: v.to(_device) for k, v in item.items()}
-                    loss = t['net'].cost(item)
-                    t['optimizer'].zero_grad()
-                    loss.backward()
+                result[t['name']] = t['eval'](
+                    t['net'], controller.validation(t['data']['val'].dataset))
+            net.train()
+        for t in tasks:
+            cost = state.costs[t['name']]
+            result[t['name']].update({'average_loss': cost['cost'] / cost['N']})
+        result['epoch'] = epoch
+        if step is not None:
+            result['step'] = step
+        json.dump(result, out)
+        print('', file=out, flush=True)
+        state.add_result(result, out)
+        # Saving model
+        if platalea.distributed.is_main_process():
+            logging.info("Saving model in {}".format(model_fname(epoch, step)))
+            writer.save(net, model_fname(epoch, step), score=controller.score(result))
+        controller.evaluated(result)
+
+    results = state.results
+    with writer, state.open_results("result.json") as out:
+        for epoch in range(state.epoch, config['epochs']+1):
+            reason = controller.stop_reason()
+            if reason is not None:
+                logging.info("Stopping training: {}".format(reason))
+                break
+            for t in tasks:
+                platalea.distributed.set_epoch(t['data']['train'], epoch)
+            train_steps = task_iterator(tasks,
+                                        config.get('accumulation_steps', 1))
+            train_steps = state.epoch_steps(epoch, train_steps)
+            for t in tasks:
+                t['cost'] = state.costs[t['name']]
+            for j, task_items in enumerate(train_steps, start=state.step + 1):
+                for t, items in task_items:
+                    items = [{k: v.to(_device) for k, v in item.items()}
+                             for item in items]
+                    loss_value = accumulate_gradients(
+                        t['net'], items, t['scaler'], amp=config.get('amp'),
+                        gradient_cache=config.get('gradient_cache', False))
+                    platalea.distributed.average_gradients(t['net'])
+                    # Gradients have to be unscaled for clipping to see their
+                    # actual norm
+                    t['scaler'].unscale_(t['optimizer'])
                     nn.utils.clip_grad_norm_(t['net'].parameters(),
                                              config['max_norm'])
-                    t['optimizer'].step()
+                    t['scaler'].step(t['optimizer'])
+                    t['scaler'].update()
+                    t['optimizer'].zero_grad()
                     t['scheduler'].step()
-                    t['cost'] += Counter({'cost': loss.item(), 'N': 1})
+                    t['cost'] += Counter({'cost': loss_value, 'N': 1})
                     t['average_loss'] = t['cost']['cost'] / t['cost']['N']
                     if j % config['loss_logging_interval'] == 0:
                         logging.info("train {} {} {} {}".format(
@@ -130,23 +206,19 @@ def experiment(net, tasks, config):
                     if j % config['validation_interval'] == 0:
                         logging.info("valid {} {} {} {}".format(
                             t['name'], epoch, j,
-                            val_loss(t['net'], t['data'])))
+                            val_loss(t['net'], t['data'],
+                                     config.get('amp'))))
+                controller.step()
+                state.end_step(j, config.get('checkpoint_interval'))
+                if controller.evaluation_due():
+                    evaluate(out, epoch, j)
+                    state.save()
+                if controller.stop_reason() is not None:
+                    break
             # Evaluation
-            result = {}
-            with torch.no_grad():
-                net.eval()
-                for t in tasks:
-                    result[t['name']] = t['eval'](t['net'],
-                                                  t['data']['val'].dataset)
-                net.train()
-            for t in tasks:
-                result[t['name']].update({'average_loss': t['average_loss']})
-            result['epoch'] = epoch
-            results.append(result)
-            json.dump(result, out)
-            print('', file=out, flush=True)
-            # Saving model
-            logging.info("Saving model in net.{}.pt".format(epoch))
-            torch.save(net, "net.{}.pt".format(epoch))
+            if controller.evaluation_due(end_of_epoch=True,
+                                         end_of_training=epoch == config['epochs']):
+                evaluate(out, epoch)
+            state.end_epoch()
 
     return results
@@ -1,10 +1,10 @@
 # encoding: utf-8
 # Copyright (c) 2015 Grzegorz Chrupała
 import numpy
-from scipy.spatial.distance import cdist
 
 
 def cosine(x, y):
+    from scipy.spatial.distance import cdist
     return cdist(x, y, metric='cosine')
 
 
@@ -13,6 +13,7 @@ def ranking(candidates, references, correct, metric=cosine, ns=(1, 5, 10)):
 
     `correct[i][j]` indicates whether for reference item i the candidate j is correct.
     """
+    from scipy.spatial.distance import cdist
     distances = cdist(references, candidates)
     result = {'ranks': [], 'recall': {}}
     for n in ns:
@@ -1,4 +1,5 @@
 import logging
+import math
 import numpy as np
 from torch.optim import lr_scheduler
 
@@ -65,7 +66,9 @@ def create_scheduler(config, optimizer, data):
     configured_scheduler = config.get('lr_scheduler')
 
     if configured_scheduler is None or configured_scheduler == 'cyclic':
-        scheduler = cyclic(optimizer, len(data['train']), max_lr=config['max_lr'],
+        # With gradient accumulation, the scheduler is stepped once every accumulation_steps batches
+        n_steps = math.ceil(len(data['train']) / config.get('accumulation_steps', 1))
+        scheduler = cyclic(optimizer, n_steps, max_lr=config['max_lr'],
                            min_lr=config['min_lr'])
     elif configured_scheduler == 'noam':
         scheduler = noam(optimizer, config['d_model'])
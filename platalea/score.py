@@ -1,14 +1,29 @@
+from collections import Counter
+import functools
+import math
 import numpy as np
+import platalea.distributed
 import platalea.rank_eval as E
 import platalea.xer as xer
+import sys
 import torch
 
 
+def _embed(fn, items):
+    """Applies `fn` to `items`. When running distributed, each process
+    applies it to its own part of `items` and the results are gathered."""
+    if not platalea.distributed.is_initialized():
+        return fn(items)
+    local = platalea.distributed.shard(items)
+    parts = platalea.distributed.all_gather(fn(local) if len(local) > 0 else None)
+    return np.concatenate([p for p in parts if p is not None])
+
+
 def score(net, dataset):
     data = dataset.evaluation()
     correct = data['correct'].cpu().numpy()
-    image_e = net.embed_image(data['image'])
-    audio_e = net.embed_audio(data['audio'])
+    image_e = _embed(net.embed_image, data['image'])
+    audio_e = _embed(net.embed_audio, data['audio'])
     result = E.ranking(image_e, audio_e, correct)
     return dict(medr=np.median(result['ranks']),
                 recall={1: np.mean(result['recall'][1]),
@@ -19,8 +34,8 @@ def score(net, dataset):
 def score_text_image(net, dataset):
     data = dataset.evaluation()
     correct = data['correct'].cpu().numpy()
-    image_e = net.embed_image(data['image'])
-    text_e = net.embed_text(data['text'])
+    image_e = _embed(net.embed_image, data['image'])
+    text_e = _embed(net.embed_text, data['text'])
     result = E.ranking(image_e, text_e, correct)
     return dict(medr=np.median(result['ranks']),
                 recall={1: np.mean(result['recall'][1]),
@@ -30,8 +45,8 @@ def score_text_image(net, dataset):
 
 def score_speech_text(net, dataset):
     data = dataset.evaluation()
-    audio_e = net.embed_audio(data['audio'])
-    text_e = net.embed_text(data['text'])
+    audio_e = _embed(net.embed_audio, data['audio'])
+    text_e = _embed(net.embed_text, data['text'])
     correct = torch.eye(len(data['audio'])).type(torch.bool)
     result = E.ranking(audio_e, text_e, correct)
     return dict(medr=np.median(result['ranks']),
@@ -40,28 +55,63 @@ def score_speech_text(net, dataset):
                         10: np.mean(result['recall'][10])})
 
 
-def score_asr(net, dataset, beam_size=None):
+def score_asr(net, dataset, beam_size=None, workers=1):
     data = dataset.evaluation()
-    trn = net.transcribe(data['audio'], beam_size=beam_size)
+    trn = _embed(functools.partial(net.transcribe, beam_size=beam_size),
+                 data['audio'])
     ref = data['text']
-    cer = xer.cer(trn, ref)
-    wer = xer.wer(trn, ref)
+    cer = xer.cer(trn, ref, workers=workers)
+    wer = xer.wer(trn, ref, workers=workers)
     return dict(wer=wer, cer=cer)
 
 
+@functools.lru_cache(maxsize=2**16)
+def _ngram_counts(tokens, max_n=4):
+    """Returns the n-gram counts of `tokens` for each order up to `max_n`.
+    Cached as the references are the same at every evaluation."""
+    return tuple(Counter(tokens[i:i + n] for i in range(len(tokens) - n + 1))
+                 for n in range(1, max_n + 1))
+
+
+def _sentence_bleu(reference, hypothesis, max_n=4):
+    """Computes the same value as nltk's `sentence_bleu([reference],
+    hypothesis)` with uniform weights and no smoothing."""
+    reference = tuple(reference)
+    hypothesis = tuple(hypothesis)
+    ref_counts = _ngram_counts(reference, max_n)
+    hyp_counts = _ngram_counts(hypothesis, max_n)
+    log_p = []
+    for n in range(max_n):
+        numerator = sum(min(c, ref_counts[n][g]) for g, c in hyp_counts[n].items())
+        if n == 0 and numerator == 0:
+            return 0
+        denominator = max(1, sum(hyp_counts[n].values()))
+        # Same flooring of null precisions as nltk's SmoothingFunction.method0
+        p = numerator / denominator if numerator != 0 else sys.float_info.min
+        log_p.append(math.log(p) / max_n)
+    r, c = len(reference), len(hypothesis)
+    if c > r:
+        bp = 1
+    elif c == 0:
+        bp = 0
+    else:
+        bp = math.exp(1 - r / c)
+    return bp * math.exp(math.fsum(log_p))
+
+
 def bleu_score(references, hypotheses):
-    from nltk.translate.bleu_score import sentence_bleu
     bleu = np.zeros(len(references))
     for i in range(len(references)):
-        bleu[i] = sentence_bleu([references[i]], hypotheses[i])
+        bleu[i] = _sentence_bleu(references[i], hypotheses[i])
     return bleu.mean()
 
 
-def score_slt(net, dataset, beam_size=None):
+def score_slt(net, dataset, beam_size=None, workers=1):
     data = dataset.evaluation()
-    trn = net.transcribe(data['audio'], beam_size=beam_size)
+    trn = _embed(functools.partial(net.transcribe, beam_size=beam_size),
+                 data['audio'])
     ref = data['text']
-    cer = xer.cer(trn, ref)
+    cer = xer.cer(trn, ref, workers=workers)
     trn = dataset.split_sentences(trn)
     ref = dataset.split_sentences(ref)
     bleu = bleu_score(ref, trn)
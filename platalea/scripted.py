@@ -0,0 +1,146 @@
+"""
+TorchScript twins of the encoders, for inference
+
+The encoders compute the output lengths of their convolutions from the
+layers themselves and keep attention weights as attributes, which TorchScript
+does not support. Their twins share their layers, and so their weights, but
+compute the same encodings with scriptable code only. Scripted and saved with
+`torch.jit.save`, they load with `torch.jit.load` without platalea.
+"""
+
+
+from typing import List
+import torch
+import torch.nn as nn
+
+from platalea.encoders import (ImageEncoder, SpeechEncoder, SpeechEncoderMultiConv,
+                               SpeechEncoderTransformer, TextEncoder)
+
+
+def _conv_params(conv):
+    return [conv.padding[0], conv.kernel_size[0], conv.stride[0], conv.dilation[0]]
+
+
+def conv_length(length: torch.Tensor, params: List[int]) -> torch.Tensor:
+    """Returns the output length of a 1D convolution with the given padding,
+    kernel size, stride and dilation (see encoders.inout)."""
+    pad, ksize, stride, dilation = params[0], params[1], params[2], params[3]
+    length = (length.float() + 2 * pad - dilation * (ksize - 1) - 1) / stride + 1
+    return length.floor().long().clamp(min=0)
+
+
+class Attention(nn.Module):
+    """Twin of attention.Attention."""
+    def __init__(self, att):
+        super(Attention, self).__init__()
+        self.hidden = att.hidden
+        self.out = att.out
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        alpha = torch.softmax(self.out(torch.tanh(self.hidden(input))), dim=1)
+        return torch.sum(alpha * input, 1)
+
+
+def _attention(att):
+    return None if att is None else Attention(att)
+
+
+class RecurrentEncoder(nn.Module):
+    """Twin of the speech encoders made of 1D convolutions followed by a
+    recurrent network, SpeechEncoder and SpeechEncoderMultiConv."""
+    def __init__(self, encoder):
+        super(RecurrentEncoder, self).__init__()
+        if isinstance(encoder.Conv, nn.Conv1d):
+            self.Conv = nn.ModuleList([encoder.Conv])
+        else:
+            self.Conv = nn.ModuleList(list(encoder.Conv))
+        self.conv_params = [_conv_params(c) for c in self.Conv]
+        self.RNN = encoder.RNN
+        self.att = _attention(encoder.att)
+
+    def forward(self, input: torch.Tensor, length: torch.Tensor) -> torch.Tensor:
+        x = input
+        i = 0
+        for conv in self.Conv:
+            x = conv(x)
+            length = conv_length(length, self.conv_params[i])
+            i += 1
+        x = nn.utils.rnn.pack_padded_sequence(
+            x.transpose(2, 1), length.cpu(), batch_first=True, enforce_sorted=False)
+        x, _ = self.RNN(x)
+        x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+        if self.att is not None:
+            x = nn.functional.normalize(self.att(x), p=2.0, dim=1)
+        return x
+
+
+class TransformerEncoder(nn.Module):
+    """Twin of SpeechEncoderTransformer."""
+    def __init__(self, encoder):
+        super(TransformerEncoder, self).__init__()
+        self.Conv = encoder.Conv
+        self.conv_params = _conv_params(encoder.Conv)
+        self.scale_conv_to_trafo = encoder.scale_conv_to_trafo
+        self.Transformer = encoder.Transformer
+        self.att = Attention(encoder.att)
+        # The dropout probability may be given as an int (e.g. the default of
+        # --trafo_dropout), which scripted dropout does not accept
+        for module in self.Transformer.modules():
+            if isinstance(module, nn.MultiheadAttention):
+                module.dropout = float(module.dropout)
+            elif isinstance(module, nn.Dropout):
+                module.p = float(module.p)
+
+    def forward(self, src: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        x = self.Conv(src)
+        lengths = conv_length(lengths, self.conv_params)
+        x = self.scale_conv_to_trafo(x.permute(0, 2, 1)).permute(1, 0, 2)
+        positions = torch.arange(x.size(0), device=x.device)
+        mask = positions.unsqueeze(0) >= lengths.to(x.device).unsqueeze(1)
+        x = self.Transformer(x, src_key_padding_mask=mask)
+        return nn.functional.normalize(self.att(x.transpose(1, 0)), p=2.0, dim=1)
+
+
+class TextRecurrentEncoder(nn.Module):
+    """Twin of TextEncoder."""
+    def __init__(self, encoder):
+        super(TextRecurrentEncoder, self).__init__()
+        self.Embed = encoder.Embed
+        self.RNN = encoder.RNN
+        self.att = _attention(encoder.att)
+
+    def forward(self, text: torch.Tensor, length: torch.Tensor) -> torch.Tensor:
+        x = nn.utils.rnn.pack_padded_sequence(
+            self.Embed(text), length.cpu(), batch_first=True, enforce_sorted=False)
+        x, _ = self.RNN(x)
+        x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+        if self.att is not None:
+            x = nn.functional.normalize(self.att(x), p=2.0, dim=1)
+        return x
+
+
+class LinearEncoder(nn.Module):
+    """Twin of ImageEncoder."""
+    def __init__(self, encoder):
+        super(LinearEncoder, self).__init__()
+        self.linear_transform = encoder.linear_transform
+        self.norm: bool = bool(encoder.norm)
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        x = self.linear_transform(input)
+        if self.norm:
+            return nn.functional.normalize(x, p=2.0, dim=1)
+        return x
+
+
+TWINS = [(SpeechEncoder, RecurrentEncoder), (SpeechEncoderMultiConv, RecurrentEncoder),
+         (SpeechEncoderTransformer, TransformerEncoder), (TextEncoder, TextRecurrentEncoder),
+         (ImageEncoder, LinearEncoder)]
+
+
+def script(encoder):
+    """Returns the scripted twin of `encoder`, in evaluation mode."""
+    for encoder_type, twin in TWINS:
+        if type(encoder) == encoder_type:
+            return torch.jit.script(twin(encoder).eval())
+    raise NotImplementedError('No scriptable twin for {}'.format(type(encoder).__name__))
@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 
 import platalea.dataset as D
+import platalea.distributed
 from platalea.encoders import TextEncoder, SpeechEncoder
 import platalea.loss
 import platalea.score
@@ -24,11 +25,21 @@ class SpeechText(nn.Module):
             self.TextEncoder = TextEncoder(config['TextEncoder'])
 
     def cost(self, item):
+        return self.embedding_cost(*self.encode(item))
+
+    def encode(self, item):
         speech_enc = self.SpeechEncoder(item['audio'], item['audio_len'])
         text_enc = self.TextEncoder(item['text'], item['text_len'])
-        scores = platalea.loss.cosine_matrix(speech_enc, text_enc)
-        loss = platalea.loss.contrastive(scores,
-                                         margin=self.config['margin_size'])
+        return speech_enc, text_enc
+
+    def embedding_cost(self, speech_enc, text_enc):
+        if self.training and self.config.get('gather_negatives', False):
+            # Contrasting with the batches of all processes
+            speech_enc = platalea.distributed.all_gather_with_grad(speech_enc)
+            text_enc = platalea.distributed.all_gather_with_grad(text_enc)
+        loss = platalea.loss.cosine_contrastive(
+            speech_enc, text_enc, margin=self.config['margin_size'],
+            hard_negatives=self.config.get('hard_negatives'))
         return loss
 
     def embed_text(self, texts):
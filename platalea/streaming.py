@@ -0,0 +1,288 @@
+"""
+Streaming inference of the recurrent speech encoders
+
+Encodes recordings of any length chunk by chunk, without truncating them to
+the `max_frames` of the data loaders and without holding them in memory. The
+frames of the receptive field of the convolutions overlapping the next chunk
+are kept, and so is the state of unidirectional recurrent layers, which
+yields the same encodings as encoding whole recordings. Bidirectional
+recurrent layers need the whole recording, so they are approximated by
+encoding overlapping windows: each window of `chunk_frames` frames is encoded
+with `context_frames` frames of context on both sides, the states of the
+context frames being dropped. Attention pooling is computed incrementally,
+with a running softmax, so memory does not grow with the length of the
+recordings. Recordings of different lengths can be streamed together, padded,
+given their lengths: as with packed sequences, padding is then left out of
+the recurrent layers and of the attention pooling.
+"""
+
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from platalea.attention import Attention
+from platalea.encoders import (SpeechEncoder, SpeechEncoderBottom, SpeechEncoderMultiConv,
+                               SpeechEncoderSplit, inout)
+
+
+class StreamingConv():
+    """1D convolution of a stream of chunks, keeping the input frames which
+    the next outputs depend on."""
+    def __init__(self, conv):
+        if conv.padding_mode != 'zeros' or isinstance(conv.padding, str):
+            raise ValueError('Only convolutions with explicit zero padding can be streamed')
+        self.conv = conv
+        self.padding = conv.padding[0]
+        self.stride = conv.stride[0]
+        self.span = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+        self.buffer = None
+
+    def _convolve(self, x):
+        n = max(0, (x.size(2) - self.span) // self.stride + 1)
+        self.buffer = x[:, :, n * self.stride:]
+        if n == 0:
+            return x.new_zeros(x.size(0), self.conv.out_channels, 0)
+        return F.conv1d(x[:, :, :(n - 1) * self.stride + self.span], self.conv.weight,
+                        self.conv.bias, self.stride, 0, self.conv.dilation, self.conv.groups)
+
+    def feed(self, x):
+        if self.buffer is None:
+            x = F.pad(x, (self.padding, 0))
+        else:
+            x = torch.cat([self.buffer, x], dim=2)
+        return self._convolve(x)
+
+    def finish(self):
+        if self.buffer is None:
+            return None
+        return self._convolve(F.pad(self.buffer, (0, self.padding)))
+
+
+class StreamingRNN():
+    """Stack of recurrent layers applied to a stream of chunks. The states of
+    unidirectional layers are carried over from one chunk to the next; if a
+    layer is bidirectional, the stack encodes windows of `window` frames with
+    `context` frames of context on both sides instead. Given the `lengths` of
+    the recordings, windows are packed so that the padding after the end of a
+    recording does not reach its states."""
+    def __init__(self, rnns, window, context, lengths=None):
+        self.rnns = rnns
+        self.lengths = lengths
+        self.bidirectional = any(r.bidirectional for r in rnns)
+        self.window = window
+        self.context = context
+        self.size = rnns[-1].hidden_size * (2 if rnns[-1].bidirectional else 1)
+        self.states = [None] * len(rnns)
+        self.left = None
+        self.pending = None
+        # Position in the recordings of the first pending frame
+        self.position = 0
+
+    def _encode(self, x, start):
+        """Encodes frames starting at position `start` of the recordings."""
+        if self.lengths is None:
+            for rnn in self.rnns:
+                x, _ = rnn(x)
+            return x
+        size = x.size(1)
+        lengths = (self.lengths - start).clamp(1, size)
+        x = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True,
+                                              enforce_sorted=False)
+        for rnn in self.rnns:
+            x, _ = rnn(x)
+        x, _ = nn.utils.rnn.pad_packed_sequence(x, batch_first=True, total_length=size)
+        return x
+
+    def _window(self, end):
+        """Encodes the pending frames up to `end` with their context, and
+        returns the states of those frames."""
+        frames = self.pending[:, :end]
+        x = frames if self.left is None else torch.cat([self.left, frames], dim=1)
+        offset = x.size(1) - frames.size(1)
+        x = self._encode(torch.cat([x, self.pending[:, end:end + self.context]], dim=1),
+                         self.position - offset)
+        self.position += frames.size(1)
+        self.left = frames[:, -self.context:] if self.left is None else \
+            torch.cat([self.left, frames], dim=1)[:, -self.context:]
+        self.pending = self.pending[:, end:]
+        return x[:, offset:offset + frames.size(1)]
+
+    def feed(self, x):
+        if x.size(1) == 0:
+            return x.new_zeros(x.size(0), 0, self.size)
+        if not self.bidirectional:
+            for i, rnn in enumerate(self.rnns):
+                x, self.states[i] = rnn(x, self.states[i])
+            return x
+        self.pending = x if self.pending is None else torch.cat([self.pending, x], dim=1)
+        out = []
+        while self.pending.size(1) >= self.window + self.context:
+            out.append(self._window(self.window))
+        if not out:
+            return x.new_zeros(x.size(0), 0, self.size)
+        return torch.cat(out, dim=1)
+
+    def finish(self):
+        if not self.bidirectional or self.pending is None or self.pending.size(1) == 0:
+            return None
+        return self._window(self.pending.size(1))
+
+
+class StreamingAttention():
+    """Attention pooling of a stream of chunks, as attention.Attention,
+    keeping the running maximum of the attention scores, the sum of their
+    exponentials and the sum of the inputs weighted by them. Frames where
+    `mask` is false are left out."""
+    def __init__(self, att):
+        if type(att) != Attention:
+            raise ValueError('Only attention.Attention can be streamed')
+        self.att = att
+        self.max = None
+        self.total = None
+        self.sum = None
+
+    def feed(self, x, mask=None):
+        if x.size(1) == 0:
+            return
+        scores = self.att.out(torch.tanh(self.att.hidden(x)))
+        if mask is not None:
+            scores = scores.masked_fill(~mask.unsqueeze(2), torch.finfo(scores.dtype).min)
+        maximum = scores.max(dim=1).values
+        if self.max is not None:
+            maximum = torch.maximum(maximum, self.max)
+            rescale = torch.exp(self.max - maximum)
+            self.total = self.total * rescale
+            self.sum = self.sum * rescale
+        weights = torch.exp(scores - maximum.unsqueeze(1))
+        if mask is not None:
+            weights = weights * mask.unsqueeze(2)
+        total = weights.sum(dim=1)
+        weighted = (weights * x).sum(dim=1)
+        self.total = total if self.total is None else self.total + total
+        self.sum = weighted if self.sum is None else self.sum + weighted
+        self.max = maximum
+
+    def pooled(self):
+        return self.sum / self.total
+
+
+def _stages(encoder):
+    """Returns the convolutions, recurrent layers and attention of a speech
+    encoder."""
+    if type(encoder) in [SpeechEncoder, SpeechEncoderMultiConv]:
+        convs = list(encoder.Conv) if isinstance(encoder.Conv, nn.Sequential) else [encoder.Conv]
+        return convs, [encoder.RNN], encoder.att
+    if type(encoder) == SpeechEncoderBottom:
+        return [encoder.Conv], [encoder.RNN] if encoder.RNN is not None else [], None
+    if type(encoder) == SpeechEncoderSplit:
+        convs, rnns, _ = _stages(encoder.Bottom)
+        if encoder.Top.RNN is not None:
+            rnns = rnns + [encoder.Top.RNN]
+        return convs, rnns, encoder.Top.att
+    raise NotImplementedError('{} cannot be streamed'.format(type(encoder).__name__))
+
+
+class StreamingSpeechEncoder():
+    """Encodes recordings chunk by chunk with a recurrent speech encoder
+    (SpeechEncoder, SpeechEncoderMultiConv, SpeechEncoderBottom or
+    SpeechEncoderSplit) in evaluation mode.
+
+    Chunks are batches of features of shape (batch, channels, frames), the
+    recordings of a batch being streamed together, and can have any number of
+    frames. Recordings of different lengths are padded with zeros to the
+    longest one, and their `lengths`, in input frames, must then be given.
+    `feed` returns the states of the last layer which the new frames complete,
+    if any, `finish` those of the last frames, and `embedding` the normalized
+    attention-pooled encoding of the recordings. States after the end of a
+    recording are zero, as when unpacking sequences. `chunk_frames` and
+    `context_frames`, in input frames, only matter for bidirectional encoders.
+    """
+    def __init__(self, encoder, chunk_frames=2048, context_frames=256, lengths=None):
+        convs, rnns, att = _stages(encoder)
+        self.convs = [StreamingConv(c) for c in convs]
+        stride = 1
+        for c in convs:
+            stride *= c.stride[0]
+        # Lengths of the recordings in frames of the recurrent layers
+        self.lengths = None
+        if lengths is not None:
+            self.lengths = torch.as_tensor(lengths)
+            for c in convs:
+                self.lengths = inout(c, self.lengths)
+            self.lengths = self.lengths.clamp(min=1)
+        self.position = 0
+        self.rnn = StreamingRNN(rnns, max(1, chunk_frames // stride),
+                                max(1, context_frames // stride), self.lengths) if rnns else None
+        self.att = StreamingAttention(att) if att is not None else None
+
+    def _forward(self, x, finish=False):
+        for conv in self.convs:
+            if finish:
+                x = conv.finish() if x is None else torch.cat([conv.feed(x), conv.finish()], dim=2)
+            else:
+                x = conv.feed(x)
+            if x is None:
+                return None
+        x = x.transpose(2, 1)
+        if self.rnn is not None:
+            x = self.rnn.feed(x)
+            if finish:
+                last = self.rnn.finish()
+                if last is not None:
+                    x = torch.cat([x, last], dim=1)
+        mask = None
+        if self.lengths is not None:
+            positions = torch.arange(self.position, self.position + x.size(1), device=x.device)
+            mask = positions.unsqueeze(0) < self.lengths.to(x.device).unsqueeze(1)
+            x = x * mask.unsqueeze(2)
+        self.position += x.size(1)
+        if self.att is not None:
+            self.att.feed(x, mask)
+        return x
+
+    @torch.no_grad()
+    def feed(self, chunk):
+        return self._forward(chunk)
+
+    @torch.no_grad()
+    def finish(self):
+        return self._forward(None, finish=True)
+
+    def embedding(self):
+        if self.att is None:
+            raise ValueError('The encoder has no attention pooling')
+        return F.normalize(self.att.pooled(), p=2, dim=1)
+
+
+def chunks(features, chunk_frames=2048):
+    """Splits features of shape (batch, channels, frames) into chunks."""
+    return torch.split(features, chunk_frames, dim=2)
+
+
+def stream_states(encoder, features, chunk_frames=2048, context_frames=256, lengths=None):
+    """Yields the states of the last layer of `encoder` for features given as
+    a tensor of shape (batch, channels, frames) or as an iterable of chunks,
+    as soon as they are computed. The `lengths` of the recordings are needed
+    if they differ."""
+    if torch.is_tensor(features):
+        features = chunks(features, chunk_frames)
+    stream = StreamingSpeechEncoder(encoder, chunk_frames, context_frames, lengths)
+    for chunk in features:
+        x = stream.feed(chunk)
+        if x.size(1) > 0:
+            yield x
+    x = stream.finish()
+    if x is not None and x.size(1) > 0:
+        yield x
+
+
+def embed(encoder, features, chunk_frames=2048, context_frames=256, lengths=None):
+    """Returns the embedding of recordings given as in stream_states."""
+    if torch.is_tensor(features):
+        features = chunks(features, chunk_frames)
+    stream = StreamingSpeechEncoder(encoder, chunk_frames, context_frames, lengths)
+    for chunk in features:
+        stream.feed(chunk)
+    stream.finish()
+    return stream.embedding()
@@ -7,6 +7,11 @@ import torch.nn as nn
 
 import platalea.schedulers
 import platalea.dataset as D
+import platalea.distributed
+from platalea.accumulation import accumulate_gradients, micro_batches
+from platalea.checkpoint import CheckpointWriter, TrainingState
+from platalea.controller import TrainingController
+from platalea.utils.files import model_fname
 from platalea.encoders import TextEncoder, ImageEncoder
 import platalea.loss
 import platalea.score
@@ -30,11 +35,21 @@ class TextImage(nn.Module):
             self.ImageEncoder = ImageEncoder(config['ImageEncoder'])
 
     def cost(self, item):
+        return self.embedding_cost(*self.encode(item))
+
+    def encode(self, item):
         text_enc = self.TextEncoder(item['text'], item['text_len'])
         image_enc = self.ImageEncoder(item['image'])
-        scores = platalea.loss.cosine_matrix(text_enc, image_enc)
-        loss = platalea.loss.contrastive(scores,
-                                         margin=self.config['margin_size'])
+        return text_enc, image_enc
+
+    def embedding_cost(self, text_enc, image_enc):
+        if self.training and self.config.get('gather_negatives', False):
+            # Contrasting with the batches of all processes
+            text_enc = platalea.distributed.all_gather_with_grad(text_enc)
+            image_enc = platalea.distributed.all_gather_with_grad(image_enc)
+        loss = platalea.loss.cosine_contrastive(
+            text_enc, image_enc, margin=self.config['margin_size'],
+            hard_negatives=self.config.get('hard_negatives'))
         return loss
 
     def embed_image(self, images):
@@ -70,43 +85,84 @@ def experiment(net, data, config):
         result = []
         for item in data['val']:
             item = {key: value.to(_device) for key, value in item.items()}
-            result.append(net.cost(item).item())
+            with platalea.hardware.autocast(config.get('amp')):
+                result.append(net.cost(item).item())
         net.train()
         return torch.tensor(result).mean()
 
     net.to(_device)
+    platalea.distributed.broadcast_parameters(net)
     net.train()
     net_parameters = net.parameters()
     optimizer = create_optimizer(config, net_parameters)
     scheduler = create_scheduler(config, optimizer, data)
+    scaler = platalea.hardware.grad_scaler(config.get('amp'))
+    writer = CheckpointWriter(keep_last=config.get('keep_checkpoints'),
+                              best_path='net.best.pt')
+    controller = TrainingController.from_config(config)
+    state = TrainingState(config.get('checkpoint'), writer, net=net,
+                          optimizer=optimizer, scheduler=scheduler, scaler=scaler,
+                          controller=controller)
+    if config.get('resume'):
+        state.load()
+
+    def evaluate(out, epoch, step=None):
+        result = platalea.score.score_text_image(
+            net, controller.validation(data['val'].dataset))
+        cost = state.costs['train']
+        result['average_loss'] = cost['cost'] / cost['N'] if cost['N'] else None
+        result['epoch'] = epoch
+        if step is not None:
+            result['step'] = step
+        json.dump(result, out)
+        print('', file=out, flush=True)
+        state.add_result(result, out)
+        if platalea.distributed.is_main_process():
+            logging.info("Saving model in {}".format(model_fname(epoch, step)))
+            writer.save(net, model_fname(epoch, step), score=controller.score(result))
+        controller.evaluated(result)
 
-    results = []
-    with open("result.json", "w") as out:
-        for epoch in range(1, config['epochs']+1):
-            cost = Counter()
-            average_loss = None
-            for j, item in enumerate(data['train'], start=1):
-                item = {key: value.to(_device) for key, value in item.items()}
-                loss = net.cost(item)
+    results = state.results
+    with writer, state.open_results("result.json") as out:
+        for epoch in range(state.epoch, config['epochs']+1):
+            reason = controller.stop_reason()
+            if reason is not None:
+                logging.info("Stopping training: {}".format(reason))
+                break
+            platalea.distributed.set_epoch(data['train'], epoch)
+            train_steps = micro_batches(data['train'],
+                                        config.get('accumulation_steps', 1))
+            train_steps = state.epoch_steps(epoch, train_steps)
+            cost = state.costs['train']
+            for j, items in enumerate(train_steps, start=state.step + 1):
+                items = [{key: value.to(_device) for key, value in item.items()}
+                         for item in items]
+                loss_value = accumulate_gradients(
+                    net, items, scaler, amp=config.get('amp'),
+                    gradient_cache=config.get('gradient_cache', False))
+                platalea.distributed.average_gradients(net)
+                scaler.step(optimizer)
+                scaler.update()
                 optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
                 scheduler.step()
-                cost += Counter({'cost': loss.item(), 'N': 1})
+                cost += Counter({'cost': loss_value, 'N': 1})
                 average_loss = cost['cost'] / cost['N']
                 if j % config['loss_logging_interval'] == 0:
                     logging.info("train {} {} {}".format(
                         epoch, j, average_loss))
                 if j % config['validation_interval'] == 0:
                     logging.info("valid {} {} {}".format(epoch, j, val_loss()))
-            result = platalea.score.score_text_image(net, data['val'].dataset)
-            result['average_loss'] = average_loss
-            result['epoch'] = epoch
-            results.append(result)
-            json.dump(result, out)
-            print('', file=out, flush=True)
-            logging.info("Saving model in net.{}.pt".format(epoch))
-            torch.save(net, "net.{}.pt".format(epoch))
+                controller.step()
+                state.end_step(j, config.get('checkpoint_interval'))
+                if controller.evaluation_due():
+                    evaluate(out, epoch, j)
+                    state.save()
+                if controller.stop_reason() is not None:
+                    break
+            if controller.evaluation_due(end_of_epoch=True,
+                                         end_of_training=epoch == config['epochs']):
+                evaluate(out, epoch)
+            state.end_epoch()
     return results
 
 
@@ -121,4 +177,5 @@ def get_default_config(hidden_size_factor=1024):
         ImageEncoder=dict(
             linear=dict(in_size=2048, out_size=hidden_size_factor * 2),
             norm=True),
-        margin_size=0.2)
+        margin_size=0.2,
+        hard_negatives=None)
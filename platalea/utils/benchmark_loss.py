@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the contrastive loss
+
+Compares the time of a forward and backward pass and the peak memory of the
+fused contrastive loss over cosine similarities with the unfused one, for a
+range of batch sizes. On GPU, memory is measured by the CUDA allocator; on
+CPU, from the memory allocated and freed by each operation, as recorded by
+the PyTorch profiler.
+"""
+
+
+import argparse
+import time
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+import platalea.hardware
+import platalea.loss
+
+
+def _unfused(U, V):
+    return platalea.loss.contrastive(platalea.loss.cosine_matrix(U, V))
+
+
+LOSSES = dict(unfused=_unfused, fused=platalea.loss.cosine_contrastive)
+
+
+def _inputs(batch_size, dim, device):
+    torch.manual_seed(123)
+    U = torch.randn(batch_size, dim, device=device, requires_grad=True)
+    V = torch.randn(batch_size, dim, device=device, requires_grad=True)
+    return U, V
+
+
+def _step(loss_fn, U, V):
+    loss_fn(U, V).backward()
+    U.grad = None
+    V.grad = None
+
+
+def _synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def step_time(loss, batch_size, dim, device, steps=20):
+    """Returns the average time of a forward and backward pass in seconds."""
+    U, V = _inputs(batch_size, dim, device)
+    for _ in range(3):
+        _step(LOSSES[loss], U, V)
+    _synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        _step(LOSSES[loss], U, V)
+    _synchronize(device)
+    return (time.perf_counter() - start) / steps
+
+
+def _profiled_peak(events):
+    """Returns the peak of the memory allocated during profiled `events`.
+    Memory allocated by an operation itself (not by the operations it calls)
+    is counted from its start and memory it frees until its end, so the peak
+    is slightly overestimated."""
+    changes = []
+    for e in events:
+        if e.self_cpu_memory_usage > 0:
+            changes.append((e.time_range.start, e.self_cpu_memory_usage))
+        elif e.self_cpu_memory_usage < 0:
+            changes.append((e.time_range.end, e.self_cpu_memory_usage))
+    current = peak = 0
+    for _, change in sorted(changes):
+        current += change
+        peak = max(peak, current)
+    return peak
+
+
+def peak_memory(loss, batch_size, dim, device):
+    """Returns the memory allocated at the peak of a forward and backward pass,
+    on top of the inputs, in bytes."""
+    if device.type == 'cuda':
+        U, V = _inputs(batch_size, dim, device)
+        _synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        before = torch.cuda.memory_allocated(device)
+        _step(LOSSES[loss], U, V)
+        _synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - before
+    U, V = _inputs(batch_size, dim, device)
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        _step(LOSSES[loss], U, V)
+    return _profiled_peak(prof.events())
+
+
+def benchmark(batch_sizes, dim=2048, device=None, steps=20):
+    device = torch.device(device) if device else platalea.hardware.device()
+    results = []
+    for batch_size in batch_sizes:
+        result = dict(batch_size=batch_size)
+        for loss in LOSSES:
+            result[loss] = dict(time=step_time(loss, batch_size, dim, device, steps),
+                                memory=peak_memory(loss, batch_size, dim, device))
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    parser = argparse.ArgumentParser(description=doc[0], epilog=doc[1])
+    parser.add_argument(
+        '--batch_sizes', help='Batch sizes to benchmark.', type=int,
+        nargs='+', default=[32, 64, 128, 256, 512, 1024])
+    parser.add_argument(
+        '--dim', help='Size of the embeddings (default=2048).', type=int,
+        default=2048)
+    parser.add_argument(
+        '--steps', help='Number of timed steps (default=20).', type=int,
+        default=20)
+    parser.add_argument(
+        '--device', help='Device to run on, by default the GPU if available.',
+        type=str, default=None)
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>12} {:>8} {:>12} {:>12}'.format(
+        'batch', 'unfused ms', 'fused ms', 'speedup', 'unfused MiB', 'fused MiB'))
+    for r in benchmark(args.batch_sizes, args.dim, args.device, args.steps):
+        print('{:>10} {:>12.3f} {:>12.3f} {:>8.2f} {:>12.1f} {:>12.1f}'.format(
+            r['batch_size'], r['unfused']['time'] * 1000, r['fused']['time'] * 1000,
+            r['unfused']['time'] / r['fused']['time'],
+            r['unfused']['memory'] / 2**20, r['fused']['memory'] / 2**20))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+"""
+Builds a nearest neighbour index of image embeddings
+
+Embeds the images of a split of Flickr8K with the image encoder of a
+retrieval model and saves an index of the embeddings (see platalea.index),
+which can then be searched with the embeddings of spoken captions. With
+--benchmark, the captions of the split are used as queries, and the recall
+and time per query of the index are reported for several numbers of probed
+partitions, along with those of the exact ranking. Recall is measured both
+against the exact ranking (overlap of the top k neighbours) and against the
+images matching the captions (recall@k, as in the evaluation of the models).
+"""
+
+
+import logging
+import time
+import numpy as np
+
+import platalea.dataset as D
+from platalea.checkpoint import load_model
+from platalea.experiments.config import get_argument_parser
+from platalea.index import FlatIndex, create_index
+
+
+def overlap(exact, approximate):
+    """Returns the mean fraction of the exact neighbours of the queries which
+    are among their approximate neighbours."""
+    return np.mean([len(set(e).intersection(a)) / len(e) for e, a in zip(exact, approximate)])
+
+
+def recall(neighbours, correct):
+    """Returns the mean fraction of the correct items of the queries which
+    are among their neighbours, `correct[i][j]` indicating whether item j is
+    correct for query i."""
+    return np.mean([c[n].sum() / c.sum() for n, c in zip(neighbours, correct)])
+
+
+def _timed_search(index, queries, k):
+    start = time.perf_counter()
+    _, neighbours = index.search(queries, k)
+    return neighbours, (time.perf_counter() - start) / len(queries)
+
+
+def benchmark(index, vectors, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32), correct=None):
+    """Returns the recall and time per query of `index`, built on `vectors`,
+    for each number of probed partitions, and those of the exact search."""
+    exact, query_time = _timed_search(FlatIndex().build(vectors, index.ids), queries, k)
+    results = [dict(index='flat', nprobe=None, time=query_time, overlap=1.0)]
+    default = getattr(index, 'nprobe', None)
+    for nprobe in nprobes if hasattr(index, 'nprobe') else [None]:
+        if nprobe is not None:
+            index.nprobe = nprobe
+        neighbours, query_time = _timed_search(index, queries, k)
+        results.append(dict(index=index.kind, nprobe=nprobe, time=query_time,
+                            overlap=overlap(exact, neighbours)))
+        if correct is not None:
+            results[-1]['recall'] = recall(neighbours, correct)
+    if correct is not None:
+        results[0]['recall'] = recall(exact, correct)
+    if default is not None:
+        index.nprobe = default
+    return results
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
+    args._parser.description = doc[0]
+    args.add_argument('path', metavar='path', help='Model\'s path')
+    args.add_argument(
+        '--output', help='Path where the index is saved'
+        ' (default=<path without .pt>.index.npz).', type=str, default=None)
+    args.add_argument(
+        '--index', help='Type of index (default=ivf).', type=str, default='ivf',
+        choices=['flat', 'ivf', 'faiss'])
+    args.add_argument(
+        '--nlist', help='Number of partitions of the ivf and faiss indices'
+        ' (default=4 sqrt(number of images)).', type=int, default=None)
+    args.add_argument(
+        '--nprobe', help='Number of partitions searched by default'
+        ' (default=8).', type=int, default=8)
+    args.add_argument(
+        '--split', help='Split whose images are indexed (default=val).',
+        type=str, default='val', choices=['train', 'val', 'test'])
+    args.add_argument(
+        '--benchmark', help='Report recall and time per query, with the'
+        ' captions of the split as queries.', action='store_true')
+    args.add_argument(
+        '--k', help='Number of neighbours of the benchmark (default=10).',
+        type=int, default=10)
+    args.enable_help()
+    args.parse()
+
+    logging.info('Loading model')
+    net = load_model(args.path).eval()
+    logging.info('Loading data')
+    data = D.flickr8k_loader(args.flickr8k_root, args.flickr8k_meta,
+                             args.flickr8k_language, args.audio_features_fn,
+                             split=args.split, batch_size=16, shuffle=False)
+    data = data.dataset.evaluation()
+    logging.info('Embedding images')
+    images = net.embed_image(data['image'])
+    kwargs = {} if args.index == 'flat' else dict(nlist=args.nlist, nprobe=args.nprobe)
+    start = time.perf_counter()
+    index = create_index(args.index, **kwargs).build(images)
+    logging.info('Index of {} images built in {:.1f}s'.format(len(index), time.perf_counter() - start))
+    output = args.output
+    if output is None:
+        output = (args.path[:-len('.pt')] if args.path.endswith('.pt') else args.path) + '.index.npz'
+    index.save(output)
+    logging.info('Index saved in {}'.format(output))
+
+    if args.benchmark:
+        logging.info('Embedding captions')
+        if hasattr(net, 'embed_audio'):
+            queries = net.embed_audio(data['audio'])
+        else:
+            queries = net.embed_text(data['text'])
+        results = benchmark(index, images, queries, args.k,
+                            correct=data['correct'].cpu().numpy())
+        print('{:>6} {:>7} {:>10} {:>9} {:>10}'.format(
+            'index', 'nprobe', 'ms/query', 'overlap', 'recall@{}'.format(args.k)))
+        for r in results:
+            print('{:>6} {:>7} {:>10.3f} {:>9.3f} {:>10.3f}'.format(
+                r['index'], '-' if r['nprobe'] is None else r['nprobe'],
+                r['time'] * 1000, r['overlap'], r['recall']))
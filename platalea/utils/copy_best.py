@@ -4,15 +4,15 @@
 Copy best network to net.best.pt
 
 Go through results to find the best performing epoch and copy the corresponding
-network to net.best.pt.
+network to net.best.pt. The network is linked rather than copied when possible.
 """
 
 
 import argparse
 import numpy as np
 import pathlib
-from shutil import copyfile
 
+from platalea.utils.files import link_file, model_fname
 from platalea.utils.get_best_score import read_results, get_metric_accessor
 
 
@@ -26,8 +26,11 @@ def copy_best(exp_path=['.'], result_fname='result.json', save_fname='net.best.p
             ibest = np.argmin([metric_accessor(r) for r in res]) + 1
         else:
             ibest = np.argmax([metric_accessor(r) for r in res]) + 1
-        best_fname = 'net.{}.pt'.format(ibest)
-        copyfile(root_path / best_fname, root_path / save_fname)
+        if 'epoch' in res[ibest - 1]:
+            best_fname = model_fname(res[ibest - 1]['epoch'], res[ibest - 1].get('step'))
+        else:
+            best_fname = 'net.{}.pt'.format(ibest)
+        link_file(root_path / best_fname, root_path / save_fname, symlink=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Embeds a corpus with a model and stores the embeddings
+
+Embeds the utterances, images and/or captions of splits of Flickr8K with the
+encoders of a retrieval model (speech-image, text-image or speech-text,
+including VQ models), and writes them to an embedding store (see
+platalea.utils.embedding_store): one sharded store of .npy files per kind of
+item, with an index of the identifiers of the items (audio file names for
+utterances and captions, image file names for images). Items are embedded
+--shard_size at a time, each shard being written as soon as it is computed.
+Running the script again on the same store only embeds the items which are
+not stored yet, so an interrupted run can be resumed.
+"""
+
+
+import logging
+import time
+import torch
+
+import platalea.dataset as D
+import platalea.hardware
+from platalea.checkpoint import load_model
+from platalea.experiments.config import get_argument_parser
+from platalea.utils.embedding_store import EmbeddingStore
+
+
+# Kind of item -> method of the model embedding it
+KINDS = dict(audio='embed_audio', image='embed_image', text='embed_text')
+
+
+def corpus_items(dataset, kind):
+    """Returns the identifiers and the inputs of the encoders of the items of
+    a kind in a Flickr8K dataset, each item appearing once."""
+    items = {}
+    for image_id, audio_id, text in dataset.split_data:
+        if kind == 'audio' and audio_id not in items:
+            items[audio_id] = dataset.audio[audio_id]
+        elif kind == 'image' and image_id not in items:
+            items[image_id] = dataset.image[image_id]
+        elif kind == 'text' and audio_id not in items:
+            items[audio_id] = text
+    return list(items), list(items.values())
+
+
+def model_kinds(net):
+    """Returns the kinds of items `net` embeds."""
+    return [kind for kind, method in KINDS.items() if hasattr(net, method)]
+
+
+def embed_items(net, store, kind, ids, items, shard_size=10000):
+    """Embeds the items which are not in `store` yet, `shard_size` at a time.
+    Returns the number of items embedded."""
+    missing = set(store.missing(kind, ids))
+    todo = [(i, x) for i, x in zip(ids, items) if i in missing]
+    if len(todo) < len(ids):
+        logging.info('{}: {} of {} items already stored'.format(
+            kind, len(ids) - len(todo), len(ids)))
+    embed = getattr(net, KINDS[kind])
+    start = time.perf_counter()
+    for offset in range(0, len(todo), shard_size):
+        shard = todo[offset:offset + shard_size]
+        shard_start = time.perf_counter()
+        # Without autograd, which would record the graph of every batch
+        with torch.inference_mode():
+            embeddings = embed([x for _, x in shard])
+        store.add(kind, [i for i, _ in shard], embeddings)
+        done = offset + len(shard)
+        logging.info('{}: {}/{} items, {:.1f} items/s ({:.1f} items/s overall)'.format(
+            kind, done, len(todo), len(shard) / (time.perf_counter() - shard_start),
+            done / (time.perf_counter() - start)))
+    return len(todo)
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
+    args._parser.description = doc[0]
+    args.add_argument('path', metavar='path', help='Model\'s path')
+    args.add_argument(
+        'output', metavar='output', help='Directory of the embedding store')
+    args.add_argument(
+        '--splits', help='Splits to embed (default=train val test).', type=str,
+        nargs='+', default=['train', 'val', 'test'], choices=['train', 'val', 'test'])
+    args.add_argument(
+        '--kinds', help='Kinds of items to embed (default=all those the model'
+        ' embeds).', type=str, nargs='+', default=None, choices=list(KINDS))
+    args.add_argument(
+        '--shard_size', help='Number of items per shard (default=10000).',
+        type=int, default=10000)
+    args.enable_help()
+    args.parse()
+
+    platalea.hardware.set_device(args.device)
+    logging.info('Loading model')
+    net = load_model(args.path).eval()
+    kinds = args.kinds or model_kinds(net)
+    unsupported = set(kinds) - set(model_kinds(net))
+    if unsupported:
+        raise ValueError('{} does not embed {}'.format(type(net).__name__, ', '.join(unsupported)))
+    store = EmbeddingStore(args.output)
+    for split in args.splits:
+        logging.info('Loading {} data'.format(split))
+        dataset = D.Flickr8KData(root=args.flickr8k_root, feature_fname=args.audio_features_fn,
+                                 meta_fname=args.flickr8k_meta, split=split,
+                                 language=args.flickr8k_language)
+        for kind in kinds:
+            ids, items = corpus_items(dataset, kind)
+            embed_items(net, store, kind, ids, items, args.shard_size)
+    logging.info('Embeddings stored in {}'.format(args.output))
@@ -0,0 +1,91 @@
+"""
+Store of the embeddings of a corpus
+
+Embeddings are stored by kind (e.g. audio, image, text) in shards, each
+shard being a NumPy .npy file, which can be memory-mapped, with the
+identifiers of its items in a text file next to it. An index maps the
+identifiers of each kind to their shard and position. Shards are written
+atomically and the index is rewritten after each of them, so an interrupted
+run can be resumed by only embedding the items which are not stored yet.
+"""
+
+
+import json
+import os
+import pathlib
+import numpy as np
+
+
+class EmbeddingStore():
+    """Embeddings stored in `directory`, read with `embeddings(kind)` or
+    item by item with store[kind, identifier]."""
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Kind -> identifier -> [shard, position in shard]
+        self.index = {}
+        if (self.directory / 'index.json').exists():
+            with open(self.directory / 'index.json') as f:
+                self.index = json.load(f)
+
+    def missing(self, kind, ids):
+        """Returns the identifiers among `ids` whose embeddings are not
+        stored."""
+        stored = self.index.get(kind, {})
+        return [i for i in ids if i not in stored]
+
+    def _shards(self, kind):
+        return sorted(self.directory.glob('{}-*.npy'.format(kind)))
+
+    def add(self, kind, ids, embeddings):
+        """Stores the embeddings of the items identified by `ids` in a new
+        shard."""
+        embeddings = np.asarray(embeddings)
+        if len(ids) != len(embeddings):
+            raise ValueError('{} identifiers for {} embeddings'.format(len(ids), len(embeddings)))
+        shards = self._shards(kind)
+        number = int(shards[-1].stem.rsplit('-', 1)[1]) + 1 if shards else 0
+        name = '{}-{:05d}'.format(kind, number)
+        path = self.directory / name
+        with open(str(path) + '.ids.tmp', 'w') as f:
+            for i in ids:
+                print(i, file=f)
+        os.replace(str(path) + '.ids.tmp', str(path) + '.ids')
+        with open(str(path) + '.npy.tmp', 'wb') as f:
+            np.save(f, embeddings)
+        os.replace(str(path) + '.npy.tmp', str(path) + '.npy')
+        entries = self.index.setdefault(kind, {})
+        for position, i in enumerate(ids):
+            entries[i] = [name, position]
+        self._save_index()
+
+    def _save_index(self):
+        path = self.directory / 'index.json'
+        with open(str(path) + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(str(path) + '.tmp', path)
+
+    def shard(self, name):
+        """Returns the embeddings of a shard, memory-mapped."""
+        return np.load(self.directory / (name + '.npy'), mmap_mode='r')
+
+    def __getitem__(self, key):
+        kind, identifier = key
+        name, position = self.index[kind][identifier]
+        return np.array(self.shard(name)[position])
+
+    def embeddings(self, kind):
+        """Returns the identifiers and embeddings of all items of a kind, in
+        the order they were stored."""
+        ids, embeddings = [], []
+        for path in self._shards(kind):
+            with open(path.with_suffix('.ids')) as f:
+                shard_ids = f.read().splitlines()
+            # Items stored again in later shards are taken from those
+            keep = [p for p, i in enumerate(shard_ids)
+                    if self.index[kind].get(i) == [path.stem, p]]
+            ids.extend(shard_ids[p] for p in keep)
+            embeddings.append(self.shard(path.stem)[keep])
+        if not embeddings:
+            return [], None
+        return ids, np.concatenate(embeddings)
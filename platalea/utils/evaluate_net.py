@@ -9,6 +9,7 @@ import platalea.score
 
 from platalea.asr import SpeechTranscriber
 from platalea.basic import SpeechImage
+from platalea.checkpoint import load_model
 from platalea.mtl import MTLNetASR, MTLNetSpeechText
 from platalea.speech_text import SpeechText
 from platalea.text_image import TextImage
@@ -80,7 +81,7 @@ else:
                              shuffle=False)
 
 logging.info('Loading model')
-net = torch.load(args.path)
+net = load_model(args.path)
 logging.info('Evaluating')
 with torch.no_grad():
     tasks = get_evaluation_tasks(net)
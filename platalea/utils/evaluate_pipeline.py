@@ -5,6 +5,7 @@ import pathlib
 import torch
 
 import platalea.dataset as D
+from platalea.checkpoint import load_model
 import platalea.rank_eval as E
 from utils.extract_transcriptions import extract_trn
 from platalea.experiments.config import get_argument_parser
@@ -46,7 +47,7 @@ if args.asr_model_dir:
     path = pathlib.Path(args.asr_model_dir) / 'net.best.pt'
 else:
     path = pathlib.Path(args.path) / 'asr.best.pt'
-net = torch.load(path)
+net = load_model(path)
 logging.info('Extracting ASR/SLT transcriptions')
 with torch.no_grad():
     net.eval()
@@ -56,7 +57,7 @@ if args.text_image_model_dir:
     path = pathlib.Path(args.text_image_model_dir) / 'net.best.pt'
 else:
     path = pathlib.Path(args.path) / 'ti.best.pt'
-net = torch.load(path)
+net = load_model(path)
 logging.info('Evaluating text-image with ASR/SLT\'s output')
 with torch.no_grad():
     net.eval()
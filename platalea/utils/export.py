@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Exports the encoders of a model to TorchScript
+
+Saves the scripted twin of each encoder of a model (see platalea.scripted) in
+<output>/<encoder>.pt, e.g. SpeechEncoder.pt, which loads with
+`torch.jit.load` in any PyTorch program, without platalea. Speech and text
+encoders are called with a padded batch and the lengths of its sequences,
+image encoders with a batch of image features. The encodings of the exported
+encoders are checked against those of the model on random inputs.
+"""
+
+
+import logging
+import os
+import torch
+
+import platalea.hardware
+from platalea.checkpoint import load_model
+from platalea.experiments.config import get_argument_parser
+from platalea.scripted import script
+from platalea.utils.quantize import ENCODERS
+
+
+def encoders(net):
+    """Returns the encoders of `net` by name, from its submodules named after
+    an encoder."""
+    return {name: module for name, module in net.named_modules()
+            if name.split('.')[-1] in ENCODERS}
+
+
+def _example(encoder):
+    if hasattr(encoder, 'linear_transform'):
+        return (torch.randn(3, encoder.linear_transform.in_features),)
+    if hasattr(encoder, 'Embed'):
+        return (torch.randint(encoder.Embed.num_embeddings, (3, 12)),
+                torch.tensor([12, 9, 5]))
+    conv = encoder.Conv if isinstance(encoder.Conv, torch.nn.Conv1d) else encoder.Conv[0]
+    return (torch.randn(3, conv.in_channels, 200), torch.tensor([200, 150, 100]))
+
+
+def check(encoder, scripted, atol=1e-5):
+    """Raises an error if `scripted` does not compute the same encodings as
+    `encoder` on random inputs."""
+    inputs = _example(encoder)
+    with torch.no_grad():
+        expected, result = encoder(*inputs), scripted(*inputs)
+    if not torch.allclose(expected, result, atol=atol):
+        raise RuntimeError('Scripted encoder differs from the original by up to {}'.format(
+            (expected - result).abs().max().item()))
+
+
+def export(net, output):
+    """Saves the scripted encoders of `net` in directory `output` and returns
+    their paths."""
+    os.makedirs(output, exist_ok=True)
+    paths = []
+    for name, encoder in encoders(net).items():
+        try:
+            scripted = script(encoder)
+        except NotImplementedError as e:
+            logging.warning('{} not exported: {}'.format(name, e))
+            continue
+        check(encoder, scripted)
+        path = os.path.join(output, '{}.pt'.format(name))
+        torch.jit.save(scripted, path)
+        paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
+    args._parser.description = doc[0]
+    args.add_argument('path', metavar='path', help='Model\'s path')
+    args.add_argument(
+        '--output', help='Directory where the encoders are saved'
+        ' (default=<path without .pt>.scripted).', type=str, default=None)
+    args.enable_help()
+    args.parse()
+
+    # Exported on CPU; torch.jit.load(path, map_location=...) moves them
+    platalea.hardware.set_device('cpu')
+    logging.info('Loading model')
+    net = load_model(args.path).eval()
+    output = args.output
+    if output is None:
+        output = (args.path[:-len('.pt')] if args.path.endswith('.pt') else args.path) + '.scripted'
+    for path in export(net, output):
+        logging.info('Encoder saved in {}'.format(path))
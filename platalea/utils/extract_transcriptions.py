@@ -4,6 +4,7 @@ import random
 import torch
 
 import platalea.dataset as D
+from platalea.checkpoint import load_model
 from platalea.experiments.config import get_argument_parser
 
 
@@ -47,7 +48,7 @@ if __name__ == '__main__':
                               split='val', batch_size=batch_size,
                               shuffle=False))
 
-    net = torch.load(args.path)
+    net = load_model(args.path)
 
     trn = {}
     logging.info('Extracting transcriptions')
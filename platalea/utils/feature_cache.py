@@ -0,0 +1,148 @@
+"""
+Cache of the features extracted from the files of a dataset
+
+Features are stored in shards, indexed by the path of the files relative to
+the dataset, with the size and modification time of the files (or the hash of
+their content) to detect those which changed. A cache only holds the features
+of a given feature configuration, so changing the configuration starts a new
+cache.
+"""
+
+
+from collections import defaultdict
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import torch
+
+
+def config_key(config):
+    """Returns a short hash identifying a feature configuration."""
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _content_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class FeatureCache():
+    """Features of the files under `root`, for the feature configuration
+    `config`, cached in `root`/feature_cache/`name`-<config hash>.
+
+    `update` computes the features of the files which are not in the cache or
+    changed since, `shard_size` files at a time, each batch being saved in its
+    own shard. Features are loaded from the shards when accessed.
+    """
+    def __init__(self, root, name, config, content_hash=False, shard_size=1000):
+        self.root = pathlib.Path(root)
+        self.directory = self.root / 'feature_cache' / '{}-{}'.format(name, config_key(config))
+        self.config = config
+        self.content_hash = content_hash
+        self.shard_size = shard_size
+        # Path relative to root -> [shard, position in shard, fingerprint]
+        self.index = {}
+        if (self.directory / 'index.json').exists():
+            with open(self.directory / 'index.json') as f:
+                self.index = json.load(f)
+        self._shard_name = None
+        self._shard = None
+
+    def key(self, path):
+        return pathlib.Path(os.path.relpath(path, self.root)).as_posix()
+
+    def fingerprint(self, path):
+        if self.content_hash:
+            return 'sha1:' + _content_hash(path)
+        stat = os.stat(path)
+        return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+    def verify(self, paths):
+        """Returns the paths whose features are missing from the cache, and
+        those whose features are stale, without computing them."""
+        missing, stale = [], []
+        for path in paths:
+            entry = self.index.get(self.key(path))
+            if entry is None:
+                missing.append(path)
+            elif entry[2] != self.fingerprint(path):
+                stale.append(path)
+        return missing, stale
+
+    def update(self, paths, compute):
+        """Computes the features of the paths which are missing or stale with
+        `compute`, a function returning the features of a list of paths.
+        Returns the number of paths whose features were computed."""
+        missing, stale = self.verify(paths)
+        todo = missing + stale
+        if not todo:
+            return 0
+        logging.info('Computing features of {} files ({} missing, {} stale)'.format(
+            len(todo), len(missing), len(stale)))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.directory / 'config.json', 'w') as f:
+            json.dump(self.config, f)
+        shards = {e[0] for e in self.index.values()}
+        number = max((int(s.split('-')[1].split('.')[0]) for s in shards), default=-1) + 1
+        for start in range(0, len(todo), self.shard_size):
+            batch = todo[start:start + self.shard_size]
+            features = compute(batch)
+            keys = [self.key(p) for p in batch]
+            name = 'shard-{:05d}.pt'.format(number)
+            number += 1
+            self._write(name, dict(keys=keys, features=list(features)))
+            for i, (key, path) in enumerate(zip(keys, batch)):
+                self.index[key] = [name, i, self.fingerprint(path)]
+            # The index is saved after each shard so that an interrupted
+            # update does not lose what was computed
+            self._save_index()
+        self._remove_unused_shards()
+        return len(todo)
+
+    def _write(self, name, obj):
+        path = str(self.directory / name)
+        torch.save(obj, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _save_index(self):
+        path = self.directory / 'index.json'
+        with open(str(path) + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(str(path) + '.tmp', path)
+
+    def _remove_unused_shards(self):
+        used = {e[0] for e in self.index.values()}
+        for path in self.directory.glob('shard-*.pt'):
+            if path.name not in used:
+                path.unlink()
+
+    def __getitem__(self, path):
+        shard, i, _ = self.index[self.key(path)]
+        if shard != self._shard_name:
+            self._shard = torch.load(self.directory / shard)
+            self._shard_name = shard
+        return self._shard['features'][i]
+
+    def features(self, paths):
+        """Returns the features of the given paths, in order, loading each
+        shard once."""
+        positions = defaultdict(list)
+        for j, path in enumerate(paths):
+            shard, i, _ = self.index[self.key(path)]
+            positions[shard].append((j, i))
+        result = [None] * len(paths)
+        for shard, shard_positions in positions.items():
+            features = torch.load(self.directory / shard)['features']
+            for j, i in shard_positions:
+                result[j] = features[i]
+        return result
+
+    def modified(self):
+        """Returns the time the cache was last modified."""
+        path = self.directory / 'index.json'
+        return os.stat(path).st_mtime if path.exists() else None
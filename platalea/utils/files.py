@@ -0,0 +1,43 @@
+"""
+Names and links of the files written by experiments
+"""
+
+
+import os
+from shutil import copyfile
+
+
+def model_fname(epoch, step=None):
+    """Returns the name of the file where the model evaluated at the given
+    epoch, and step if not at the end of the epoch, is saved."""
+    if step is None:
+        return 'net.{}.pt'.format(epoch)
+    return 'net.{}.{}.pt'.format(epoch, step)
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.relpath(src, os.path.dirname(os.path.abspath(dst))), dst)
+
+
+def link_file(src, dst, symlink=True):
+    """Makes `dst` hold the content of `src` without copying it if possible,
+    as a hard link, else as a symbolic link if `symlink` is set, else as a
+    copy. `dst` is replaced at once.
+
+    A symbolic link follows `src` if it is later replaced or removed, which
+    hard links and copies do not.
+    """
+    src, dst = str(src), str(dst)
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    links = [os.link, _symlink] if symlink else [os.link]
+    for link in links:
+        try:
+            link(src, tmp)
+            break
+        except OSError:
+            pass
+    else:
+        copyfile(src, tmp)
+    os.replace(tmp, dst)
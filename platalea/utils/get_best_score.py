@@ -36,6 +36,15 @@ def get_metric_accessor(experiment_type):
         return lambda x: x['SI']['recall']['10']
 
 
+def get_score(result, experiment_type='retrieval'):
+    """Returns the score of a result, the higher the better, using the same
+    metric as get_best_score."""
+    # Keys as in result.json
+    result = json.loads(json.dumps(result))
+    score = get_metric_accessor(experiment_type)(result)
+    return -score if experiment_type == 'asr' else score
+
+
 def get_best_score(result_fpath='result.json', experiment_type='retrieval'):
     res = read_results(result_fpath)
     metric_accessor = get_metric_accessor(experiment_type)
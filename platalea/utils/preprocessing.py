@@ -4,50 +4,122 @@
 Preprocesses datasets
 """
 
+import hashlib
 import json
 import logging
 import numpy as np
+import os
 import pathlib
-import PIL.Image
 import platalea.hardware
-import soundfile
+import time
 import torch
 import torch.nn as nn
-import torchvision.models as models
-import torchvision.transforms as transforms
 from platalea.experiments.config import get_argument_parser
+from platalea.utils.feature_cache import FeatureCache, config_key
 
 
-args = get_argument_parser()
 _audio_feat_config = dict(type='mfcc', delta=True, alpha=0.97, n_filters=40,
                           window_size=0.025, frame_shift=0.010)
 _images_feat_config = dict(model='resnet')
 
 
-def preprocess_flickr8k(dataset_path, audio_subdir, image_subdir):
-    flickr8k_audio_features(pathlib.Path(dataset_path), audio_subdir, _audio_feat_config)
-    flickr8k_image_features(pathlib.Path(dataset_path), image_subdir, _images_feat_config)
+def preprocess_flickr8k(dataset_path, audio_subdir, image_subdir, batch_size=16, workers=0,
+                        content_hash=False):
+    flickr8k_audio_features(pathlib.Path(dataset_path), audio_subdir, _audio_feat_config,
+                            content_hash)
+    flickr8k_image_features(pathlib.Path(dataset_path), image_subdir, _images_feat_config,
+                            batch_size, workers, content_hash)
+
+
+def verify_flickr8k(dataset_path, audio_subdir, image_subdir, content_hash=False):
+    """Reports the files whose cached features are missing or stale.
+    Returns whether all are up to date."""
+    dataset_path = pathlib.Path(dataset_path)
+    up_to_date = True
+    for name, paths, config in [
+            ('mfcc', flickr8k_audio_paths(dataset_path, audio_subdir)[1], _audio_feat_config),
+            ('resnet', flickr8k_image_paths(dataset_path, image_subdir)[1], _images_feat_config)]:
+        cache = FeatureCache(dataset_path, name, config, content_hash)
+        missing, stale = cache.verify(paths)
+        logging.info("{} features: {} files, {} missing, {} stale".format(
+            name, len(paths), len(missing), len(stale)))
+        for path in stale:
+            logging.info("Stale: {}".format(path))
+        up_to_date = up_to_date and not missing and not stale
+    return up_to_date
+
+
+def _assembly_key(cache, files):
+    """Returns a hash identifying the feature configuration and the list of
+    files of assembled features."""
+    return hashlib.sha1(json.dumps([config_key(cache.config), files]).encode()).hexdigest()
+
+
+def _stored_key(fpath):
+    try:
+        # Memory-mapped, so that the features themselves are not read
+        return torch.load(fpath, map_location='cpu', mmap=True, weights_only=False).get('key')
+    except Exception:
+        return None
+
+
+def _assemble(cache, files, paths, fpath, stack=False):
+    """Writes the features of `paths` from `cache` to `fpath` unless it is
+    more recent than the cache and holds the features of the same files,
+    with the same configuration."""
+    key = _assembly_key(cache, files)
+    modified = cache.modified()
+    if fpath.exists() and modified is not None and os.stat(fpath).st_mtime >= modified \
+            and _stored_key(fpath) == key:
+        logging.info("{} is up to date".format(fpath))
+        return
+    features = cache.features(paths)
+    if stack:
+        features = torch.stack(features)
+    torch.save(dict(features=features, filenames=files, key=key), fpath)
 
 
 def preprocess_librispeech(dataset_path):
     librispeech_audio_features(pathlib.Path(dataset_path), _audio_feat_config)
 
 
-def flickr8k_audio_features(dataset_path, audio_subdir, feat_config):
+def flickr8k_audio_paths(dataset_path, audio_subdir):
+    """Returns the names of the audio files, and their paths."""
     directory = dataset_path / audio_subdir
     files = [line.split()[0] for line in open(dataset_path / 'wav2capt.txt')]
-    paths = [directory / fn for fn in files]
-    features = audio_features(paths, feat_config)
-    torch.save(dict(features=features, filenames=files), dataset_path / 'mfcc_features.pt')
+    return files, [directory / fn for fn in files]
 
 
-def flickr8k_image_features(dataset_path, images_subdir, feat_config):
+def flickr8k_image_paths(dataset_path, images_subdir):
+    """Returns the names of the image files, and their paths."""
     directory = dataset_path / images_subdir
     data = json.load(open(dataset_path / 'dataset.json'))
     files = [image['filename'] for image in data['images']]
-    paths = [directory / fn for fn in files]
-    features = torch.stack(image_features(paths, feat_config)).cpu()
-    torch.save(dict(features=features, filenames=files), dataset_path / 'resnet_features.pt')
+    return files, [directory / fn for fn in files]
+
+
+def flickr8k_audio_features(dataset_path, audio_subdir, feat_config, content_hash=False):
+    files, paths = flickr8k_audio_paths(dataset_path, audio_subdir)
+    cache = FeatureCache(dataset_path, 'mfcc', feat_config, content_hash)
+    cache.update(paths, lambda p: audio_features(p, feat_config))
+    _assemble(cache, files, paths, dataset_path / 'mfcc_features.pt')
+
+
+def flickr8k_image_features(dataset_path, images_subdir, feat_config, batch_size=16, workers=0,
+                            content_hash=False):
+    files, paths = flickr8k_image_paths(dataset_path, images_subdir)
+    cache = FeatureCache(dataset_path, 'resnet', feat_config, content_hash)
+    model = []
+
+    def compute(paths):
+        # The model is only loaded if some features are to be computed
+        if not model:
+            model.append(image_model(feat_config))
+        return extract_image_features(model[0], paths, platalea.hardware.device(),
+                                      batch_size, workers)
+
+    cache.update(paths, compute)
+    _assemble(cache, files, paths, dataset_path / 'resnet_features.pt', stack=True)
 
 
 def librispeech_audio_features(dataset_path, feat_config):
@@ -112,47 +184,82 @@ def librispeech_load_trn(path):
     return transcriptions
 
 
-def image_features(paths, config):
+def image_model(config):
+    """Returns the model extracting image features, without its last layer."""
+    import torchvision.models as models
     if config['model'] == 'resnet':
         model = models.resnet152(pretrained=True)
         model = nn.Sequential(*list(model.children())[:-1])
     elif config['model'] == 'vgg19':
         model = models.vgg19_bn(pretrained=True)
         model.classifier = nn.Sequential(*list(model.classifier.children())[:-1])
-    model.to(platalea.hardware.device())
     for p in model.parameters():
         p.requires_grad = False
-    model.eval()
-    device = list(model.parameters())[0].device
-
-    def one(path):
-        logging.info("Extracting features from {}".format(path))
-        im = PIL.Image.open(path)
-        return prep_tencrop(im, model, device)
-
-    return [one(path) for path in paths]
-
-
-def prep_tencrop(im, model, device):
-    # Adapted from: https://github.com/gchrupala/speech2image/blob/master/preprocessing/visual_features.py#L60
-
-    # some functions such as taking the ten crop (four corners, center and
-    # horizontal flip) normalise and resize.
-    tencrop = transforms.TenCrop(224)
-    tens = transforms.ToTensor()
-    normalise = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                     std=[0.229, 0.224, 0.225])
-    resize = transforms.Resize(256, PIL.Image.ANTIALIAS)
-
-    # there are some grayscale images in mscoco and places that the vgg and
-    # resnet networks wont take
-    if im.mode != 'RGB':
-        im = im.convert('RGB')
-    im = tencrop(resize(im))
-    im = torch.cat([normalise(tens(x)).unsqueeze(0) for x in im])
-    im = im.to(device)
-    activations = model(im)
-    return activations.mean(0).squeeze()
+    return model.eval()
+
+
+def image_features(paths, config, batch_size=16, workers=0):
+    model = image_model(config)
+    return extract_image_features(model, paths, platalea.hardware.device(),
+                                  batch_size, workers)
+
+
+class TenCrop():
+    """Resizes an image and returns its ten crops (four corners, center and
+    horizontal flip), normalised, as a tensor of shape (10, 3, 224, 224)."""
+    def __init__(self):
+        # Adapted from: https://github.com/gchrupala/speech2image/blob/master/preprocessing/visual_features.py#L60
+        import PIL.Image
+        import torchvision.transforms as transforms
+        self.resize = transforms.Resize(256, PIL.Image.LANCZOS)
+        self.tencrop = transforms.TenCrop(224)
+        self.tens = transforms.ToTensor()
+        self.normalise = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                              std=[0.229, 0.224, 0.225])
+
+    def __call__(self, im):
+        # there are some grayscale images in mscoco and places that the vgg
+        # and resnet networks wont take
+        if im.mode != 'RGB':
+            im = im.convert('RGB')
+        im = self.tencrop(self.resize(im))
+        return torch.stack([self.normalise(self.tens(x)) for x in im])
+
+
+class ImageCrops(torch.utils.data.Dataset):
+    """Images decoded and cropped by the workers of a DataLoader."""
+    def __init__(self, paths):
+        self.paths = paths
+        self.transform = TenCrop()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        import PIL.Image
+        with PIL.Image.open(self.paths[i]) as im:
+            return self.transform(im)
+
+
+def extract_image_features(model, paths, device, batch_size=16, workers=0):
+    """Returns the features of the images in `paths`, averaged over their ten
+    crops. Images are decoded and cropped in `workers` processes while the
+    crops of `batch_size` images at a time go through the model."""
+    model = model.to(device, memory_format=torch.channels_last)
+    loader = torch.utils.data.DataLoader(
+        ImageCrops(paths), batch_size=batch_size, num_workers=workers,
+        pin_memory=device.type == 'cuda')
+    features = []
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for crops in loader:
+            n = crops.shape[0]
+            crops = crops.flatten(0, 1).to(device, non_blocking=True)
+            activations = model(crops.contiguous(memory_format=torch.channels_last))
+            features.extend(activations.view(n, 10, -1).mean(1).cpu())
+            logging.info("Extracted features from {}/{} images ({:.1f} images/s)".format(
+                len(features), len(paths), len(features) / (time.perf_counter() - start)))
+    return features
 
 
 def fix_wav(path):
@@ -182,6 +289,7 @@ def fix_wav(path):
 def audio_features(paths, config):
     # Adapted from https://github.com/gchrupala/speech2image/blob/master/preprocessing/audio_features.py#L45
     from platalea.audio.features import get_fbanks, get_freqspectrum, get_mfcc, delta, raw_frames
+    import soundfile
     if config['type'] != 'mfcc' and config['type'] != 'fbank':
         raise NotImplementedError()
     output = []
@@ -220,14 +328,34 @@ def audio_features(paths, config):
 if __name__ == '__main__':
     # Parsing command line
     doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
     args._parser.description = doc[0]
     args.add_argument(
         'dataset_name', help='Name of the dataset to preprocess.',
         type=str, choices=['flickr8k', 'librispeech'])
+    args.add_argument(
+        '--image_batch_size', type=int, default=16,
+        help='Number of images whose crops go through the image model at once.')
+    args.add_argument(
+        '--image_workers', type=int, default=min(4, os.cpu_count()),
+        help='Number of processes decoding and cropping images.')
+    args.add_argument(
+        '--content_hash', action='store_true',
+        help='Detect changed files by the hash of their content rather than \
+        by their size and modification time.')
+    args.add_argument(
+        '--verify', action='store_true',
+        help='Only report the files whose cached features are missing or \
+        stale.')
     args.enable_help()
     args.parse()
 
-    if args.dataset_name == "flickr8k":
-        preprocess_flickr8k(args.flickr8k_root, args.flickr8k_audio_subdir, args.flickr8k_image_subdir)
+    if args.dataset_name == "flickr8k" and args.verify:
+        if not verify_flickr8k(args.flickr8k_root, args.flickr8k_audio_subdir,
+                               args.flickr8k_image_subdir, args.content_hash):
+            exit(1)
+    elif args.dataset_name == "flickr8k":
+        preprocess_flickr8k(args.flickr8k_root, args.flickr8k_audio_subdir, args.flickr8k_image_subdir,
+                            args.image_batch_size, args.image_workers, args.content_hash)
     elif args.dataset_name == "librispeech":
         preprocess_librispeech(args.librispeech_root)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Quantizes a model for CPU inference
+
+Applies dynamic int8 quantization to the recurrent and linear layers of the
+speech, text and image encoders of a model, and saves the quantized model,
+which loads like any other. Reports how much the retrieval scores (recall@k
+and median rank) on the validation set drift from those of the fp32 model,
+and the time each model takes to be scored.
+"""
+
+
+import copy
+import json
+import logging
+import time
+import torch
+import torch.nn as nn
+
+import platalea.dataset as D
+import platalea.hardware
+import platalea.score
+from platalea.checkpoint import load_model
+from platalea.experiments.config import get_argument_parser
+
+
+ENCODERS = ['SpeechEncoder', 'TextEncoder', 'ImageEncoder']
+QUANTIZED_LAYERS = {nn.GRU, nn.LSTM, nn.Linear}
+
+
+def quantize(net):
+    """Returns a copy of `net` on CPU whose encoders have their recurrent and
+    linear layers quantized to int8, their activations being quantized on
+    the fly."""
+    net = copy.deepcopy(net).cpu().eval()
+    for module in list(net.modules()):
+        for name, child in list(module.named_children()):
+            if name in ENCODERS:
+                setattr(module, name, torch.ao.quantization.quantize_dynamic(
+                    child, QUANTIZED_LAYERS, dtype=torch.qint8))
+    return net
+
+
+def score_fn(net):
+    """Returns the retrieval score function matching the embeddings `net`
+    computes."""
+    if hasattr(net, 'embed_image') and hasattr(net, 'embed_audio'):
+        return platalea.score.score
+    if hasattr(net, 'embed_image') and hasattr(net, 'embed_text'):
+        return platalea.score.score_text_image
+    if hasattr(net, 'embed_audio') and hasattr(net, 'embed_text'):
+        return platalea.score.score_speech_text
+    raise ValueError('{} is not a retrieval model'.format(type(net).__name__))
+
+
+def drift(reference, result):
+    """Returns the difference between the scores of `result` and those of
+    `reference`."""
+    return dict(medr=result['medr'] - reference['medr'],
+                recall={k: result['recall'][k] - reference['recall'][k]
+                        for k in reference['recall']})
+
+
+def compare(net, quantized, dataset):
+    """Scores `net` and its quantized version on `dataset`."""
+    report = {}
+    for name, model in [('fp32', net), ('int8', quantized)]:
+        start = time.perf_counter()
+        with torch.no_grad():
+            report[name] = score_fn(model)(model, dataset)
+        report[name]['time'] = time.perf_counter() - start
+    report['drift'] = drift(report['fp32'], report['int8'])
+    return report
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
+    args._parser.description = doc[0]
+    args.add_argument('path', metavar='path', help='Model\'s path')
+    args.add_argument(
+        '--output', help='Path where the quantized model is saved'
+        ' (default=<path without .pt>.int8.pt).', type=str, default=None)
+    args.enable_help()
+    args.parse()
+
+    # Quantized layers run on CPU only
+    platalea.hardware.set_device('cpu')
+    logging.info('Loading model')
+    net = load_model(args.path).eval()
+    logging.info('Quantizing model')
+    quantized = quantize(net)
+    output = args.output
+    if output is None:
+        output = (args.path[:-len('.pt')] if args.path.endswith('.pt') else args.path) + '.int8.pt'
+    torch.save(quantized, output)
+    logging.info('Quantized model saved in {}'.format(output))
+
+    logging.info('Loading data')
+    data = D.flickr8k_loader(args.flickr8k_root, args.flickr8k_meta,
+                             args.flickr8k_language, args.audio_features_fn,
+                             split='val', batch_size=16, shuffle=False)
+    print(json.dumps(compare(net, quantized, data.dataset)))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+"""
+Serves a model over HTTP
+
+Loads a saved model and answers requests to embed speech or images, or to
+transcribe speech, depending on the model. Concurrent requests are gathered
+in micro-batches: a batch is run as soon as it has --max_batch_size requests,
+or --max_latency seconds after its first request arrived. Batches run one at
+a time in a worker thread, while new requests are queued. The server listens
+on --host and --port, or on a Unix socket with --socket, and only depends on
+the standard library. As when evaluating models, the padding of the
+utterances of a batch slightly changes their embeddings, as attention pooling
+does not mask it.
+
+Requests are POST requests to /embed_audio, /embed_image or /transcribe, with
+the features of an utterance (frames x channels) or of an image as a JSON
+object {"features": [...]}, or as a NumPy .npy file with content type
+application/octet-stream. Responses are JSON objects, {"embedding": [...]} or
+{"transcript": "..."}. Features of the wrong shape are rejected with status
+400, and when a batch fails, its requests are retried one at a time, so that
+only the faulty ones fail. GET /stats returns the number of requests and
+batches, the mean batch size, the throughput since the server started and the
+median and 99th percentile latency of each endpoint, in seconds.
+"""
+
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import logging
+import signal
+import time
+import numpy as np
+import torch
+
+from platalea.checkpoint import load_model
+from platalea.experiments.config import get_argument_parser
+import platalea.hardware
+
+
+# Endpoint -> (method of the model, key of the results)
+ENDPOINTS = dict(embed_audio=('embed_audio', 'embedding'),
+                 embed_image=('embed_image', 'embedding'),
+                 transcribe=('transcribe', 'transcript'))
+# Endpoint -> (encoder of the model, number of dimensions of the features)
+INPUTS = dict(embed_audio=('SpeechEncoder', 2), embed_image=('ImageEncoder', 1),
+              transcribe=('SpeechEncoder', 2))
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+          500: 'Internal Server Error'}
+
+
+class LatencyStats():
+    """Counts requests and batches, and keeps the latency of the last
+    `window` requests."""
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.start = time.perf_counter()
+
+    def record(self, latencies):
+        self.latencies.extend(latencies)
+        self.requests += len(latencies)
+        self.batches += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        result = dict(requests=self.requests, batches=self.batches,
+                      mean_batch_size=self.requests / max(self.batches, 1),
+                      throughput=self.requests / elapsed)
+        if self.latencies:
+            p50, p99 = np.percentile(self.latencies, [50, 99])
+            result.update(p50_latency=p50, p99_latency=p99)
+        return result
+
+
+class MicroBatcher():
+    """Gathers the items submitted concurrently into batches, which `fn`
+    processes in `executor`. A batch is processed once it has
+    `max_batch_size` items, or `max_latency` seconds after its first item was
+    submitted."""
+    def __init__(self, fn, executor, max_batch_size=32, max_latency=0.01):
+        self.fn = fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = asyncio.Queue()
+        self.stats = LatencyStats()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future, time.perf_counter()))
+        return await future
+
+    async def _batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                else:
+                    # Past the deadline, only requests already queued join
+                    batch.append(self.queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.fn,
+                                                     [item for item, _, _ in batch])
+            except Exception as e:
+                if len(batch) == 1:
+                    results = [e]
+                else:
+                    # Items are retried one at a time, so that only those
+                    # failing on their own fail
+                    results = [await self._run_one(item) for item, _, _ in batch]
+            end = time.perf_counter()
+            for (_, future, _), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self.stats.record([end - start for _, _, start in batch])
+
+    async def _run_one(self, item):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.fn, [item])
+            return results[0]
+        except Exception as e:
+            return e
+
+
+def _model_fn(net, method):
+    def fn(items):
+        with torch.no_grad():
+            results = getattr(net, method)([torch.from_numpy(i) for i in items])
+        return [r.tolist() if isinstance(r, np.ndarray) else str(r) for r in results]
+    return fn
+
+
+def _input_size(encoder):
+    """Returns the number of channels or features of the inputs of
+    `encoder`, or None if its first layer does not constrain them."""
+    for module in encoder.modules():
+        if isinstance(module, torch.nn.Conv1d):
+            return module.in_channels
+        if isinstance(module, torch.nn.Linear):
+            return module.in_features
+        if isinstance(module, torch.nn.Conv2d):
+            return None
+    return None
+
+
+def _features(body, content_type, ndim, size=None):
+    """Returns the features of a request, checking they have `ndim`
+    dimensions, the last one of size `size` if given."""
+    if content_type == 'application/octet-stream':
+        features = np.load(io.BytesIO(body), allow_pickle=False)
+    else:
+        features = np.asarray(json.loads(body)['features'])
+    if features.ndim != ndim or features.size == 0:
+        raise ValueError('expected a non-empty array with {} dimensions, got shape {}'.format(
+            ndim, features.shape))
+    if size is not None and features.shape[-1] != size:
+        raise ValueError('expected {} features per {}, got {}'.format(
+            size, 'frame' if ndim == 2 else 'item', features.shape[-1]))
+    return features.astype(np.float32)
+
+
+class Server():
+    """HTTP server of the endpoints `net` supports, each with its own
+    micro-batcher, all batches running in the same worker thread."""
+    def __init__(self, net, max_batch_size=32, max_latency=0.01):
+        self.executor = ThreadPoolExecutor(1)
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.batchers = None
+        self.tasks = []
+        # Endpoint -> (number of dimensions, size of the last dimension)
+        self.inputs = {}
+        for name, (encoder, ndim) in INPUTS.items():
+            encoder = getattr(net, encoder, None)
+            self.inputs[name] = ndim, None if encoder is None else _input_size(encoder)
+
+    def start_batchers(self):
+        self.batchers = {
+            name: MicroBatcher(_model_fn(self.net, method), self.executor,
+                               self.max_batch_size, self.max_latency)
+            for name, (method, _) in ENDPOINTS.items() if hasattr(self.net, method)}
+        self.tasks = [asyncio.ensure_future(b.run()) for b in self.batchers.values()]
+
+    def stats(self):
+        return {name: b.stats.summary() for name, b in self.batchers.items()}
+
+    async def respond(self, method, path, headers, body):
+        """Returns the status and JSON response to a request."""
+        name = path.strip('/')
+        if method == 'GET' and name == 'stats':
+            return 200, self.stats()
+        if name not in self.batchers:
+            return 404, dict(error='Unknown endpoint: {}'.format(path))
+        if method != 'POST':
+            return 405, dict(error='Expected a POST request')
+        try:
+            features = _features(body, headers.get('content-type'), *self.inputs[name])
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, dict(error='Invalid features: {}'.format(e))
+        try:
+            result = await self.batchers[name].submit(features)
+        except Exception as e:
+            logging.exception('Request to {} failed'.format(path))
+            return 500, dict(error=str(e))
+        return 200, {ENDPOINTS[name][1]: result}
+
+    async def handle(self, reader, writer):
+        """Answers the requests of a connection, which is kept alive unless
+        the client asks otherwise."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line.strip():
+                    break
+                method, path, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    key, value = line.split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response = await self.respond(method, path, headers, body)
+                content = json.dumps(response).encode()
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n'
+                             'Content-Length: {}\r\n\r\n'.format(
+                                 status, STATUS[status], len(content)).encode() + content)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8000, socket=None):
+        """Starts the batchers and the server, and returns the latter."""
+        self.start_batchers()
+        if socket is not None:
+            return await asyncio.start_unix_server(self.handle, path=socket)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self):
+        """Stops the batchers."""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def close(self):
+        self.executor.shutdown()
+
+
+async def _serve(server, host, port, socket):
+    http = await server.start(host, port, socket)
+    logging.info('Serving {} on {}'.format(
+        ', '.join('/' + name for name in server.batchers),
+        socket or '{}:{}'.format(host, port)))
+    task = asyncio.current_task()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, task.cancel)
+        except NotImplementedError:
+            # Not supported on Windows, where Ctrl+C still interrupts
+            pass
+    try:
+        async with http:
+            await http.serve_forever()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    args = get_argument_parser()
+    args._parser.description = doc[0]
+    args.add_argument('path', metavar='path', help='Model\'s path')
+    args.add_argument(
+        '--host', help='Address to listen on (default=127.0.0.1).', type=str,
+        default='127.0.0.1')
+    args.add_argument(
+        '--port', help='Port to listen on (default=8000).', type=int, default=8000)
+    args.add_argument(
+        '--socket', help='Unix socket to listen on instead of a port.', type=str,
+        default=None)
+    args.add_argument(
+        '--max_batch_size', help='Maximum number of requests in a batch'
+        ' (default=32).', type=int, default=32)
+    args.add_argument(
+        '--max_latency', help='Maximum time, in seconds, the first request of'
+        ' a batch waits for others (default=0.01).', type=float, default=0.01)
+    args.enable_help()
+    args.parse()
+
+    platalea.hardware.set_device(args.device)
+    logging.info('Loading model')
+    server = Server(load_model(args.path).eval(), args.max_batch_size, args.max_latency)
+    try:
+        asyncio.run(_serve(server, args.host, args.port, args.socket))
+    finally:
+        if server.batchers is not None:
+            logging.info('Statistics: {}'.format(json.dumps(server.stats())))
+        server.close()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+"""
+Runs a hyperparameter sweep on local processes
+
+Reads a sweep configuration in the format of wandb sweeps (see
+wandb_sweep.yaml) and runs its trials as subprocesses, each in its own
+directory, a given number at a time. With `early_terminate` set to hyperband,
+trials are stopped by asynchronous successive halving (ASHA): when a trial
+reaches one of the milestones, counted in evaluations (lines of result.json),
+it only goes on if its best score so far is among the top 1/eta of all trials
+having reached that milestone. Options not recognized are passed on to all
+trials, the relative paths of --config, --flickr8k_root and --librispeech_root
+being made absolute, as trials do not run in the current directory. A summary table of the trials is written to summary.tsv.
+"""
+
+
+import argparse
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+import yaml
+
+from platalea.utils.get_best_score import get_score
+
+
+class SuccessiveHalving():
+    """Asynchronous successive halving: decides whether trials reaching a
+    milestone (rung) go on, given the scores of all trials having reached it
+    before."""
+    def __init__(self, rungs, eta=3):
+        self.rungs = sorted(rungs)
+        self.eta = eta
+        self.scores = {r: [] for r in self.rungs}
+
+    @classmethod
+    def from_config(cls, config):
+        """Computes the milestones from either `min_iter` or `max_iter` and
+        `s`, as the hyperband early termination of wandb."""
+        eta = config.get('eta', 3)
+        if 'min_iter' in config:
+            rungs = [config['min_iter'] * eta ** i
+                     for i in range(config.get('s', 3))]
+        elif 'max_iter' in config:
+            rungs = [config['max_iter'] // eta ** i
+                     for i in range(1, config.get('s', 1) + 1)]
+        else:
+            raise ValueError('Hyperband early termination needs min_iter or '
+                             'max_iter')
+        return cls([r for r in rungs if r > 0], eta)
+
+    def report(self, iteration, score):
+        """Records the best score of a trial after `iteration` evaluations.
+        Returns whether the trial should go on."""
+        if iteration not in self.scores:
+            return True
+        scores = self.scores[iteration]
+        scores.append(score)
+        rank = sorted(scores, reverse=True).index(score)
+        return rank < math.ceil(len(scores) / self.eta)
+
+
+def _values(spec):
+    if 'value' in spec:
+        return [spec['value']]
+    if 'values' in spec:
+        return list(spec['values'])
+    return None
+
+
+def _sample(spec, rng):
+    values = _values(spec)
+    if values is not None:
+        return rng.choice(values)
+    distribution = spec.get('distribution')
+    if distribution is None:
+        is_int = isinstance(spec['min'], int) and isinstance(spec['max'], int)
+        distribution = 'int_uniform' if is_int else 'uniform'
+    if distribution == 'int_uniform':
+        return rng.randint(spec['min'], spec['max'])
+    if distribution == 'uniform':
+        return rng.uniform(spec['min'], spec['max'])
+    if distribution == 'log_uniform_values':
+        return math.exp(rng.uniform(math.log(spec['min']),
+                                    math.log(spec['max'])))
+    raise ValueError('Unsupported distribution: {}'.format(distribution))
+
+
+def trial_parameters(sweep, count=None, seed=123):
+    """Returns the parameters of the trials of a sweep: all combinations for
+    the grid method, `count` samples for the random method."""
+    parameters = sweep.get('parameters', {})
+    method = sweep.get('method', 'grid')
+    if method == 'grid':
+        names = list(parameters)
+        values = []
+        for n in names:
+            v = _values(parameters[n])
+            if v is None:
+                raise ValueError('Grid search needs the values of {}'.format(n))
+            values.append(v)
+        trials = [dict(zip(names, c)) for c in itertools.product(*values)]
+        return trials[:count]
+    if method == 'random':
+        if count is None:
+            raise ValueError('Random search needs a number of trials')
+        rng = random.Random(seed)
+        return [{n: _sample(s, rng) for n, s in parameters.items()}
+                for _ in range(count)]
+    raise ValueError('Unsupported sweep method: {}'.format(method))
+
+
+def program_command(program):
+    """Returns the command running the program of a sweep, given as a module
+    (platalea.experiments.flickr8k.basic) or a path."""
+    path = program.replace('\\', '/')
+    if path.endswith('.py'):
+        if not path.startswith('platalea/'):
+            return [sys.executable, os.path.abspath(path)]
+        path = path[:-len('.py')]
+    return [sys.executable, '-m', path.replace('/', '.')]
+
+
+# Options of the experiments taking paths relative to the working directory,
+# the other paths (e.g. flickr8k_meta) being relative to the dataset root
+PATH_OPTIONS = ['config', 'flickr8k_root', 'librispeech_root']
+
+
+def _absolute(path, directory):
+    return os.path.normpath(os.path.join(directory, os.path.expanduser(path)))
+
+
+def absolute_parameters(parameters, directory):
+    """Returns the parameters with the paths of PATH_OPTIONS made absolute
+    against `directory`."""
+    return {k: _absolute(v, directory) if k in PATH_OPTIONS and isinstance(v, str) else v
+            for k, v in parameters.items()}
+
+
+def absolute_args(args, directory):
+    """Returns the command line arguments with the paths of PATH_OPTIONS,
+    given as --option=path or --option path, made absolute against
+    `directory`."""
+    flags = {'--' + o for o in PATH_OPTIONS} | {'-c'}
+    result = []
+    path_next = False
+    for arg in args:
+        if path_next:
+            arg = _absolute(arg, directory)
+            path_next = False
+        else:
+            name, sep, value = arg.partition('=')
+            if name in flags:
+                if sep:
+                    arg = '{}={}'.format(name, _absolute(value, directory))
+                else:
+                    path_next = True
+        result.append(arg)
+    return result
+
+
+def parameter_args(parameters):
+    args = []
+    for k, v in parameters.items():
+        if v is True:
+            args.append('--{}'.format(k))
+        elif v is not False and v is not None:
+            args.append('--{}={}'.format(k, v))
+    return args
+
+
+def experiment_type(sweep):
+    """Returns the type of experiment scoring the trials: the metric name if
+    it is one get_best_score knows, else guessed from the program."""
+    name = sweep.get('metric', {}).get('name')
+    if name in ['retrieval', 'asr', 'slt', 'mtl']:
+        return name
+    program = os.path.basename(sweep['program'].replace('\\', '/'))
+    if program.startswith('mtl'):
+        return 'mtl'
+    if program.startswith('asr'):
+        return 'asr'
+    return 'retrieval'
+
+
+class Trial():
+    def __init__(self, number, parameters, path):
+        self.number = number
+        self.parameters = parameters
+        self.path = path
+        self.process = None
+        self.status = 'pending'
+        self.evaluations = 0
+        self.best_score = None
+        self.offset = 0
+
+    def start(self, command, env):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, 'log.txt'), 'w') as log:
+            # In its own session so that its subprocesses are stopped with it
+            self.process = subprocess.Popen(
+                command + parameter_args(self.parameters), cwd=self.path,
+                stdout=log, stderr=subprocess.STDOUT, env=env,
+                start_new_session=True)
+        self.status = 'running'
+
+    def new_results(self):
+        """Returns the results written since the last call, ignoring a line
+        being written."""
+        fpath = os.path.join(self.path, 'result.json')
+        if not os.path.exists(fpath):
+            return []
+        with open(fpath, 'rb') as f:
+            f.seek(self.offset)
+            lines = f.read()
+        lines = lines[:lines.rfind(b'\n') + 1]
+        self.offset += len(lines)
+        return [json.loads(line) for line in lines.decode().splitlines()
+                if line.strip()]
+
+    def stop(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.status = 'stopped'
+
+
+def _update(trial, scheduler, experiment_type):
+    """Processes the new results of a trial. Returns whether it should go
+    on."""
+    go_on = True
+    for result in trial.new_results():
+        trial.evaluations += 1
+        score = get_score(result, experiment_type)
+        if trial.best_score is None or score > trial.best_score:
+            trial.best_score = score
+        if scheduler is not None and go_on:
+            go_on = scheduler.report(trial.evaluations, trial.best_score)
+    return go_on
+
+
+def run_sweep(sweep, sweep_dir='sweep', slots=1, count=None, extra_args=(),
+              devices=None, poll_interval=10, seed=123):
+    """Runs the trials of a sweep, at most `slots` at a time, and returns
+    them. Trial i runs in `sweep_dir`/trial-i, with the devices of its slot
+    visible if `devices` is given. Relative paths of the data and
+    configuration files are resolved against the current directory."""
+    cwd = os.getcwd()
+    command = program_command(sweep['program']) + absolute_args(extra_args, cwd)
+    etype = experiment_type(sweep)
+    early_terminate = sweep.get('early_terminate')
+    scheduler = None
+    if early_terminate is not None:
+        if early_terminate.get('type') != 'hyperband':
+            raise ValueError('Unsupported early termination: {}'.format(
+                early_terminate.get('type')))
+        scheduler = SuccessiveHalving.from_config(early_terminate)
+        logging.info('Successive halving milestones: {}'.format(scheduler.rungs))
+    trials = [Trial(i, absolute_parameters(p, cwd), os.path.join(sweep_dir, 'trial-{}'.format(i)))
+              for i, p in enumerate(trial_parameters(sweep, count, seed))]
+    pending = list(trials)
+    running = {}
+    # Trials run in their own directory but use the same platalea
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    pythonpath = os.pathsep.join(p for p in [root, os.environ.get('PYTHONPATH')] if p)
+    while pending or running:
+        for slot in range(slots):
+            if slot not in running and pending:
+                trial = pending.pop(0)
+                env = dict(os.environ, PYTHONPATH=pythonpath)
+                if devices is not None:
+                    env['CUDA_VISIBLE_DEVICES'] = devices[slot % len(devices)]
+                logging.info('Starting trial {} {}'.format(
+                    trial.number, trial.parameters))
+                trial.start(command, env)
+                running[slot] = trial
+        time.sleep(poll_interval)
+        for slot, trial in list(running.items()):
+            returncode = trial.process.poll()
+            if not _update(trial, scheduler, etype):
+                logging.info('Stopping trial {} after {} evaluations'.format(
+                    trial.number, trial.evaluations))
+                trial.stop()
+            elif returncode is not None:
+                trial.status = 'finished' if returncode == 0 else 'failed'
+                logging.info('Trial {} {}'.format(trial.number, trial.status))
+            else:
+                continue
+            del running[slot]
+    write_summary(trials, os.path.join(sweep_dir, 'summary.tsv'))
+    return trials
+
+
+def write_summary(trials, fpath):
+    """Writes a table of the trials, ranked by best score, to `fpath` as
+    tab-separated values."""
+    names = sorted({n for t in trials for n in t.parameters})
+    header = ['trial', 'status', 'evaluations', 'best_score'] + names
+    rows = []
+    ranked = sorted(trials, key=lambda t: (t.best_score is None,
+                                           -(t.best_score or 0)))
+    for t in ranked:
+        rows.append([t.number, t.status, t.evaluations, t.best_score] +
+                    [t.parameters.get(n, '') for n in names])
+    with open(fpath, 'w') as f:
+        for row in [header] + rows:
+            print('\t'.join(str(v) for v in row), file=f)
+
+
+def print_summary(fpath):
+    """Prints the summary written by `write_summary` as an aligned table."""
+    with open(fpath) as f:
+        rows = [line.split('\t') for line in f.read().splitlines()]
+    widths = [max(len(r[i]) for r in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    # Parsing command line
+    doc = __doc__.strip("\n").split("\n", 1)
+    parser = argparse.ArgumentParser(description=doc[0], epilog=doc[1])
+    parser.add_argument(
+        'config', help='Path to the YAML sweep configuration.', type=str)
+    parser.add_argument(
+        '--slots', help='Number of trials running at the same time'
+        ' (default=1).', type=int, default=1)
+    parser.add_argument(
+        '--count', help='Number of trials; required for random search.',
+        type=int, default=None)
+    parser.add_argument(
+        '--sweep_dir', help='Directory of the trials (default=sweep).',
+        type=str, default='sweep')
+    parser.add_argument(
+        '--devices', help='Comma-separated CUDA devices assigned in turn to'
+        ' the slots.', type=str, default=None)
+    parser.add_argument(
+        '--poll_interval', help='Seconds between two reads of the results'
+        ' of the trials (default=10).', type=float, default=10)
+    parser.add_argument(
+        '--seed', help='Seed of the random search (default=123).', type=int,
+        default=123)
+    args, extra_args = parser.parse_known_args()
+
+    with open(args.config) as f:
+        sweep = yaml.safe_load(f)
+    devices = args.devices.split(',') if args.devices else None
+    run_sweep(sweep, args.sweep_dir, args.slots, args.count, extra_args,
+              devices, args.poll_interval, args.seed)
+    print_summary(os.path.join(args.sweep_dir, 'summary.tsv'))
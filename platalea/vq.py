@@ -47,12 +47,16 @@ class VQEmbeddingEMA(nn.Module):
         M, D = self.embedding.size()
         # unpack packed_sequence
         x, l = nn.utils.rnn.pad_packed_sequence(x, batch_first=True)
+        # The codebook and its EMA statistics are kept in fp32, also when the
+        # surrounding model runs under autocast
+        x = x.float()
         x_flat = x.detach().reshape(-1, D)
 
-        distances = torch.addmm(torch.sum(self.embedding ** 2, dim=1) +
-                                torch.sum(x_flat ** 2, dim=1, keepdim=True),
-                                x_flat, self.embedding.t(),
-                                alpha=-2.0, beta=1.0)
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            distances = torch.addmm(torch.sum(self.embedding ** 2, dim=1) +
+                                    torch.sum(x_flat ** 2, dim=1, keepdim=True),
+                                    x_flat, self.embedding.t(),
+                                    alpha=-2.0, beta=1.0)
 
         indices = torch.argmin(distances.float(), dim=-1)
         encodings = F.one_hot(indices, M).float()
@@ -65,7 +69,8 @@ class VQEmbeddingEMA(nn.Module):
             n = torch.sum(self.ema_count)
             self.ema_count = (self.ema_count + self.epsilon) / (n + M * self.epsilon) * n
 
-            dw = torch.matmul(encodings.t(), x_flat)
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                dw = torch.matmul(encodings.t(), x_flat)
             self.ema_weight = self.decay * self.ema_weight + (1 - self.decay) * dw
 
             self.embedding = self.ema_weight / self.ema_count.unsqueeze(-1)
@@ -1,6 +1,5 @@
 import glob
 from platalea.utils.preprocessing import audio_features
-from zerospeech2020.evaluation import evaluation_2019
 import logging
 import os
 import os.path
@@ -10,7 +9,87 @@ import torch
 config = dict(type='mfcc', delta=True, alpha=0.97, n_filters=40,  window_size=0.025, frame_shift=0.010)
 
 
-def encode(net, datadir, outdir):
+def _code_dtype(num_codes):
+    return np.int16 if num_codes <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def run_length_encode(codes):
+    """Returns the values and lengths of the runs of repeated codes."""
+    if len(codes) == 0:
+        return codes, np.zeros(0, dtype=np.int32)
+    starts = np.flatnonzero(np.concatenate([[True], codes[1:] != codes[:-1]]))
+    lengths = np.diff(np.concatenate([starts, [len(codes)]]))
+    return codes[starts], lengths
+
+
+def write_codes(path, names, codes, num_codes, rle=False):
+    """Writes the code indices of utterances to a single .npz file: the codes
+    of all utterances concatenated, as int16 if possible, with the offsets of
+    each utterance. With `rle`, runs of repeated codes are stored as their
+    value and length, which saves space when runs are long."""
+    dtype = _code_dtype(num_codes)
+    arrays = dict(names=np.asarray(names), num_codes=num_codes)
+    if rle:
+        runs = [run_length_encode(np.asarray(c)) for c in codes]
+        codes = [v for v, _ in runs]
+        lengths = np.concatenate([n for _, n in runs]) if runs else np.zeros(0, np.int32)
+        # Lengths take the smallest unsigned type holding the longest run
+        arrays['lengths'] = lengths.astype(np.min_scalar_type(lengths.max(initial=0)))
+    arrays['offsets'] = np.concatenate([[0], np.cumsum([len(c) for c in codes])]).astype(np.int64)
+    arrays['codes'] = np.concatenate(codes).astype(dtype) if codes else np.zeros(0, dtype)
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class Codes():
+    """Code indices of utterances written by `write_codes`, accessed by
+    position or name. One-hot matrices are only built on request."""
+    def __init__(self, path):
+        with np.load(path) as arrays:
+            self.names = list(arrays['names'])
+            self.num_codes = int(arrays['num_codes'])
+            self.offsets = arrays['offsets']
+            self.codes = arrays['codes']
+            self.lengths = arrays['lengths'] if 'lengths' in arrays else None
+        self.positions = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, key):
+        i = self.positions[key] if isinstance(key, str) else key
+        codes = self.codes[self.offsets[i]:self.offsets[i + 1]]
+        if self.lengths is None:
+            return codes
+        return np.repeat(codes, self.lengths[self.offsets[i]:self.offsets[i + 1]])
+
+    def one_hot(self, key):
+        codes = self[key]
+        one_hot = np.zeros((len(codes), self.num_codes), dtype=np.uint8)
+        one_hot[np.arange(len(codes)), codes] = 1
+        return one_hot
+
+    def items(self):
+        for i, name in enumerate(self.names):
+            yield name, self[i]
+
+
+def write_text(codes, outdir, one_hot=True):
+    """Writes the codes of each utterance to <outdir>/<name>.txt, one frame per
+    line, as expected by the ZeroSpeech evaluation, from codes written by
+    `write_codes`."""
+    if not isinstance(codes, Codes):
+        codes = Codes(codes)
+    os.makedirs(outdir, exist_ok=True)
+    for i, name in enumerate(codes.names):
+        code = codes.one_hot(i) if one_hot else codes[i][:, None]
+        assert code.shape[0] > 0
+        np.savetxt(os.path.join(outdir, name + '.txt'), code, fmt='%d')
+
+
+def encode(net, datadir, outdir, rle=False, level=0):
+    """Writes the codes of the utterances in `datadir` for the codebook
+    `level` to <outdir>/codes.npz and returns its path."""
     paths = glob.glob(datadir + "/*.wav")
     assert len(paths) > 0
     try:
@@ -21,19 +100,22 @@ def encode(net, datadir, outdir):
         logging.info("Saving preprocessed data")
         torch.save(feat, str(datadir) + "_audiofeat.pt")
     logging.info("Computing codes")
-    codes = net.code_audio(feat, one_hot=True)
-    for path, code in zip(paths, codes):
-        filename = os.path.splitext(os.path.basename(path))[0]
-        out = outdir + '/' + filename + ".txt"
-        assert code.shape[0] > 0
-        np.savetxt(out, code.astype(int), fmt='%d')
+    codes = net.code_audio(feat, level=level)
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    num_codes = net.SpeechEncoder.codebooks()[level].embedding.size(0)
+    out = os.path.join(outdir, 'codes.npz')
+    write_codes(out, names, codes, num_codes, rle=rle)
+    return out
 
 
 def encode_zerospeech(net, outdir='.'):
-    encode(net, "/roaming/gchrupal/verdigris/platalea.vq/data/2020/2019/english/test/")
+    codes = encode(net, "/roaming/gchrupal/verdigris/platalea.vq/data/2020/2019/english/test/", outdir)
+    # The evaluation reads one text file of one-hot codes per utterance
+    write_text(codes, outdir)
 
 
 def evaluate_zerospeech(net, outdir='.'):
+    from zerospeech2020.evaluation import evaluation_2019
     encode_zerospeech(net, outdir=outdir)
     logging.info("Data encoded")
     logging.info("Evaluating")
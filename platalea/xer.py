@@ -1,48 +1,62 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+
 def nbeditops(s1, s2):
     import Levenshtein as L
-    d = 0
-    i = 0
-    s = 0
-    for op in L.editops(s1, s2):
-        if op[0] == 'delete':
-            d += 1
-        elif op[0] == 'insert':
-            i += 1
-        elif op[0] == 'replace':
-            s += 1
-    return d, i, s
-
-
-def cer(hyps, refs):
-    delete = 0
-    insert = 0
-    substitute = 0
-    nbchar = 0
-    for h, r in zip(hyps, refs):
+    ops = Counter(op[0] for op in L.editops(s1, s2))
+    return ops['delete'], ops['insert'], ops['replace']
+
+
+def _cer_counts(pairs):
+    counts = Counter(Del=0, Ins=0, Sub=0, N=0)
+    for h, r in pairs:
         d, i, s = nbeditops(r, h)
-        delete += d
-        insert += i
-        substitute += s
-        nbchar += len(r)
+        counts.update(Del=d, Ins=i, Sub=s, N=len(r))
+    return counts
+
+
+def _wer_counts(pairs):
+    counts = Counter(Del=0, Ins=0, Sub=0, Cor=0, N=0)
+    for h, r in pairs:
+        results = wer_sent(r, h)
+        counts.update(Del=results['Del'], Ins=results['Ins'],
+                      Sub=results['Sub'], Cor=results['Cor'],
+                      N=len(r.split()))
+    return counts
+
+
+def _count_ops(count_fn, hyps, refs, workers=1):
+    """Sums the operation counts returned by `count_fn` over all
+    hypothesis/reference pairs, splitting them in one contiguous chunk per
+    worker process when `workers` > 1."""
+    pairs = list(zip(hyps, refs))
+    if workers is None or workers <= 1 or len(pairs) < 2:
+        return count_fn(pairs)
+    chunk_size = -(-len(pairs) // workers)
+    chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        for c in executor.map(count_fn, chunks):
+            counts.update(c)
+    return counts
+
+
+def cer(hyps, refs, workers=1):
+    counts = _count_ops(_cer_counts, hyps, refs, workers)
+    delete, insert, substitute = counts['Del'], counts['Ins'], counts['Sub']
+    nbchar = counts['N']
     cer = (delete + insert + substitute) / nbchar
     correct = nbchar - substitute - delete
     return {'CER': cer, 'Cor': correct, 'Sub': substitute, 'Ins': insert,
             'Del': delete}
 
 
-def wer(hyps, refs):
-    delete = 0
-    insert = 0
-    substitute = 0
-    correct = 0
-    nbwords = 0
-    for h, r in zip(hyps, refs):
-        results = wer_sent(r, h)
-        delete += results['Del']
-        insert += results['Ins']
-        substitute += results['Sub']
-        correct += results['Cor']
-        nbwords += len(r.split())
+def wer(hyps, refs, workers=1):
+    counts = _count_ops(_wer_counts, hyps, refs, workers)
+    delete, insert, substitute = counts['Del'], counts['Ins'], counts['Sub']
+    correct = counts['Cor']
+    nbwords = counts['N']
     wer = (delete + insert + substitute) / nbwords
     return {'WER': wer, 'Cor': correct, 'Sub': substitute, 'Ins': insert,
             'Del': delete}
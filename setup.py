@@ -12,16 +12,17 @@ setup(name='platalea',
                 'platalea.experiments.flickr8k', 'platalea.experiments.librispeech_places'],
       include_package_data=True,
       install_requires=[
-          'torch>=1.2.0',
-          'torchvision>=0.4.0',
+          'torch>=2.3.0',
+          'torchvision>=0.18.0',
           'numpy>=1.17.2',
           'scipy>=1.3.1',
           'configargparse>=1.0',
           'nltk>=3.4.5',
           'soundfile>=0.10.3',
-          'scikit-learn==0.22.1',
-          'wandb>=0.10.10',
+          'scikit-learn>=0.22.1',
+          'PyYAML>=5.1',
           'python-Levenshtein>=0.12.0'],
+      extras_require={'wandb': ['wandb>=0.10.10']},
       use_scm_version=True,
       setup_requires=['setuptools_scm'],
       )
@@ -0,0 +1,62 @@
+import torch
+
+import platalea.hardware
+from platalea.accumulation import accumulate_gradients, micro_batches
+from platalea.basic import SpeechImage
+
+
+def _tiny_speech_image():
+    torch.manual_seed(123)
+    return SpeechImage(dict(
+        SpeechEncoder=dict(conv=dict(in_channels=3, out_channels=4, kernel_size=2, stride=2, padding=0, bias=False),
+                           rnn=dict(input_size=4, hidden_size=4, num_layers=1, bidirectional=True, dropout=0),
+                           att=dict(in_size=8, hidden_size=4)),
+        ImageEncoder=dict(linear=dict(in_size=5, out_size=8), norm=True),
+        margin_size=0.2))
+
+
+def _batch(size):
+    return dict(audio=torch.randn(size, 3, 10),
+                audio_len=torch.randint(4, 11, (size,)),
+                image=torch.randn(size, 5))
+
+
+def _gradients(net):
+    return [p.grad.clone() for p in net.parameters()]
+
+
+def test_micro_batches_keeps_incomplete_last_step():
+    assert list(micro_batches(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_gradient_cache_equals_full_batch_gradient():
+    net = _tiny_speech_image()
+    scaler = platalea.hardware.grad_scaler(None)
+    items = [_batch(3), _batch(3)]
+    full = {key: torch.cat([item[key] for item in items]) for key in items[0]}
+
+    loss = net.cost(full)
+    loss.backward()
+    expected = _gradients(net)
+    net.zero_grad()
+
+    loss_value = accumulate_gradients(net, items, scaler, gradient_cache=True)
+
+    assert abs(loss_value - loss.item()) < 1e-6
+    for g, e in zip(_gradients(net), expected):
+        torch.testing.assert_close(g, e)
+
+
+def test_accumulation_averages_micro_batch_gradients():
+    net = _tiny_speech_image()
+    scaler = platalea.hardware.grad_scaler(None)
+    items = [_batch(3), _batch(3)]
+
+    (sum(net.cost(item) for item in items) / 2).backward()
+    expected = _gradients(net)
+    net.zero_grad()
+
+    accumulate_gradients(net, items, scaler)
+
+    for g, e in zip(_gradients(net), expected):
+        torch.testing.assert_close(g, e)
@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+
+from platalea.basicvq import SpeechImage
+from platalea.encoders import inout
+
+
+def _config(levels):
+    bottom = dict(conv=dict(in_channels=39, out_channels=16, kernel_size=6, stride=2, padding=0, bias=False),
+                  rnn=dict(input_size=16, hidden_size=8, num_layers=1, bidirectional=True, dropout=0))
+    codebook = dict(num_codebook_embeddings=12, embedding_dim=16, jitter=0.12)
+    top = dict(rnn=dict(input_size=16, hidden_size=8, num_layers=1, bidirectional=True, dropout=0),
+               att=dict(in_size=16, hidden_size=8))
+    speech = dict(SpeechEncoderBottom=bottom, SpeechEncoderTop=top)
+    if levels == 1:
+        speech['VQEmbedding'] = codebook
+    else:
+        speech.update(VQEmbedding1=codebook, VQEmbedding2=dict(codebook, num_codebook_embeddings=10),
+                      SpeechEncoderMiddle=dict(rnn=dict(input_size=16, hidden_size=16, num_layers=1)))
+    return dict(SpeechEncoder=speech, ImageEncoder=dict(linear=dict(in_size=20, out_size=16), norm=True))
+
+
+def test_codes_match_padded_codes():
+    torch.manual_seed(123)
+    audios = [torch.randn(n, 39) for n in [50, 7, 33, 80, 12]]
+    for levels in [1, 2]:
+        net = SpeechImage(_config(levels)).eval()
+        codes = net.codes(audios, batch_size=2)
+        one_hot = net.codes(audios, one_hot=True, batch_size=3)
+        assert len(codes) == len(one_hot) == levels
+        for i, audio in enumerate(audios):
+            # Each utterance alone, without padding
+            with torch.no_grad():
+                expected, _ = net.SpeechEncoder.codes(audio.t().unsqueeze(0), torch.tensor([len(audio)]))
+            length = inout(net.SpeechEncoder.Bottom.Conv, torch.tensor(len(audio))).item()
+            for level in range(levels):
+                num_codes = net.SpeechEncoder.codebooks()[level].embedding.size(0)
+                assert codes[level][i].tolist() == expected[level][0, :length].tolist()
+                assert (one_hot[level][i] == np.eye(num_codes)[codes[level][i]]).all()
+        assert all((a == b).all() for a, b in zip(net.code_audio(audios, level=levels - 1), codes[-1]))
@@ -0,0 +1,106 @@
+import torch
+
+from platalea.checkpoint import CheckpointWriter, TrainingState, load_model, load_weights
+from platalea.controller import TrainingController
+
+
+def _train(epochs, stop=None):
+    """Trains a toy model, returning its final weights, or None when stopped
+    after the given (epoch, step)."""
+    torch.manual_seed(123)
+    data = torch.utils.data.DataLoader(torch.randn(12, 3), batch_size=2, shuffle=True)
+    net = torch.nn.Sequential(torch.nn.Dropout(0.5), torch.nn.Linear(3, 1))
+    optimizer = torch.optim.Adam(net.parameters(), lr=0.1)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=4)
+    state = TrainingState(net=net, optimizer=optimizer, scheduler=scheduler)
+    state.load()
+    with state.open_results() as out:
+        for epoch in range(state.epoch, epochs + 1):
+            steps = state.epoch_steps(epoch, data)
+            cost = state.costs['train']
+            for j, x in enumerate(steps, start=state.step + 1):
+                loss = net(x).pow(2).mean()
+                loss.backward()
+                optimizer.step()
+                optimizer.zero_grad()
+                scheduler.step()
+                cost['cost'] += loss.item()
+                state.end_step(j, checkpoint_interval=1)
+                if (epoch, j) == stop:
+                    return None
+            print(cost['cost'], file=out)
+            state.add_result(dict(epoch=epoch), out)
+            state.end_epoch()
+    return net.state_dict()
+
+
+def test_resume_in_the_middle_of_an_epoch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    expected = _train(3)
+    with open('result.json') as f:
+        expected_results = f.read()
+    (tmp_path / 'checkpoint.pt').unlink()
+    assert _train(3, stop=(2, 4)) is None
+    for k, v in _train(3).items():
+        torch.testing.assert_close(v, expected[k])
+    with open('result.json') as f:
+        assert f.read() == expected_results
+
+
+def test_load_weights_from_model_or_state_dict(tmp_path):
+    net = torch.nn.Linear(3, 2)
+    torch.save(net, tmp_path / 'net.pt')
+    torch.save(net.state_dict(), tmp_path / 'weights.pt')
+    for path in ['net.pt', 'weights.pt']:
+        other = torch.nn.Linear(3, 2)
+        load_weights(other, str(tmp_path / path))
+        torch.testing.assert_close(other.weight, net.weight)
+
+
+def test_writer_saves_snapshot(tmp_path):
+    net = torch.nn.Linear(3, 2)
+    # Modules may keep intermediate results, e.g. attention weights
+    net.output = net(torch.ones(1, 3))
+    expected = net.weight.detach().clone()
+    with CheckpointWriter() as writer:
+        writer.save(net, str(tmp_path / 'net.pt'))
+        with torch.no_grad():
+            net.weight.add_(1)
+    torch.testing.assert_close(load_model(str(tmp_path / 'net.pt')).weight, expected)
+    assert not (tmp_path / 'net.pt.tmp').exists()
+
+
+def test_writer_keeps_last_and_best_checkpoints(tmp_path):
+    best = str(tmp_path / 'net.best.pt')
+    with CheckpointWriter(keep_last=2, best_path=best) as writer:
+        for epoch, score in enumerate([0.1, 0.5, 0.2, 0.3, 0.4], start=1):
+            writer.save(torch.full((1,), epoch), str(tmp_path / 'net.{}.pt'.format(epoch)), score=score)
+            writer.wait()
+            assert torch.load(best).item() == (1 if epoch == 1 else 2)
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['net.2.pt', 'net.4.pt', 'net.5.pt', 'net.best.pt']
+
+
+def test_controller_stops_without_improvement():
+    calls = []
+    controller = TrainingController(patience=2, plateau_policies=[lambda: calls.append(1)])
+    for score in [0.2, 0.3, 0.1, 0.3]:
+        assert controller.stop_reason() is None
+        controller.step()
+        assert controller.evaluation_due(end_of_epoch=True)
+        controller.evaluated({'recall': {10: score}})
+    assert len(calls) == 2
+    assert controller.stop_reason() is not None
+
+
+def test_controller_evaluates_at_step_budget():
+    controller = TrainingController(max_steps=5, eval_interval=2)
+    due = []
+    for step in range(1, 6):
+        controller.step()
+        if controller.evaluation_due():
+            due.append(step)
+            controller.evaluated({'recall': {10: step}})
+    assert due == [2, 4, 5]
+    assert controller.stop_reason() is not None
+    assert not controller.evaluation_due(end_of_epoch=True)
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing
+
+import platalea.distributed
+import platalea.loss
+import platalea.score
+
+
+def _run(rank, world_size, port, fn, results):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size),
+                      MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port))
+    platalea.distributed.init_process_group()
+    try:
+        results[rank] = fn()
+    finally:
+        dist.destroy_process_group()
+
+
+def _spawn(fn, world_size=2):
+    """Runs `fn` in `world_size` CPU processes communicating through gloo and
+    returns their results in rank order."""
+    results = torch.multiprocessing.Manager().dict()
+    torch.multiprocessing.start_processes(
+        _run, args=(world_size, platalea.distributed._free_port(), fn, results),
+        nprocs=world_size, start_method='fork')
+    return [results[rank] for rank in range(world_size)]
+
+
+def _average_gradients():
+    net = torch.nn.Linear(3, 2)
+    platalea.distributed.broadcast_parameters(net)
+    torch.manual_seed(platalea.distributed.get_rank())
+    net(torch.randn(4, 3)).sum().backward()
+    local = [p.grad.clone() for p in net.parameters()]
+    platalea.distributed.average_gradients(net)
+    return local, [p.grad for p in net.parameters()]
+
+
+def test_average_gradients():
+    (local0, avg0), (local1, avg1) = _spawn(_average_gradients)
+    for l0, l1, a0, a1 in zip(local0, local1, avg0, avg1):
+        torch.testing.assert_close(a0, (l0 + l1) / 2)
+        torch.testing.assert_close(a1, a0)
+
+
+def _gathered_contrastive_loss():
+    net = torch.nn.Linear(3, 4)
+    platalea.distributed.broadcast_parameters(net)
+    # Processes have batches of different sizes
+    torch.manual_seed(platalea.distributed.get_rank())
+    x = torch.randn(2 + platalea.distributed.get_rank(), 3)
+    y = torch.randn(2 + platalea.distributed.get_rank(), 3)
+
+    def loss(u, v):
+        return platalea.loss.contrastive(platalea.loss.cosine_matrix(u, v))
+
+    loss(platalea.distributed.all_gather_with_grad(net(x)),
+         platalea.distributed.all_gather_with_grad(net(y))).backward()
+    platalea.distributed.average_gradients(net)
+    gathered = [p.grad.clone() for p in net.parameters()]
+
+    net.zero_grad()
+    full_x = torch.cat(platalea.distributed.all_gather(x))
+    full_y = torch.cat(platalea.distributed.all_gather(y))
+    loss(net(full_x), net(full_y)).backward()
+    return gathered, [p.grad for p in net.parameters()]
+
+
+def test_gathered_loss_has_full_batch_gradient():
+    for gathered, full in _spawn(_gathered_contrastive_loss):
+        for g, f in zip(gathered, full):
+            torch.testing.assert_close(g, f)
+
+
+def _embed():
+    items = list(range(7))
+    return platalea.score._embed(lambda x: np.array(x) * 2, items)
+
+
+def test_distributed_embedding_gathers_shards_in_order():
+    for result in _spawn(_embed, world_size=3):
+        np.testing.assert_array_equal(result, np.arange(7) * 2)
+
+
+def _sampler():
+    sampler = platalea.distributed.sampler(list(range(10)), shuffle=True)
+    sampler.set_epoch(1)
+    return list(sampler)
+
+
+def test_sampler_splits_data_between_processes():
+    part0, part1 = _spawn(_sampler)
+    assert sorted(part0 + part1) == list(range(10))
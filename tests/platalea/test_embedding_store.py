@@ -0,0 +1,35 @@
+import numpy as np
+import torch
+
+from platalea.utils.embed_corpus import embed_items
+from platalea.utils.embedding_store import EmbeddingStore
+
+
+class _Net():
+    def __init__(self):
+        self.calls = []
+
+    def embed_audio(self, audios):
+        self.calls.append(len(audios))
+        assert not torch.is_grad_enabled()
+        return np.stack([a.mean(axis=0) for a in audios])
+
+
+def test_embeddings_are_stored_and_resumed(tmp_path):
+    rng = np.random.default_rng(123)
+    ids = ['utt{}.wav'.format(i) for i in range(10)]
+    audio = [rng.normal(size=(20 + i, 4)).astype(np.float32) for i in range(10)]
+    net = _Net()
+    store = EmbeddingStore(tmp_path)
+    assert embed_items(net, store, 'audio', ids[:5], audio[:5], shard_size=2) == 5
+    assert net.calls == [2, 2, 1]
+    # Resuming only embeds the missing items
+    store = EmbeddingStore(tmp_path)
+    assert embed_items(net, store, 'audio', ids, audio, shard_size=4) == 5
+    assert net.calls == [2, 2, 1, 4, 1]
+    stored_ids, embeddings = EmbeddingStore(tmp_path).embeddings('audio')
+    assert stored_ids == ids
+    assert np.allclose(embeddings, np.stack([a.mean(axis=0) for a in audio]))
+    assert np.allclose(store['audio', 'utt7.wav'], audio[7].mean(axis=0))
+    assert store.missing('audio', ids + ['new.wav']) == ['new.wav']
+    assert store.embeddings('image') == ([], None)
@@ -0,0 +1,63 @@
+import subprocess
+import sys
+import torch
+
+import platalea.encoders as E
+from platalea.basic import SpeechImage
+from platalea.scripted import script
+from platalea.utils.export import export
+
+RNN = dict(input_size=16, hidden_size=8, num_layers=2, bidirectional=True, dropout=0)
+CONV = dict(in_channels=39, out_channels=16, kernel_size=6, stride=2, padding=0, bias=False)
+ATT = dict(in_size=16, hidden_size=8)
+
+
+def test_scripted_encoders_match():
+    torch.manual_seed(123)
+    audio = (torch.randn(3, 39, 50), torch.tensor([50, 40, 30]))
+    text = (torch.randint(0, 20, (3, 9)), torch.tensor([9, 5, 3]))
+    encoders = [
+        (E.SpeechEncoder(dict(conv=CONV, rnn=RNN, att=ATT)), audio),
+        (E.SpeechEncoder(dict(conv=CONV, rnn=RNN)), audio),
+        (E.SpeechEncoderMultiConv(dict(
+            conv=[CONV, dict(in_channels=16, out_channels=16, kernel_size=3, stride=2,
+                             padding=1)],
+            rnn=RNN, att=ATT)), audio),
+        (E.SpeechEncoderTransformer(dict(
+            conv=CONV, upsample=dict(bias=True), att=dict(in_size=32, hidden_size=8),
+            trafo=dict(d_model=32, dim_feedforward=64, num_encoder_layers=2, dropout=0,
+                       nhead=4))), audio),
+        (E.TextEncoder(dict(emb=dict(num_embeddings=20, embedding_dim=16), rnn=RNN,
+                            att=ATT)), text),
+        (E.ImageEncoder(dict(linear=dict(in_size=20, out_size=16), norm=True)),
+         (torch.randn(3, 20),))]
+    for encoder, inputs in encoders:
+        encoder.eval()
+        scripted = script(encoder)
+        with torch.no_grad():
+            assert torch.allclose(encoder(*inputs), scripted(*inputs), atol=1e-6), \
+                type(encoder).__name__
+
+
+def test_exported_encoders_load_without_platalea(tmp_path):
+    torch.manual_seed(123)
+    net = SpeechImage(dict(
+        SpeechEncoder=dict(conv=CONV, rnn=dict(RNN, hidden_size=32),
+                           att=dict(in_size=64, hidden_size=16)),
+        ImageEncoder=dict(linear=dict(in_size=20, out_size=64), norm=True),
+        margin_size=0.2)).eval()
+    export(net, str(tmp_path))
+    audio = torch.randn(2, 39, 60)
+    length = torch.tensor([60, 45])
+    torch.save(dict(audio=audio, length=length), tmp_path / 'inputs.pt')
+    code = '\n'.join([
+        'import sys, torch',
+        'inputs = torch.load("inputs.pt")',
+        'encoder = torch.jit.load("SpeechEncoder.pt")',
+        'torch.save(encoder(inputs["audio"], inputs["length"]), "output.pt")',
+        'assert not any(m.startswith("platalea") for m in sys.modules)'])
+    subprocess.run([sys.executable, '-c', code], cwd=str(tmp_path), check=True)
+    with torch.no_grad():
+        expected = net.SpeechEncoder(audio, length)
+    assert torch.allclose(torch.load(tmp_path / 'output.pt'), expected, atol=1e-6)
+    assert (tmp_path / 'ImageEncoder.pt').exists()
@@ -0,0 +1,52 @@
+import os
+
+import torch
+
+from platalea.utils.feature_cache import FeatureCache
+
+
+def _files(root, n, start=0):
+    paths = []
+    for i in range(start, n):
+        path = root / 'data' / '{}.txt'.format(i)
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(str(i))
+        paths.append(path)
+    return paths
+
+
+class Compute():
+    """Feature extraction recording the paths it is given."""
+    def __init__(self):
+        self.paths = []
+
+    def __call__(self, paths):
+        self.paths.extend(paths)
+        return [torch.tensor([float(p.read_text())]) for p in paths]
+
+
+def test_cache_only_computes_missing_and_stale_features(tmp_path):
+    paths = _files(tmp_path, 5)
+    compute = Compute()
+    cache = FeatureCache(tmp_path, 'test', dict(a=1), shard_size=2)
+    assert cache.update(paths, compute) == 5
+    assert len(list(cache.directory.glob('shard-*.pt'))) == 3
+    paths[3].write_text('30')
+    os.utime(paths[3], ns=(0, 0))
+    paths += _files(tmp_path, 7, start=5)
+    cache = FeatureCache(tmp_path, 'test', dict(a=1), shard_size=2)
+    assert cache.verify(paths) == (paths[5:], [paths[3]])
+    compute.paths = []
+    assert cache.update(paths, compute) == 3
+    assert compute.paths == paths[5:] + [paths[3]]
+    assert torch.cat(cache.features(paths)).tolist() == [0, 1, 2, 30, 4, 5, 6]
+    assert cache[paths[3]].item() == 30
+    assert FeatureCache(tmp_path, 'test', dict(a=1)).verify(paths) == ([], [])
+
+
+def test_cache_depends_on_config_and_content(tmp_path):
+    paths = _files(tmp_path, 2)
+    FeatureCache(tmp_path, 'test', dict(a=1), content_hash=True).update(paths, Compute())
+    assert FeatureCache(tmp_path, 'test', dict(a=2)).verify(paths) == (paths, [])
+    os.utime(paths[0], ns=(0, 0))
+    assert FeatureCache(tmp_path, 'test', dict(a=1), content_hash=True).verify(paths) == ([], [])
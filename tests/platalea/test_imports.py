@@ -0,0 +1,32 @@
+import json
+import subprocess
+import sys
+
+# Only needed on some code paths, and slow to import
+HEAVY_MODULES = ['wandb', 'torchvision', 'sklearn', 'nltk', 'Levenshtein', 'scipy',
+                 'PIL', 'soundfile', 'yaml']
+
+MODULES = ['platalea.basic', 'platalea.asr', 'platalea.mtl', 'platalea.text_image',
+           'platalea.basicvq', 'platalea.dataset', 'platalea.score', 'platalea.vq_encode',
+           'platalea.utils.preprocessing', 'platalea.utils.get_best_score',
+           'platalea.utils.copy_best']
+
+SCRIPT = """
+import json, sys, time
+import numpy, torch
+start = time.perf_counter()
+{imports}
+print(json.dumps(dict(time=time.perf_counter() - start,
+                      heavy=[m for m in {heavy} if m in sys.modules])))
+"""
+
+
+def test_import_time():
+    imports = '\n'.join('import {}'.format(m) for m in MODULES)
+    script = SCRIPT.format(imports=imports, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', script], check=True,
+                         capture_output=True, text=True).stdout
+    result = json.loads(out.splitlines()[-1])
+    assert result['heavy'] == []
+    # Besides torch and numpy, importing platalea takes a fraction of a second
+    assert result['time'] < 1.0
@@ -0,0 +1,42 @@
+import numpy as np
+
+import platalea.rank_eval
+from platalea.index import FlatIndex, IVFIndex, load_index
+from platalea.utils.build_index import benchmark
+
+
+def _data():
+    rng = np.random.default_rng(123)
+    centers = rng.normal(size=(20, 32))
+    vectors = centers[rng.integers(0, 20, 2000)] + 0.5 * rng.normal(size=(2000, 32))
+    queries = vectors[:100] + 0.1 * rng.normal(size=(100, 32))
+    return vectors, queries
+
+
+def test_flat_index_matches_ranking():
+    vectors, queries = _data()
+    _, neighbours = FlatIndex().build(vectors).search(queries, k=5, batch_size=30)
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    correct = np.zeros((len(queries), len(vectors)), dtype=bool)
+    correct[np.arange(len(queries)), neighbours[:, 0]] = True
+    result = platalea.rank_eval.ranking(vectors, queries, correct)
+    assert result['ranks'] == [1] * len(queries)
+
+
+def test_ivf_index(tmp_path):
+    vectors, queries = _data()
+    index = IVFIndex(nprobe=4).build(vectors, ids=['img{}'.format(i) for i in range(len(vectors))])
+    results = benchmark(index, vectors, queries, k=10, nprobes=[1, 16, 1000])
+    assert [r['nprobe'] for r in results] == [None, 1, 16, 1000]
+    assert results[-1]['overlap'] == 1.0
+    assert results[2]['overlap'] > 0.9
+    index.save(str(tmp_path / 'index.npz'))
+    loaded = load_index(str(tmp_path / 'index.npz'))
+    scores, ids = index.search(queries, k=3)
+    loaded_scores, loaded_ids = loaded.search(queries, k=3)
+    assert (ids == loaded_ids).all() and np.allclose(scores, loaded_scores)
+    assert ids[0, 0] == 'img0'
+    # All vectors are returned when there are fewer than k
+    _, ids = IVFIndex(nprobe=1).build(vectors[:5]).search(queries, k=10)
+    assert ids.shape == (100, 5) and (np.sort(ids, axis=1) == np.arange(5)).all()
@@ -0,0 +1,108 @@
+import pickle
+
+import torch
+
+import platalea.loss
+
+
+def _hinge_loss(M, negatives_r, negatives_c, margin=0.2):
+    """Contrastive loss with additional negatives, one pair at a time."""
+    B = M.size(0)
+    loss_r = sum(max(0, margin + s - M[i, i]) for i in range(B)
+                 for j, s in enumerate(torch.cat([M[i], negatives_r[i]])) if j != i)
+    loss_c = sum(max(0, margin + s - M[j, j]) for j in range(B)
+                 for i, s in enumerate(torch.cat([M[:, j], negatives_c[:, j]])) if i != j)
+    return loss_r / (B * (B + negatives_r.size(1))) + loss_c / (B * (B + negatives_c.size(0)))
+
+
+def test_contrastive_with_additional_negatives():
+    torch.manual_seed(123)
+    M = torch.rand(4, 4)
+    negatives_r = torch.rand(4, 3)
+    negatives_c = torch.rand(5, 4)
+    torch.testing.assert_close(
+        platalea.loss.contrastive(M, negatives_r=negatives_r, negatives_c=negatives_c),
+        _hinge_loss(M, negatives_r, negatives_c))
+
+
+def test_contrastive_without_additional_negatives():
+    torch.manual_seed(123)
+    M = torch.rand(4, 4)
+    torch.testing.assert_close(
+        platalea.loss.contrastive(M, negatives_r=torch.zeros(4, 0)),
+        platalea.loss.contrastive(M))
+
+
+def test_fused_cosine_contrastive_matches_unfused():
+    torch.manual_seed(123)
+    for margin in [0.2, 1.5]:
+        U = torch.randn(6, 5, dtype=torch.double, requires_grad=True)
+        V = torch.randn(6, 5, dtype=torch.double, requires_grad=True)
+        fused = platalea.loss.cosine_contrastive(U, V, margin=margin)
+        fused_grad = torch.autograd.grad(fused, [U, V])
+        unfused = platalea.loss.contrastive(platalea.loss.cosine_matrix(U, V), margin=margin)
+        unfused_grad = torch.autograd.grad(unfused, [U, V])
+        torch.testing.assert_close(fused, unfused)
+        for f, u in zip(fused_grad, unfused_grad):
+            torch.testing.assert_close(f, u)
+
+
+def _hard_negative_loss(M, k, negatives_r, negatives_c, margin=0.2):
+    """Mean violation of the k hardest negatives, sorting all of them."""
+    B = M.size(0)
+    loss = 0
+    for S, N in ((M, negatives_r), (M.t(), negatives_c.t())):
+        hinges = []
+        for i in range(B):
+            negatives = torch.cat([S[i, :i], S[i, i + 1:], N[i]])
+            hardest = negatives.sort(descending=True)[0][:k]
+            hinges.append(torch.clamp(margin + hardest - S[i, i], min=0))
+        hinges = torch.cat(hinges)
+        loss = loss + hinges.sum() / len(hinges)
+    return loss
+
+
+def test_hard_negatives():
+    torch.manual_seed(123)
+    M = torch.rand(5, 5)
+    for k in [1, 3, 10]:
+        for K in [0, 2]:
+            negatives_r = torch.rand(5, K)
+            negatives_c = torch.rand(K, 5)
+            torch.testing.assert_close(
+                platalea.loss.contrastive(M, negatives_r=negatives_r, negatives_c=negatives_c,
+                                          hard_negatives=k),
+                _hard_negative_loss(M, k, negatives_r, negatives_c))
+
+
+def test_max_violation_with_dominant_positive():
+    """The positive pair is among the k + 1 highest similarities."""
+    M = torch.tensor([[0.9, 0.5, 0.1], [0.2, 0.8, 0.6], [0.3, 0.1, 0.7]])
+    torch.testing.assert_close(platalea.loss.contrastive(M, hard_negatives=1),
+                               _hard_negative_loss(M, 1, torch.zeros(3, 0), torch.zeros(0, 3)))
+
+
+def test_memory_bank_keeps_most_recent_embeddings():
+    bank = platalea.loss.MemoryBank(size=5)
+    assert bank.get() is None
+    for step in range(3):
+        bank.push(torch.full((2, 1), float(step)), torch.full((2, 3), float(-step)))
+    speech, image = bank.get()
+    assert sorted(speech.view(-1).tolist()) == [0, 1, 1, 2, 2]
+    assert image.shape == (5, 3)
+
+
+def test_memory_bank_discards_stale_embeddings():
+    bank = platalea.loss.MemoryBank(size=10, max_age=2)
+    for step in range(4):
+        bank.push(torch.full((2, 1), float(step)))
+    embeddings, = bank.get()
+    assert sorted(embeddings.view(-1).tolist()) == [2, 2, 3, 3]
+
+
+def test_memory_bank_is_saved_empty():
+    bank = platalea.loss.MemoryBank(size=5, max_age=3)
+    bank.push(torch.ones(2, 1))
+    bank = pickle.loads(pickle.dumps(bank))
+    assert bank.get() is None
+    assert bank.size == 5 and bank.max_age == 3
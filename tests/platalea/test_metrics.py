@@ -0,0 +1,60 @@
+import json
+import time
+
+import pytest
+
+from platalea.metrics import CSVSink, JSONLSink, MetricsLogger, MetricsSink
+
+
+def test_logger_writes_jsonl_and_csv(tmp_path):
+    jsonl, csv = str(tmp_path / 'metrics.jsonl'), str(tmp_path / 'metrics.csv')
+    with MetricsLogger([JSONLSink(jsonl), CSVSink(csv)], buffer_size=2) as logger:
+        logger.log({'loss': 0.5}, step=1)
+        logger.log({'loss': 0.25}, step=2)
+        logger.log({'recall': {10: 0.75}}, step=2)
+    with open(jsonl) as f:
+        assert [json.loads(line) for line in f] == [
+            {'step': 1, 'loss': 0.5}, {'step': 2, 'loss': 0.25},
+            {'step': 2, 'recall': {'10': 0.75}}]
+    with open(csv) as f:
+        assert f.read().splitlines() == [
+            'step,name,value', '1,loss,0.5', '2,loss,0.25', '2,recall/10,0.75']
+
+
+def test_step_of_logger_replaces_step_of_record(tmp_path):
+    jsonl = str(tmp_path / 'metrics.jsonl')
+    with MetricsLogger([JSONLSink(jsonl)]) as logger:
+        logger.log({'epoch': 1, 'step': 10}, step=110)
+    with open(jsonl) as f:
+        assert [json.loads(line) for line in f] == [{'epoch': 1, 'step': 110}]
+
+
+class SlowSink(MetricsSink):
+    def __init__(self):
+        self.records = []
+
+    def write(self, records):
+        time.sleep(0.01)
+        self.records.extend(records)
+
+
+def test_logging_overhead_is_small():
+    sink = SlowSink()
+    with MetricsLogger([sink]) as logger:
+        for step in range(10000):
+            logger.log({'loss': 0.1, 'epoch': 1}, step=step)
+        # Writing happens in the background
+        assert logger.overhead / logger.calls < 1e-4
+    assert len(sink.records) == 10000
+
+
+class FailingSink(MetricsSink):
+    def write(self, records):
+        raise OSError('disk full')
+
+
+def test_sink_errors_are_raised():
+    logger = MetricsLogger([FailingSink()])
+    logger.log({'loss': 0.1})
+    with pytest.raises(RuntimeError):
+        logger.close()
@@ -0,0 +1,41 @@
+import numpy as np
+import PIL.Image
+import torch
+
+from platalea.utils.feature_cache import FeatureCache
+from platalea.utils.preprocessing import TenCrop, _assemble, extract_image_features
+
+
+def test_batched_image_features_match_single_images(tmp_path):
+    rng = np.random.default_rng(123)
+    paths = []
+    for i, mode in enumerate(['RGB', 'L', 'RGB']):
+        im = PIL.Image.fromarray(rng.integers(0, 256, (260 + 10 * i, 300, 3), dtype=np.uint8))
+        paths.append(str(tmp_path / '{}.png'.format(i)))
+        im.convert(mode).save(paths[-1])
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 7, stride=4), torch.nn.AdaptiveAvgPool2d(1))
+    device = torch.device('cpu')
+    features = extract_image_features(model, paths, device, batch_size=2)
+    with torch.no_grad():
+        # Each image on its own
+        expected = [model(TenCrop()(PIL.Image.open(p))).mean(0).squeeze() for p in paths]
+    torch.testing.assert_close(torch.stack(features), torch.stack(expected))
+
+
+def test_assembled_features_follow_file_list(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / '{}.txt'.format(i))
+        paths[-1].write_text(str(i))
+    cache = FeatureCache(tmp_path, 'test', dict(a=1))
+    cache.update(paths, lambda paths: [torch.tensor([float(p.read_text())]) for p in paths])
+    fpath = tmp_path / 'features.pt'
+    _assemble(cache, [p.name for p in paths], paths, fpath)
+    mtime = fpath.stat().st_mtime_ns
+    _assemble(cache, [p.name for p in paths], paths, fpath)
+    assert fpath.stat().st_mtime_ns == mtime
+    # Removing a file from the list does not change the cache
+    _assemble(cache, [p.name for p in paths[1:]], paths[1:], fpath)
+    stored = torch.load(fpath)
+    assert stored['filenames'] == ['1.txt', '2.txt']
+    assert torch.cat(stored['features']).tolist() == [1, 2]
@@ -0,0 +1,39 @@
+import torch
+
+from platalea.basic import SpeechImage
+from platalea.checkpoint import load_model
+from platalea.utils.quantize import drift, quantize
+
+
+def _net():
+    torch.manual_seed(123)
+    return SpeechImage(dict(
+        SpeechEncoder=dict(conv=dict(in_channels=39, out_channels=16, kernel_size=6, stride=2,
+                                     padding=0, bias=False),
+                           rnn=dict(input_size=16, hidden_size=32, num_layers=2,
+                                    bidirectional=True, dropout=0),
+                           att=dict(in_size=64, hidden_size=16)),
+        ImageEncoder=dict(linear=dict(in_size=20, out_size=64), norm=True),
+        margin_size=0.2))
+
+
+def test_quantized_encoders_match_fp32(tmp_path):
+    net = _net().eval()
+    quantized = quantize(net)
+    assert isinstance(quantized.SpeechEncoder.RNN, torch.ao.nn.quantized.dynamic.GRU)
+    assert isinstance(quantized.ImageEncoder.linear_transform, torch.ao.nn.quantized.dynamic.Linear)
+    assert isinstance(net.SpeechEncoder.RNN, torch.nn.GRU)
+    torch.save(quantized, tmp_path / 'net.int8.pt')
+    quantized = load_model(str(tmp_path / 'net.int8.pt'))
+    audio = torch.randn(3, 39, 50)
+    length = torch.tensor([50, 40, 30])
+    with torch.no_grad():
+        similarity = (net.SpeechEncoder(audio, length) *
+                      quantized.SpeechEncoder(audio, length)).sum(dim=1)
+    assert (similarity > 0.99).all()
+
+
+def test_drift():
+    fp32 = dict(medr=2.0, recall={1: 0.5, 5: 0.75, 10: 1.0})
+    int8 = dict(medr=3.0, recall={1: 0.25, 5: 0.75, 10: 1.0})
+    assert drift(fp32, int8) == dict(medr=1.0, recall={1: -0.25, 5: 0.0, 10: 0.0})
@@ -0,0 +1,37 @@
+import random
+
+from nltk.translate.bleu_score import sentence_bleu
+
+import platalea.score
+import platalea.xer
+
+
+def _random_sentences(n, tokens, max_length, seed=123):
+    rng = random.Random(seed)
+    return [[rng.choice(tokens) for _ in range(rng.randint(0, max_length))] for _ in range(n)]
+
+
+def test_parallel_cer_equals_serial():
+    refs = [''.join(s) or 'a' for s in _random_sentences(50, 'abc d', 30, seed=1)]
+    hyps = [''.join(s) for s in _random_sentences(50, 'abc d', 30, seed=2)]
+    assert platalea.xer.cer(hyps, refs, workers=3) == platalea.xer.cer(hyps, refs)
+
+
+def test_parallel_wer_equals_serial():
+    refs = [' '.join(s) or 'a' for s in _random_sentences(50, ['a', 'dog', 'runs'], 10, seed=1)]
+    hyps = [' '.join(s) for s in _random_sentences(50, ['a', 'dog', 'runs'], 10, seed=2)]
+    assert platalea.xer.wer(hyps, refs, workers=3) == platalea.xer.wer(hyps, refs)
+
+
+def test_sentence_bleu_matches_nltk():
+    """Includes empty hypotheses and sentences shorter than the n-gram order."""
+    tokens = ['the', 'a', 'dog', 'cat', 'runs']
+    refs = _random_sentences(200, tokens, 12, seed=1)
+    hyps = _random_sentences(200, tokens, 12, seed=2)
+    for r, h in zip(refs, hyps):
+        assert platalea.score._sentence_bleu(r, h) == sentence_bleu([r], h)
+
+
+def test_sentence_bleu_on_characters():
+    """Japanese sentences are not split and BLEU is computed on characters."""
+    assert platalea.score._sentence_bleu('犬が走る', '犬が走った') == sentence_bleu(['犬が走る'], '犬が走った')
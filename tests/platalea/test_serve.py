@@ -0,0 +1,99 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import io
+import json
+import threading
+import numpy as np
+import torch
+
+from platalea.basic import SpeechImage
+from platalea.utils.serve import MicroBatcher, Server
+
+
+def _net():
+    torch.manual_seed(123)
+    return SpeechImage(dict(
+        SpeechEncoder=dict(conv=dict(in_channels=39, out_channels=16, kernel_size=6, stride=2,
+                                     padding=0, bias=False),
+                           rnn=dict(input_size=16, hidden_size=32, num_layers=1,
+                                    bidirectional=True, dropout=0),
+                           att=dict(in_size=64, hidden_size=16)),
+        ImageEncoder=dict(linear=dict(in_size=20, out_size=64), norm=True),
+        margin_size=0.2)).eval()
+
+
+def _request(port, method, path, body=None, content_type='application/json'):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request(method, path, body, {'Content-Type': content_type})
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+def test_server_batches_concurrent_requests():
+    net = _net()
+    server = Server(net, max_batch_size=8, max_latency=0.2)
+    loop = asyncio.new_event_loop()
+    http_server = loop.run_until_complete(server.start(port=0))
+    port = http_server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        rng = np.random.default_rng(123)
+        audio = [rng.normal(size=(n, 39)).astype(np.float32) for n in range(40, 56)]
+        bodies = [json.dumps(dict(features=a.tolist())) for a in audio[:8]]
+        for a in audio[8:]:
+            f = io.BytesIO()
+            np.save(f, a)
+            bodies.append(f.getvalue())
+        with ThreadPoolExecutor(16) as pool:
+            responses = list(pool.map(
+                lambda b: _request(port, 'POST', '/embed_audio', b,
+                                   'application/json' if isinstance(b, str)
+                                   else 'application/octet-stream'), bodies))
+        with torch.no_grad():
+            expected = np.concatenate([net.embed_audio([torch.from_numpy(a)]) for a in audio])
+        for (status, response), e in zip(responses, expected):
+            assert status == 200
+            # Padding in batches changes embeddings slightly
+            assert np.dot(response['embedding'], e) > 0.999
+        status, stats = _request(port, 'GET', '/stats')
+        assert stats['embed_audio']['requests'] == 16
+        assert stats['embed_audio']['batches'] < 16
+        assert stats['embed_audio']['p99_latency'] >= stats['embed_audio']['p50_latency']
+        assert _request(port, 'POST', '/transcribe', '{}')[0] == 404
+        assert _request(port, 'POST', '/embed_image', '{}')[0] == 400
+        # Wrong number of channels or of dimensions
+        for features in [np.zeros((50, 13)), np.zeros(39), np.zeros((0, 39))]:
+            body = json.dumps(dict(features=features.tolist()))
+            assert _request(port, 'POST', '/embed_audio', body)[0] == 400
+        assert _request(port, 'POST', '/embed_image', json.dumps(dict(features=[0.0] * 20)))[0] == 200
+    finally:
+        http_server.close()
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+
+
+def test_failing_batch_is_retried_item_by_item():
+    def fn(items):
+        if any(i < 0 for i in items):
+            raise ValueError('negative item')
+        return [2 * i for i in items]
+
+    async def run():
+        with ThreadPoolExecutor(1) as executor:
+            batcher = MicroBatcher(fn, executor, max_batch_size=4, max_latency=0.1)
+            task = asyncio.ensure_future(batcher.run())
+            results = await asyncio.gather(*[batcher.submit(i) for i in [1, -1, 2, 3]],
+                                           return_exceptions=True)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return results
+
+    results = asyncio.run(run())
+    assert results[0] == 2 and results[2] == 4 and results[3] == 6
+    assert isinstance(results[1], ValueError)
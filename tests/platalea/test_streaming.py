@@ -0,0 +1,64 @@
+import torch
+
+import platalea.encoders as E
+from platalea.streaming import embed, stream_states
+
+CONV = dict(in_channels=39, out_channels=16, kernel_size=6, stride=2, padding=1)
+
+
+def _encoder(bidirectional, att=True):
+    torch.manual_seed(123)
+    config = dict(conv=CONV, rnn=dict(input_size=16, hidden_size=8, num_layers=2,
+                                      bidirectional=bidirectional, dropout=0))
+    if att:
+        config['att'] = dict(in_size=16 if bidirectional else 8, hidden_size=8)
+    return E.SpeechEncoder(config).eval()
+
+
+def test_streaming_matches_whole_recording():
+    audio = torch.randn(2, 39, 1001)
+    length = torch.tensor([1001, 1001])
+    chunks = torch.split(audio, 37, dim=2)
+    encoder = _encoder(False)
+    with torch.no_grad():
+        expected = encoder(audio, length)
+    assert torch.allclose(embed(encoder, chunks), expected, atol=1e-6)
+    encoder = _encoder(False, att=False)
+    with torch.no_grad():
+        expected = encoder(audio, length)
+    states = torch.cat(list(stream_states(encoder, chunks)), dim=1)
+    assert states.shape == expected.shape
+    assert torch.allclose(states, expected, atol=1e-6)
+
+
+def test_streaming_bidirectional_windows():
+    audio = torch.randn(1, 39, 1001)
+    length = torch.tensor([1001])
+    encoder = _encoder(True)
+    with torch.no_grad():
+        expected = encoder(audio, length)
+    # Exact with a window covering the recording
+    assert torch.allclose(embed(encoder, audio, chunk_frames=2048), expected, atol=1e-6)
+    embedding = embed(encoder, torch.split(audio, 37, dim=2), chunk_frames=200,
+                      context_frames=50)
+    assert (embedding * expected).sum() > 0.99
+
+
+def test_streaming_recordings_of_different_lengths():
+    audio = torch.randn(2, 39, 1001)
+    # Padded with zeros as by dataset.batch_audio
+    audio[1, :, 700:] = 0
+    lengths = torch.tensor([1001, 700])
+    for bidirectional in [False, True]:
+        encoder = _encoder(bidirectional)
+        with torch.no_grad():
+            expected = torch.cat([encoder(audio[i:i + 1, :, :n], n.view(1))
+                                  for i, n in enumerate(lengths)])
+        embedding = embed(encoder, torch.split(audio, 37, dim=2), lengths=lengths)
+        assert torch.allclose(embedding, expected, atol=1e-6)
+    encoder = _encoder(False, att=False)
+    states = torch.cat(list(stream_states(encoder, audio, chunk_frames=100, lengths=lengths)), dim=1)
+    with torch.no_grad():
+        expected = encoder(audio[1:, :, :700], lengths[1:])
+    assert torch.allclose(states[1, :expected.size(1)], expected[0], atol=1e-6)
+    assert (states[1, expected.size(1):] == 0).all()
@@ -0,0 +1,86 @@
+import os
+
+from platalea.utils.sweep import SuccessiveHalving, absolute_args, run_sweep, trial_parameters
+
+
+def test_grid_parameters():
+    sweep = dict(method='grid', parameters=dict(lr=dict(values=[0.1, 0.2]),
+                                                epochs=dict(value=3),
+                                                seed=dict(values=[1, 2])))
+    trials = trial_parameters(sweep)
+    assert len(trials) == 4
+    assert dict(lr=0.2, epochs=3, seed=1) in trials
+
+
+def test_successive_halving_milestones():
+    assert SuccessiveHalving.from_config(dict(max_iter=27, s=2, eta=3)).rungs == [3, 9]
+    assert SuccessiveHalving.from_config(dict(min_iter=1, s=3, eta=2)).rungs == [1, 2, 4]
+
+
+def test_successive_halving_keeps_top_trials():
+    scheduler = SuccessiveHalving([2], eta=2)
+    assert scheduler.report(1, 0.1)
+    assert scheduler.report(2, 0.5)
+    assert not scheduler.report(2, 0.3)
+    assert scheduler.report(2, 0.6)
+    assert not scheduler.report(2, 0.4)
+
+
+# Trial writing the given recall as result at each of 4 epochs
+PROGRAM = """
+import argparse, json, time
+parser = argparse.ArgumentParser()
+parser.add_argument('--recall', type=float)
+args = parser.parse_args()
+with open('result.json', 'w') as f:
+    for epoch in range(1, 5):
+        time.sleep(0.3)
+        print(json.dumps(dict(recall={10: args.recall}, epoch=epoch)), file=f, flush=True)
+"""
+
+
+def test_run_sweep_stops_losing_trials(tmp_path, capsys):
+    program = tmp_path / 'program.py'
+    program.write_text(PROGRAM)
+    sweep = dict(program=str(program), method='grid',
+                 parameters=dict(recall=dict(values=[0.5, 0.1, 0.9])),
+                 early_terminate=dict(type='hyperband', min_iter=2, s=1, eta=2))
+    trials = run_sweep(sweep, str(tmp_path / 'sweep'), slots=1, poll_interval=0.1)
+    assert [t.status for t in trials] == ['finished', 'stopped', 'finished']
+    assert trials[1].evaluations < 4
+    with open(tmp_path / 'sweep' / 'summary.tsv') as f:
+        lines = f.read().splitlines()
+    assert lines[0].split('\t') == ['trial', 'status', 'evaluations', 'best_score', 'recall']
+    assert lines[1].split('\t')[:2] == ['2', 'finished']
+    assert capsys.readouterr().out == ''
+
+
+# Trial reading its recall from a file of its data root
+DATA_PROGRAM = """
+import argparse, json, os
+parser = argparse.ArgumentParser()
+parser.add_argument('--flickr8k_root')
+parser.add_argument('--flickr8k_meta')
+parser.add_argument('--name')
+args = parser.parse_args()
+with open(os.path.join(args.flickr8k_root, args.flickr8k_meta)) as f:
+    recall = json.load(f)[args.name]
+with open('result.json', 'w') as f:
+    print(json.dumps(dict(recall={10: recall}, epoch=1)), file=f)
+"""
+
+
+def test_run_sweep_resolves_relative_paths(tmp_path, monkeypatch):
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'data' / 'dataset.json').write_text('{"a": 0.25, "b": 0.75}')
+    (tmp_path / 'program.py').write_text(DATA_PROGRAM)
+    monkeypatch.chdir(tmp_path)
+    sweep = dict(program='program.py', method='grid',
+                 parameters=dict(name=dict(values=['a', 'b']),
+                                 flickr8k_meta=dict(value='dataset.json')))
+    trials = run_sweep(sweep, 'sweep', slots=2, poll_interval=0.1,
+                       extra_args=['--flickr8k_root', 'data'])
+    assert [t.best_score for t in trials] == [0.25, 0.75]
+    assert absolute_args(['-c=a.yml', '--flickr8k_root', '/data', '--seed', '1'], '/runs') == [
+        '-c=' + os.path.normpath('/runs/a.yml'), '--flickr8k_root', os.path.normpath('/data'),
+        '--seed', '1']
@@ -0,0 +1,32 @@
+import numpy as np
+
+from platalea.vq_encode import Codes, run_length_encode, write_codes, write_text
+
+
+def _codes():
+    rng = np.random.default_rng(123)
+    return [np.repeat(rng.integers(0, 50, 20), rng.integers(1, 4, 20)) for _ in range(5)]
+
+
+def test_codes_round_trip(tmp_path):
+    codes = _codes()
+    names = ['utt{}'.format(i) for i in range(5)]
+    for rle in [False, True]:
+        write_codes(tmp_path / 'codes.npz', names, codes, 50, rle=rle)
+        stored = Codes(tmp_path / 'codes.npz')
+        assert stored.codes.dtype == np.int16
+        assert len(stored) == 5
+        for i, (name, c) in enumerate(stored.items()):
+            assert name == names[i]
+            assert (c == codes[i]).all()
+        assert (stored.one_hot('utt3') == np.eye(50)[codes[3]]).all()
+    values, lengths = run_length_encode(np.array([3, 3, 1, 2, 2, 2]))
+    assert values.tolist() == [3, 1, 2] and lengths.tolist() == [2, 1, 3]
+
+
+def test_text_matches_one_hot_text(tmp_path):
+    codes = _codes()
+    write_codes(tmp_path / 'codes.npz', ['a', 'b', 'c', 'd', 'e'], codes, 50, rle=True)
+    write_text(tmp_path / 'codes.npz', tmp_path / 'text')
+    np.savetxt(tmp_path / 'b.txt', np.eye(50)[codes[1]].astype(int), fmt='%d')
+    assert (tmp_path / 'text' / 'b.txt').read_text() == (tmp_path / 'b.txt').read_text()